@@ -0,0 +1,193 @@
+'''
+Load test for pytrace.  Runs the Quart app in this process with the
+subprocess worker backend (no docker needed) and drives simulated
+websocket clients through the programs in bench/programs.  Each client
+starts a program, sends its STDIN, steps up to --steps lines and then
+continues to the end, over and over until --duration has passed.
+
+    python bench/load.py --clients 20 --duration 60 --json result.json
+
+Reports start latency (START until stopped at the first line), step
+latency (STEP until stopped at the next line), steps per second and the
+RSS of the server process.
+'''
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+
+PYTRACE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pytrace")
+PROGRAM_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "programs")
+
+STATE_IDLE = 0
+STATE_WAIT = 2
+
+# Longest a single run may take before the client gives up on it
+RUN_TIMEOUT = 120
+
+class Stats:
+
+    def __init__(self):
+        self.start_latency = []
+        self.step_latency = []
+        self.runs = 0
+        self.failed = 0
+        self.rss = []
+
+    @staticmethod
+    def percentile(values, percent):
+        if not values:
+            return 0.0
+        values = sorted(values)
+        index = min(len(values) - 1, round(percent / 100 * (len(values) - 1)))
+        return values[index]
+
+    def report(self, elapsed):
+        '''
+        Return the results as a dictionary (latencies in milliseconds).
+        '''
+        return {
+            "runs" : self.runs,
+            "failed" : self.failed,
+            "steps" : len(self.step_latency),
+            "steps_per_second" : len(self.step_latency) / elapsed,
+            "start_p50_ms" : Stats.percentile(self.start_latency, 50) * 1000,
+            "start_p99_ms" : Stats.percentile(self.start_latency, 99) * 1000,
+            "step_p50_ms" : Stats.percentile(self.step_latency, 50) * 1000,
+            "step_p99_ms" : Stats.percentile(self.step_latency, 99) * 1000,
+            "rss_max_mb" : max(self.rss, default=0) / (1024 * 1024),
+            "rss_end_mb" : (self.rss[-1] if self.rss else 0) / (1024 * 1024),
+        }
+
+def load_programs():
+    '''
+    Return (name, code, stdin) for each program in the corpus.  STDIN for
+    a program is read from a .stdin file next to it.
+    '''
+    programs = []
+    for name in sorted(os.listdir(PROGRAM_DIRECTORY)):
+        if not name.endswith(".py"):
+            continue
+        with open(os.path.join(PROGRAM_DIRECTORY, name), encoding="utf-8") as file:
+            code = file.read()
+        stdin = ""
+        path = os.path.join(PROGRAM_DIRECTORY, name[:-len(".py")] + ".stdin")
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as file:
+                stdin = file.read()
+        programs.append((name, code, stdin))
+    return programs
+
+def rss():
+    '''
+    Return the resident memory of this (the server) process in bytes.
+    '''
+    with open("/proc/self/statm") as file:
+        return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+async def send(ws, cmd, content):
+    await ws.send(json.dumps({"CMD" : cmd, "CONTENT" : content}))
+
+async def receive_state(ws):
+    '''
+    Read messages until the next STATE message and return the state.
+    '''
+    while True:
+        message = json.loads(await ws.receive())
+        if message["CMD"] == "WS_CMD_STATE":
+            state = message["CONTENT"]["STATE"]
+            if state == STATE_IDLE or state == STATE_WAIT:
+                return state
+
+async def run_program(ws, program, steps, stats):
+    '''
+    Run one program to completion and record its latencies.
+    '''
+    (name, code, stdin) = program
+    sent = time.perf_counter()
+    await send(ws, "WS_CMD_START", {"CODE" : code})
+    if stdin:
+        await send(ws, "WS_CMD_STDIN", {"TEXT" : stdin})
+    state = await receive_state(ws)
+    stats.start_latency.append(time.perf_counter() - sent)
+    count = 0
+    while state == STATE_WAIT:
+        if count < steps:
+            sent = time.perf_counter()
+            await send(ws, "WS_CMD_STEP", {})
+            state = await receive_state(ws)
+            if state == STATE_WAIT:
+                stats.step_latency.append(time.perf_counter() - sent)
+            count += 1
+        else:
+            await send(ws, "WS_CMD_CONTINUE", {})
+            state = await receive_state(ws)
+
+async def simulate_client(app, index, programs, steps, deadline, stats):
+    '''
+    One browser running the programs in turn (starting at a different one
+    for each client) until the deadline.
+    '''
+    client = app.test_client()
+    async with client.websocket("/ws", query_string={"session" : f"bench{index}"}) as ws:
+        position = index
+        while time.monotonic() < deadline:
+            program = programs[position % len(programs)]
+            position += 1
+            try:
+                await asyncio.wait_for(run_program(ws, program, steps, stats), RUN_TIMEOUT)
+                stats.runs += 1
+            except asyncio.TimeoutError:
+                print(f"[bench] => ERROR: Client {index} timed out running {program[0]}")
+                stats.failed += 1
+                return
+
+async def sample_rss(stats, interval=0.5):
+    while True:
+        stats.rss.append(rss())
+        await asyncio.sleep(interval)
+
+async def main(args):
+    # The app is configured from the environment when it is imported
+    os.environ["PYTRACE_POOL_BACKEND"] = "subprocess"
+    os.environ["PYTRACE_POOL_SIZE"] = str(args.pool)
+    os.environ["PYTRACE_MAX_RUNNING"] = str(args.running)
+    os.environ["PYTRACE_MAX_QUEUED"] = str(max(args.clients, 1))
+    sys.path.insert(0, os.path.abspath(PYTRACE_DIRECTORY))
+    from app import app
+
+    programs = load_programs()
+    stats = Stats()
+    async with app.test_app() as test_app:
+        # Let the pool fill before timing anything
+        await asyncio.sleep(args.warmup)
+        sampler = asyncio.create_task(sample_rss(stats))
+        started = time.monotonic()
+        deadline = started + args.duration
+        await asyncio.gather(*[simulate_client(test_app, index, programs, args.steps, deadline, stats)
+                               for index in range(args.clients)])
+        elapsed = time.monotonic() - started
+        sampler.cancel()
+    stats.rss.append(rss())
+
+    result = stats.report(elapsed)
+    result.update({"clients" : args.clients, "duration" : elapsed, "pool" : args.pool,
+                   "running" : args.running, "steps_per_run" : args.steps})
+    for (key, value) in result.items():
+        print(f"{key:>18} : {value:.2f}" if isinstance(value, float) else f"{key:>18} : {value}")
+    if args.json is not None:
+        with open(args.json, "w") as file:
+            json.dump(result, file, indent=2)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test pytrace with simulated websocket clients")
+    parser.add_argument("--clients", type=int, default=10, help="simulated browsers")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to keep starting runs")
+    parser.add_argument("--steps", type=int, default=50, help="lines stepped in each run before continuing")
+    parser.add_argument("--pool", type=int, default=4, help="warm workers")
+    parser.add_argument("--running", type=int, default=8, help="runs allowed at once")
+    parser.add_argument("--warmup", type=float, default=2, help="seconds to let the pool fill")
+    parser.add_argument("--json", default=None, help="also write the results to this file")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,5 @@
+count = int(input("How many? "))
+total = 0
+for i in range(count):
+    total += int(input(f"Number {i + 1}: "))
+print("Total", total)
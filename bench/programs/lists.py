@@ -0,0 +1,6 @@
+values = list(range(50000))
+squares = [v * v for v in values]
+table = {v: str(v) for v in values[:5000]}
+nested = [[i] * 100 for i in range(100)]
+values.sort(reverse=True)
+print(len(squares), len(table), sum(map(len, nested)), values[0])
@@ -0,0 +1,173 @@
+'''
+Micro-benchmark of the tracer harness.  Runs each workload in a real
+harness subprocess (the same one the subprocess worker backend starts)
+once without tracing and once in each traced mode, and reports the cost
+the tracer adds to every line run:
+
+    python bench/tracer.py --repeat 5 --budget 15
+
+RECORD sends every line without stopping, which is the per-line work of
+stepping without the wait for the browser.  CONTINUE runs to a
+breakpoint that is never reached, so nothing is sent.  SUMMARY only
+counts lines and PROFILE counts and times them.  The run fails (exit
+code 1) if the RECORD cost of any workload is more than --budget
+microseconds per line.
+'''
+import os
+import sys
+import json
+import socket
+import argparse
+import tempfile
+import subprocess
+
+HARNESS_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pytrace", "sandbox")
+
+MODES = ("SUMMARY", "PROFILE", "CONTINUE", "RECORD")
+
+# Small programs like the ones students step through: a few scalars and
+# containers changing on most lines, loops and function calls, and large
+# values held (and seldom changed) across a loop
+WORKLOADS = {
+    "loop" : '''
+total = 0
+for i in range(20000):
+    total += i % 7
+''',
+    "assignment" : '''
+grades = [71, 88, 93, 65, 79, 84, 90, 58, 77, 81]
+names = ["ana", "ben", "cai", "dev", "eli", "fay", "gus", "hal", "ivy", "jo"]
+report = {}
+best = None
+for round in range(200):
+    for (name, grade) in zip(names, grades):
+        letter = "A" if grade >= 90 else "B" if grade >= 80 else "C"
+        report[name] = letter
+        if best is None or grade > best[1]:
+            best = (name, grade)
+    average = sum(grades) / len(grades)
+    message = f"round {round}: average {average:.1f}"
+''',
+    "calls" : '''
+def fib(n):
+    if n < 2:
+        return n
+    return fib(n - 1) + fib(n - 2)
+
+def square(x):
+    result = x * x
+    return result
+
+total = fib(16)
+for i in range(2000):
+    total += square(i)
+''',
+    "large" : '''
+import collections
+window = collections.deque(range(100000))
+history = list(range(100000))
+total = 0
+for i in range(5000):
+    total += i % 7
+    if i % 100 == 0:
+        window.rotate(1)
+''',
+}
+
+def run(python, code, mode):
+    '''
+    Run code in a new harness and return (its FINISHED report, messages
+    sent, bytes sent).
+    '''
+    with tempfile.TemporaryDirectory() as directory:
+        server_name = os.path.join(directory, "bench.sock")
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(server_name)
+        server.listen(1)
+        env = dict(os.environ)
+        env["SERVER_NAME"] = server_name
+        env["PYTHONPATH"] = HARNESS_DIRECTORY
+        process = subprocess.Popen([python, "-u", "-m", "harness"], env=env, stdin=subprocess.DEVNULL,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            (connection, _) = server.accept()
+            with connection:
+                # A breakpoint that is never reached runs in CONTINUE mode
+                start = {"CODE" : code, "MODE" : "STEP" if mode == "CONTINUE" else mode,
+                         "BREAKPOINTS" : [10 ** 6] if mode == "CONTINUE" else [], "LIMIT" : 10 ** 9,
+                         "STDIN" : ""}
+                connection.sendall(json.dumps(start).encode("utf-8") + b"\n")
+                # Messages are only counted (reading takes as little of the CPU
+                # from the harness as possible) until the harness exits.  The
+                # last message is FINISHED.
+                messages = 0
+                size = 0
+                last = b""
+                while True:
+                    data = connection.recv(1 << 16)
+                    if not data:
+                        break
+                    messages += data.count(b"\n")
+                    size += len(data)
+                    last = (last + data)[-(1 << 16):]
+                lines = last.splitlines()
+                if not lines or b'"FINISHED"' not in lines[-1][:32]:
+                    raise RuntimeError(f"Harness exited without finishing in {mode} mode")
+                return (json.loads(lines[-1])["CONTENT"], messages - 1, size - len(lines[-1]) - 1)
+        finally:
+            process.kill()
+            process.wait()
+            server.close()
+
+def measure(python, code, repeat):
+    '''
+    Return the results of one workload.  The fastest of repeat runs is
+    used for each mode.
+    '''
+    def fastest(mode):
+        best = None
+        for _ in range(repeat):
+            (finished, messages, size) = run(python, code, mode)
+            if finished["exception"] is not None:
+                raise RuntimeError(finished["exception"])
+            if best is None or finished["usage"]["wall_time"] < best[0]["usage"]["wall_time"]:
+                best = (finished, messages, size)
+        return best
+
+    untraced = fastest("RUN")[0]["usage"]["wall_time"]
+    result = {"untraced_ms" : untraced * 1000}
+    for mode in MODES:
+        (finished, messages, size) = fastest(mode)
+        if mode == "SUMMARY":
+            result["lines"] = finished["lines"]
+        cost = (finished["usage"]["wall_time"] - untraced) / result["lines"]
+        result[f"{mode.lower()}_us_per_line"] = cost * 1e6
+        if mode == "RECORD":
+            result["record_bytes_per_line"] = size / max(messages, 1)
+    return result
+
+def main(args):
+    results = {}
+    failed = False
+    for (name, code) in WORKLOADS.items():
+        result = measure(args.python, code, args.repeat)
+        results[name] = result
+        over = result["record_us_per_line"] > args.budget
+        failed = failed or over
+        print(f"{name:>12} : {result['lines']:>7} lines  untraced {result['untraced_ms']:8.2f} ms  "
+              + "  ".join(f"{mode.lower()} {result[mode.lower() + '_us_per_line']:6.2f} us/line" for mode in MODES)
+              + ("  OVER BUDGET" if over else ""))
+    if args.json is not None:
+        with open(args.json, "w") as file:
+            json.dump({"python" : args.python, "budget_us" : args.budget, "workloads" : results}, file, indent=2)
+    if failed:
+        print(f"RECORD cost is over the budget of {args.budget} us per line")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the per-line cost of the tracer harness")
+    parser.add_argument("--python", default=sys.executable, help="python that runs the harness")
+    parser.add_argument("--repeat", type=int, default=5, help="runs of each mode (the fastest is used)")
+    parser.add_argument("--budget", type=float, default=15, help="most RECORD microseconds per line allowed")
+    parser.add_argument("--json", default=None, help="also write the results to this file")
+    main(parser.parse_args())
@@ -1,25 +1,154 @@
+import os
+import sys
+import json
 import quart as qt
 from client import Client
+from interface import Interface
+from pool import Pool, DockerBackend, SubprocessBackend, HARNESS_PATH
+from cache import TraceCache
+from scheduler import Scheduler, SharedScheduler, Limits
+from store import SqliteStore
+from wire import Wire
+from batch import Batch
+from session import Sessions
+import metrics
 
 # Create the Quart App and also the AppManager to track clients
 app = qt.Quart(__name__)
 
 # Configure the Quart App
 app.config.update({
-    "SECRET_KEY" : "dev"
+    "SECRET_KEY" : "dev",
+    "POOL_SIZE" : int(os.environ.get("PYTRACE_POOL_SIZE", "4")),
+    "POOL_BACKEND" : os.environ.get("PYTRACE_POOL_BACKEND", "docker"),
+    "POOL_IMAGE" : os.environ.get("PYTRACE_POOL_IMAGE", "pytrace-sandbox"),
+    "POOL_PYTHON" : os.environ.get("PYTRACE_POOL_PYTHON", sys.executable),
+    "CACHE_ENTRIES" : int(os.environ.get("PYTRACE_CACHE_ENTRIES", "256")),
+    "CACHE_BYTES" : int(os.environ.get("PYTRACE_CACHE_BYTES", str(64 * 1024 * 1024))),
+    "CACHE_DIR" : os.environ.get("PYTRACE_CACHE_DIR"),
+    "MAX_RUNNING" : int(os.environ.get("PYTRACE_MAX_RUNNING", "8")),
+    "MAX_QUEUED" : int(os.environ.get("PYTRACE_MAX_QUEUED", "100")),
+    "CPU_TIME_LIMIT" : int(os.environ.get("PYTRACE_CPU_TIME_LIMIT", "10")),
+    "WALL_TIME_LIMIT" : int(os.environ.get("PYTRACE_WALL_TIME_LIMIT", "600")),
+    "MEMORY_LIMIT" : int(os.environ.get("PYTRACE_MEMORY_LIMIT", str(256 * 1024 * 1024))),
+    "STORE" : os.environ.get("PYTRACE_STORE"),
+    "BATCH_PARALLEL" : int(os.environ.get("PYTRACE_BATCH_PARALLEL", "4")),
+    "SESSION_GRACE" : int(os.environ.get("PYTRACE_SESSION_GRACE", "60")),
+    "SPANS" : os.environ.get("PYTRACE_SPANS", "0") == "1",
 });
 
+# Pool of warm workers shared by every client
+pool = None
+
+# Recorded traces shared by every client
+cache = None
+
+# Admission of runs across every client
+scheduler = None
+
+# State shared with other server processes (None when running alone)
+store = None
+
+# Clients by session token so a browser that reconnects continues its run
+sessions = None
+
+# Fill the worker pool, load the trace cache and create the scheduler
+# before accepting connections.  The subprocess backend runs code
+# without docker and is intended for testing only.  With a store the
+# queue and cache are shared by every server process (see router.py).
+@app.before_serving
+async def startup():
+    global pool
+    global cache
+    global scheduler
+    global store
+    global sessions
+    limits = Limits(app.config["CPU_TIME_LIMIT"], app.config["WALL_TIME_LIMIT"], app.config["MEMORY_LIMIT"])
+    if app.config["POOL_BACKEND"] == "subprocess":
+        backend = SubprocessBackend(limits, app.config["POOL_PYTHON"])
+    else:
+        backend = DockerBackend(app.config["POOL_IMAGE"], limits)
+    pool = Pool(backend, app.config["POOL_SIZE"])
+    await pool.start()
+    if app.config["STORE"] is not None:
+        store = SqliteStore(app.config["STORE"])
+        scheduler = SharedScheduler(store, app.config["MAX_RUNNING"], app.config["MAX_QUEUED"], limits)
+    else:
+        scheduler = Scheduler(app.config["MAX_RUNNING"], app.config["MAX_QUEUED"], limits)
+    with open(HARNESS_PATH, encoding="utf-8") as file:
+        harness = file.read()
+    cache = TraceCache(harness, app.config["CACHE_ENTRIES"], app.config["CACHE_BYTES"],
+                       app.config["CACHE_DIR"], store)
+    sessions = Sessions(app.config["SESSION_GRACE"])
+    metrics.SPANS.enabled = app.config["SPANS"]
+    metrics.DETACHED_SESSIONS.set_function(sessions.count)
+    metrics.POOL_IDLE.set_function(lambda: len(pool.idle))
+    metrics.POOL_WAITING.set_function(lambda: len(pool.waiters))
+    metrics.SCHEDULER_RUNNING.set_function(lambda: scheduler.depth()[0])
+    metrics.SCHEDULER_QUEUED.set_function(lambda: scheduler.depth()[1])
+
+@app.after_serving
+async def shutdown():
+    await pool.close()
+    if store is not None:
+        store.close()
+
 # Handle request for browser root request
 @app.route("/")
 async def index():
     return await qt.render_template("browser.html")
 
+# Metrics of this server process in the Prometheus text format
+@app.route("/metrics")
+async def metrics_route():
+    return metrics.REGISTRY.render(), 200, {"Content-Type" : "text/plain; version=0.0.4"}
+
+# Recent spans (empty unless PYTRACE_SPANS=1), optionally of one session
+@app.route("/metrics/spans")
+async def spans_route():
+    return qt.jsonify(metrics.SPANS.to_content(qt.request.args.get("session")))
+
+# Run many programs without tracing (for example to grade submissions).
+# The body is {"MODE": "RUN", "SUMMARY" or "PROFILE", "JOBS": [{"ID", "CODE", "STDIN"}]}
+# and one JSON result is streamed per line as each program finishes.
+@app.route("/batch", methods=["POST"])
+async def batch():
+    content = await qt.request.get_json(force=True, silent=True)
+    try:
+        jobs = Batch.parse(content)
+        runner = Batch(pool, scheduler, app.config["BATCH_PARALLEL"],
+                       content.get("MODE", Interface.TRACE_CMD_RUN))
+    except ValueError as e:
+        return qt.jsonify({"ERROR" : str(e)}), 400
+
+    async def results():
+        async for result in runner.run(jobs):
+            yield json.dumps(result) + "\n"
+
+    return qt.Response(results(), mimetype="application/x-ndjson")
+
 # Create the websocket which will formally create a Client 
 # object.  If the websocket closes, then this function will 
-# return.
+# return.  A websocket with the token of a session that still
+# exists continues that session instead, once it has sent the
+# secret of the session (see Client.resume).
 @app.websocket("/ws")
 async def ws():
-    client = Client(qt.websocket)
+    websocket = qt.websocket._get_current_object()
+    wire = Wire.negotiate(websocket.args)
+    token = websocket.args.get("session")
+    client = sessions.get(token)
+    if client is not None:
+        if not await client.resume(websocket, wire):
+            print(f"[{client}] => ERROR: Websocket refused without the session secret")
+            await websocket.close(code=Client.CLOSE_REFUSED)
+            return
+        await client.attach(websocket, wire)
+    else:
+        client = Client(websocket, pool, cache, scheduler, wire, token, sessions)
+        sessions.add(client)
+        if client.secret is not None:
+            await client.send_ws(Client.WS_CMD_SESSION, {"SECRET" : client.secret})
     try:
         await client.handle_ws()
     except:
@@ -0,0 +1,203 @@
+import os
+import json
+import time
+import asyncio
+import argparse
+from process import Process
+from interface import Interface
+
+class Job:
+    '''
+    One program of a batch and what happened when it ran.  The program
+    reads its STDIN from the text given instead of a terminal.
+    '''
+
+    STATUS_COMPLETED = "COMPLETED"
+    STATUS_EXCEPTION = "EXCEPTION"
+    STATUS_TERMINATED = "TERMINATED"
+
+    # Largest STDOUT kept for a job.  Anything more is dropped and marked
+    # as truncated.
+    MAX_STDOUT = 256 * 1024
+
+    def __init__(self, job_id, code, stdin=""):
+        self.job_id = job_id
+        self.code = code
+        self.stdin = stdin
+        self.stdout = []
+        self.stdout_size = 0
+        self.truncated = False
+        self.finished = None
+        self.started = None
+        self.ended = None
+
+    async def handle_process_msg(self, message):
+        '''
+        Collect STDOUT and the report sent by the process.  Nothing is sent
+        back as the program is not traced.
+        '''
+        match message["CMD"]:
+            case Interface.PROC_CMD_STDOUT:
+                self.add_stdout(message["CONTENT"]["TEXT"])
+            case Interface.PROC_CMD_FINISHED:
+                self.finished = message["CONTENT"]
+            case _:
+                pass
+
+    def add_stdout(self, text):
+        '''
+        Add STDOUT text from the process without the newlines added by the
+        PTY, up to MAX_STDOUT characters.
+        '''
+        text = text.replace("\r\n", "\n")
+        if self.stdout_size + len(text) > Job.MAX_STDOUT:
+            text = text[:Job.MAX_STDOUT - self.stdout_size]
+            self.truncated = True
+        self.stdout.append(text)
+        self.stdout_size += len(text)
+
+    def to_content(self):
+        '''
+        Return the result of the job.  A program that did not finish (it was
+        killed at a limit or never started) is TERMINATED and the reason is
+        at the end of its STDOUT.
+        '''
+        if self.finished is None:
+            status = Job.STATUS_TERMINATED
+        elif self.finished.get("exception") is not None:
+            status = Job.STATUS_EXCEPTION
+        else:
+            status = Job.STATUS_COMPLETED
+        finished = self.finished or {}
+        return {
+            "ID" : self.job_id,
+            "STATUS" : status,
+            "STDOUT" : "".join(self.stdout),
+            "TRUNCATED" : self.truncated,
+            "EXCEPTION" : finished.get("exception"),
+            "USAGE" : finished.get("usage"),
+            "LINES" : finished.get("lines"),
+            "PROFILE" : finished.get("profile"),
+            "TIME" : self.ended - self.started
+        }
+
+class Batch:
+    '''
+    Runs many programs without a browser, for example to grade submissions.
+    Programs run in the same sandboxed workers as traced programs, at most
+    parallel at once, and take their turn in the scheduler like everybody
+    else.  In RUN mode programs are not traced at all; in SUMMARY mode the
+    lines run are counted; in PROFILE mode the hits and time of each line
+    are kept.  Results are produced as each program finishes.
+    '''
+
+    MODES = (Interface.TRACE_CMD_RUN, Interface.TRACE_CMD_SUMMARY, Interface.TRACE_CMD_PROFILE)
+
+    # Most programs accepted in one batch
+    MAX_JOBS = 1000
+
+    def __init__(self, pool, scheduler=None, parallel=4, mode=Interface.TRACE_CMD_RUN):
+        if mode not in Batch.MODES:
+            raise ValueError(f"Invalid batch mode [{mode}]")
+        self.pool = pool
+        self.scheduler = scheduler
+        self.parallel = asyncio.Semaphore(parallel)
+        self.mode = mode
+
+    @staticmethod
+    def parse(content):
+        '''
+        Return the jobs of a batch request {"JOBS": [{"ID", "CODE", "STDIN"}]}.
+        Raises ValueError if the request is not valid.
+        '''
+        try:
+            jobs = [Job(str(job.get("ID", index)), str(job["CODE"]), str(job.get("STDIN", "")))
+                    for (index, job) in enumerate(content["JOBS"])]
+        except Exception as e:
+            raise ValueError(f"Invalid batch [{e}]")
+        if len(jobs) > Batch.MAX_JOBS:
+            raise ValueError(f"Batch has more than {Batch.MAX_JOBS} jobs")
+        return jobs
+
+    async def run_job(self, job):
+        async with self.parallel:
+            job.started = time.perf_counter()
+            process = Process(job.code, job.handle_process_msg, self.pool, [], self.mode,
+                              scheduler=self.scheduler, stdin=job.stdin)
+            try:
+                await process.start()
+            finally:
+                await process.stop()
+                job.ended = time.perf_counter()
+        return job
+
+    async def run(self, jobs):
+        '''
+        Run the jobs and yield the result of each as it finishes.  Jobs
+        still running are stopped if the caller stops reading.
+        '''
+        tasks = [asyncio.create_task(self.run_job(job)) for job in jobs]
+        try:
+            for task in asyncio.as_completed(tasks):
+                job = await task
+                yield job.to_content()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+def load_jobs(paths, stdin):
+    '''
+    Return a job for each program file.  A program reads the STDIN file
+    next to it (name.stdin) if there is one and otherwise the shared STDIN.
+    '''
+    jobs = []
+    for path in paths:
+        with open(path, encoding="utf-8") as file:
+            code = file.read()
+        text = stdin
+        fixture = os.path.splitext(path)[0] + ".stdin"
+        if os.path.exists(fixture):
+            with open(fixture, encoding="utf-8") as file:
+                text = file.read()
+        jobs.append(Job(path, code, text))
+    return jobs
+
+async def main(args):
+    '''
+    Run the programs with a pool of this process and print one JSON result
+    per line as each finishes.
+    '''
+    from pool import Pool, DockerBackend, SubprocessBackend
+    from scheduler import Scheduler, Limits
+    stdin = ""
+    if args.stdin is not None:
+        with open(args.stdin, encoding="utf-8") as file:
+            stdin = file.read()
+    jobs = load_jobs(args.programs, stdin)
+    limits = Limits(args.cpu_time, args.wall_time, args.memory)
+    if args.backend == "subprocess":
+        backend = SubprocessBackend(limits)
+    else:
+        backend = DockerBackend(args.image, limits)
+    pool = Pool(backend, args.parallel)
+    await pool.start()
+    try:
+        batch = Batch(pool, Scheduler(args.parallel, len(jobs), limits), args.parallel, args.mode)
+        async for result in batch.run(jobs):
+            print(json.dumps(result), flush=True)
+    finally:
+        await pool.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run many programs without tracing and print their results")
+    parser.add_argument("programs", nargs="+", help="python files to run")
+    parser.add_argument("--stdin", default=None, help="STDIN for programs without a name.stdin file")
+    parser.add_argument("--mode", default=Interface.TRACE_CMD_RUN, choices=Batch.MODES)
+    parser.add_argument("--parallel", type=int, default=4, help="programs run at once")
+    parser.add_argument("--backend", default="docker", choices=["docker", "subprocess"])
+    parser.add_argument("--image", default="pytrace-sandbox")
+    parser.add_argument("--cpu-time", type=int, default=10, help="CPU seconds per program")
+    parser.add_argument("--wall-time", type=int, default=60, help="seconds per program")
+    parser.add_argument("--memory", type=int, default=256 * 1024 * 1024, help="bytes per program")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,157 @@
+import os
+import json
+import asyncio
+import hashlib
+import collections
+
+class TraceCache:
+    '''
+    Recorded traces of finished programs keyed by a hash of the code and
+    the STDIN it was given.  Only deterministic runs are stored, so a hit
+    can be sent to the browser without running the program again.  The
+    least recently used traces are evicted once there are more than
+    max_entries traces or more than max_bytes of them.  If a directory is
+    given then traces are also kept on disk and loaded again on startup.
+    If a store is given then traces are shared with the other server
+    processes using it and the memory cache only holds recently used ones.
+    The store may block so it is only used from a thread.
+    '''
+
+    def __init__(self, version, max_entries=256, max_bytes=64 * 1024 * 1024, directory=None, store=None):
+        self.version = hashlib.sha256(version.encode("utf-8")).hexdigest()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.store = store
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        if self.directory is not None:
+            self.load()
+
+    #########################################################################################
+    # Functions related to finding and storing traces                                       #
+    #########################################################################################
+
+    def key(self, code, stdin=""):
+        '''
+        Return the key for code run with the STDIN transcript.  The version
+        (the harness code) is included so traces recorded by an older harness
+        are never used.
+        '''
+        digest = hashlib.sha256()
+        for part in (self.version, code, stdin):
+            data = part.encode("utf-8")
+            digest.update(len(data).to_bytes(8, "big"))
+            digest.update(data)
+        return digest.hexdigest()
+
+    async def get(self, key):
+        '''
+        Return the trace stored for key or None.  A hit becomes the most
+        recently used trace.
+        '''
+        entry = self.entries.get(key)
+        if entry is None and self.store is not None:
+            entry = await self.load_shared(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return json.loads(entry)
+
+    async def put(self, key, content):
+        '''
+        Store the trace for key and evict older traces if the cache is full.
+        A trace larger than the whole cache is not stored.
+        '''
+        entry = json.dumps(content)
+        if len(entry) > self.max_bytes:
+            return
+        self.add(key, entry)
+        if self.directory is not None:
+            self.write(key, entry)
+        if self.store is not None:
+            try:
+                await asyncio.to_thread(self.store.put_trace, key, entry, self.max_entries, self.max_bytes)
+            except Exception as e:
+                print(f"[{self}] => ERROR: Unable to share trace [{e}]")
+        self.evict()
+
+    def add(self, key, entry):
+        '''
+        Add the encoded trace to the in memory cache.
+        '''
+        previous = self.entries.pop(key, None)
+        if previous is not None:
+            self.size -= len(previous)
+        self.entries[key] = entry
+        self.size += len(entry)
+
+    def evict(self):
+        '''
+        Remove least recently used traces until the cache is within its limits.
+        '''
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            key, entry = self.entries.popitem(last=False)
+            self.size -= len(entry)
+            if self.directory is not None:
+                try:
+                    os.remove(self.path(key))
+                except:
+                    pass
+
+    async def load_shared(self, key):
+        '''
+        Find the trace for key in the shared store and keep it in memory.
+        '''
+        try:
+            entry = await asyncio.to_thread(self.store.get_trace, key)
+        except Exception as e:
+            print(f"[{self}] => ERROR: Unable to read shared trace [{e}]")
+            return None
+        if entry is not None:
+            self.add(key, entry)
+            self.evict()
+        return entry
+
+    #########################################################################################
+    # Functions related to keeping traces on disk                                           #
+    #########################################################################################
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def write(self, key, entry):
+        '''
+        Write the encoded trace to disk.  It is written to a temporary file
+        first so a partly written trace is never loaded.
+        '''
+        temp = self.path(key) + ".tmp"
+        try:
+            with open(temp, "w", encoding="utf-8") as file:
+                file.write(entry)
+            os.replace(temp, self.path(key))
+        except Exception as e:
+            print(f"[{self}] => ERROR: Unable to write trace to disk [{e}]")
+
+    def load(self):
+        '''
+        Load the traces kept on disk, oldest first so the most recently stored
+        traces are the last to be evicted.
+        '''
+        os.makedirs(self.directory, exist_ok=True)
+        names = [name for name in os.listdir(self.directory) if name.endswith(".json")]
+        paths = sorted((os.path.join(self.directory, name) for name in names), key=os.path.getmtime)
+        for path in paths:
+            try:
+                with open(path, encoding="utf-8") as file:
+                    entry = file.read()
+                json.loads(entry)
+            except Exception as e:
+                print(f"[{self}] => ERROR: Unable to load trace from disk [{e}]")
+                continue
+            self.add(os.path.basename(path)[:-len(".json")], entry)
+        self.evict()
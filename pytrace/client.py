@@ -1,7 +1,12 @@
-import json
+import time
 import asyncio
+import secrets
+import metrics
 from process import Process
 from interface import Interface
+from recording import Recording
+from wire import Wire
+from outbox import Outbox
 
 class Client:
 
@@ -9,6 +14,8 @@ class Client:
     STATE_IDLE = 0
     STATE_RUNNING = 1
     STATE_WAIT = 2
+    STATE_QUEUED = 3
+    STATE_INPUT = 4
 
     WS_CMD_STDIN = "WS_CMD_STDIN"
     WS_CMD_STDOUT = "WS_CMD_STDOUT"
@@ -18,12 +25,62 @@ class Client:
     WS_CMD_STOP = "WS_CMD_STOP"
     WS_CMD_STATE = "WS_CMD_STATE"
     WS_CMD_DATA = "WS_CMD_DATA"
+    WS_CMD_CONTINUE = "WS_CMD_CONTINUE"
+    WS_CMD_STEP_OVER = "WS_CMD_STEP_OVER"
+    WS_CMD_STEP_OUT = "WS_CMD_STEP_OUT"
+    WS_CMD_BREAKPOINTS = "WS_CMD_BREAKPOINTS"
+    WS_CMD_EXPAND = "WS_CMD_EXPAND"
+    WS_CMD_TRACE = "WS_CMD_TRACE"
+    WS_CMD_QUEUE = "WS_CMD_QUEUE"
+    WS_CMD_RESYNC = "WS_CMD_RESYNC"
+    WS_CMD_PROFILE = "WS_CMD_PROFILE"
+    WS_CMD_SESSION = "WS_CMD_SESSION"
+    WS_CMD_RESUME = "WS_CMD_RESUME"
+
+    START_MODE_STEP = "STEP"
+    START_MODE_RECORD = "RECORD"
+    START_MODE_PROFILE = "PROFILE"
+
+    # Most STDOUT kept while detached.  Only the newest output is kept.
+    DETACHED_STDOUT = 256 * 1024
+
+    # Seconds a websocket continuing a session has to send RESUME
+    RESUME_TIMEOUT = 5
+
+    # Websocket close codes telling the browser not to simply reconnect: the
+    # session was continued on another websocket, or a websocket tried to
+    # continue a session without its secret
+    CLOSE_MOVED = 4001
+    CLOSE_REFUSED = 4403
     
-    def __init__(self, ws):
+    def __init__(self, ws, pool, cache=None, scheduler=None, wire=None, session=None, sessions=None):
         self.ws = ws
+        self.pool = pool
+        self.cache = cache
+        self.scheduler = scheduler
+        self.wire = wire if wire is not None else Wire()
         self.state = Client.STATE_IDLE
         self.process = None
         self.process_task = None
+        self.recording = None
+        self.session = session
+        self.sessions = sessions
+        self.secret = secrets.token_hex(16) if session is not None else None
+        self.span = None
+        self.outbox = Outbox(self.write_ws, self.handle_outbox_overflow)
+
+        # What the browser needs to continue after attaching again: the
+        # functions being run, where the program is and anything it missed
+        # while detached
+        self.stack = []
+        self.frame = None
+        self.line = None
+        self.position = None
+        self.detached = False
+        self.detached_stdout = ""
+        self.detached_trace = None
+        self.detached_profile = None
+        self.expand_pending = False
 
     #########################################################################################
     # Functions related to managing the WebSocket object                                    #
@@ -33,28 +90,62 @@ class Client:
         '''
         Disconnect the websocket.  This will cause this client object
         to become unusable.  Intended for use when the client is 
-        either closed or forced closed.
+        either closed or forced closed.  A detached client has no
+        websocket but its process is still stopped.
         '''
-        if self.ws is not None:
+        if self.ws is not None or self.detached:
             try:
                 await self.reset_client()
-                await self.ws.close(code=1001)
+                await self.outbox.stop()
+                if self.ws is not None:
+                    await self.ws.close(code=1001)
             except:
                 pass
             finally:
                 self.ws = None
+        self.detached = False
         self.state = Client.STATE_DEAD
         print(f"[{self}] => Disconnected")
 
     async def send_ws(self, cmd, content):
         '''
-        Send a message via the websocket.
+        Queue a message to be sent via the websocket.  This does not wait
+        for the message to be sent (see Outbox).  While detached only what
+        the browser needs to continue is kept.
         '''
-        message = {"CMD" : cmd, "CONTENT" : content}
+        if self.detached:
+            self.keep_detached(cmd, content)
+            return
         if self.ws is None:
+            message = {"CMD" : cmd, "CONTENT" : content}
             print(f"[{self}] => ERROR: Websocket is unexpectedly closed when sending [{message}]")
             return
-        await self.ws.send(json.dumps(message))
+        self.outbox.put(cmd, content)
+
+    async def write_ws(self, cmd, content):
+        '''
+        Send a message via the websocket.  Only called by the outbox sender.
+        '''
+        if self.ws is None:
+            return
+        started = time.perf_counter()
+        await self.ws.send(self.wire.encode(cmd, content))
+        metrics.WS_SEND_SECONDS.observe(time.perf_counter() - started)
+        metrics.WS_SENT_MESSAGES.inc()
+
+    async def handle_outbox_overflow(self):
+        '''
+        The browser has fallen too far behind to catch up.  Stop the process
+        so it does not hold a worker and close the websocket.  The browser
+        may connect again.
+        '''
+        print(f"[{self}] => ERROR: Websocket is too slow, closing")
+        self.recording = None
+        await self.reset_client()
+        try:
+            await self.ws.close(code=1013)
+        except:
+            pass
 
     async def send_ws_terminal(self, text):
         '''
@@ -87,14 +178,128 @@ class Client:
             finally:
                 self.process = None
         
-        if self.process_task is not None:
+        # The process task itself resets the client when the process completes
+        if self.process_task is not None and self.process_task is not asyncio.current_task():
             try:
                 self.process_task.cancel()
                 await self.process_task
             except:
                 pass
-            finally:
-                self.process_task = None      
+        self.process_task = None      
+
+    #########################################################################################
+    # Functions related to detaching and attaching the websocket of a session               #
+    #########################################################################################
+
+    async def detach(self):
+        '''
+        Keep the process running without a websocket for the grace period of
+        the session.  Messages not yet sent are dropped as the browser is
+        brought up to date when it attaches again.
+        '''
+        print(f"[{self}] => Detached")
+        self.detached = True
+        self.detached_stdout = ""
+        self.detached_trace = None
+        self.detached_profile = None
+        await self.outbox.stop()
+        self.ws = None
+        self.sessions.detached(self)
+
+    async def resume(self, ws, wire):
+        '''
+        Return True if a new websocket may continue the session.  Its first
+        message must be RESUME with the secret the session was given when it
+        started, so knowing the session token alone is not enough.
+        '''
+        try:
+            frame = await asyncio.wait_for(ws.receive(), Client.RESUME_TIMEOUT)
+            message = wire.decode(frame)
+            secret = message["CONTENT"]["SECRET"]
+            if message["CMD"] == Client.WS_CMD_RESUME and isinstance(secret, str):
+                return secrets.compare_digest(secret, self.secret)
+        except:
+            pass
+        return False
+
+    async def attach(self, ws, wire):
+        '''
+        Continue the session on a new websocket that has sent RESUME.  If the
+        session is still attached to an old websocket (the browser reconnected
+        before the old one was seen to close, or the session was continued in
+        another window) then the old one is closed with CLOSE_MOVED so that
+        its browser does not take the session back.  The browser is
+        sent RESYNC with the state, the functions being run, the line and the
+        STDOUT it missed.  If the program is stopped then the variables of
+        the frame are sent again, otherwise they are sent at the next stop.
+        '''
+        if self.ws is not None:
+            old = self.ws
+            await self.outbox.stop()
+            try:
+                await old.close(code=Client.CLOSE_MOVED)
+            except:
+                pass
+        self.sessions.attached(self)
+        self.ws = ws
+        self.wire = wire
+        self.detached = False
+        self.outbox = Outbox(self.write_ws, self.handle_outbox_overflow)
+        print(f"[{self}] => Attached")
+
+        content = {"STATE" : self.state, "STACK" : self.stack, "FRAME" : self.frame, "LINE" : self.line,
+                   "STDOUT" : self.detached_stdout}
+        if self.state == Client.STATE_QUEUED:
+            content["POSITION"] = self.position
+        await self.send_ws(Client.WS_CMD_RESYNC, content)
+        if self.detached_trace is not None:
+            await self.send_ws(Client.WS_CMD_TRACE, self.detached_trace)
+        if self.detached_profile is not None:
+            await self.send_ws(Client.WS_CMD_PROFILE, self.detached_profile)
+        self.detached_stdout = ""
+        self.detached_trace = None
+        self.detached_profile = None
+        if self.state == Client.STATE_WAIT and self.frame is not None and self.process is not None:
+            await self.process.expand(self.frame, [], 0)
+        else:
+            self.expand_pending = self.process is not None
+
+    def keep_detached(self, cmd, content):
+        '''
+        Keep what the browser will need from a message sent while detached.
+        State and DATA are kept by the client itself.
+        '''
+        if cmd == Client.WS_CMD_STDOUT:
+            text = self.detached_stdout + content["TEXT"]
+            if len(text) > Client.DETACHED_STDOUT:
+                text = "--- OUTPUT TRUNCATED ---\n" + text[-Client.DETACHED_STDOUT:]
+            self.detached_stdout = text
+        elif cmd == Client.WS_CMD_TRACE:
+            self.detached_trace = content
+        elif cmd == Client.WS_CMD_PROFILE:
+            self.detached_profile = content
+
+    def track_data(self, content):
+        '''
+        Follow the functions being run and where the program is from DATA.
+        '''
+        changes = content.get("stack")
+        if changes is not None:
+            self.stack = self.stack[:len(self.stack) - changes["pop"]] + changes["push"]
+        self.frame = content.get("frame")
+        self.line = content.get("line")
+
+    def begin_span(self, name):
+        '''
+        Start timing a command until the process stops or completes (only
+        when spans are enabled).
+        '''
+        metrics.SPANS.end(self.span)
+        self.span = metrics.SPANS.begin(self.session, name)
+
+    def end_span(self):
+        metrics.SPANS.end(self.span)
+        self.span = None
 
     #########################################################################################
     # Functions related to handling messages from the WebScoket object                      #
@@ -107,25 +312,38 @@ class Client:
         if self.ws is None (which should not happen).
         '''
         print(f"[{self}] => Connected")
+        metrics.CLIENTS.inc()
+        ws = self.ws
+        self.outbox.start()
         try:
             while True:
-                message = await self.ws.receive()
+                message = await ws.receive()
                 await self.handle_ws_msg(message)
         except:
             pass
         finally:
-            await self.disconnect()
+            metrics.CLIENTS.dec()
+            if self.ws is not ws:
+                # Another websocket has taken over the session
+                pass
+            elif self.sessions is not None and self.session is not None and self.process is not None:
+                await self.detach()
+            else:
+                if self.sessions is not None:
+                    self.sessions.remove(self)
+                await self.disconnect()
 
-    async def handle_ws_msg(self, json_message):
+    async def handle_ws_msg(self, frame):
         '''
-        Process the websocket messages: STDIN, START, STEP, STOP
+        Process the websocket messages: STDIN, START, STEP, CONTINUE, STEP_OVER,
+        STEP_OUT, BREAKPOINTS, EXPAND, STOP
         '''
         try:
-            message = json.loads(json_message)
+            message = self.wire.decode(frame)
             cmd = message["CMD"]
             content = message["CONTENT"]
         except:
-            print(f"[{self}] => ERROR: Message not proper JSON format [{message}]")
+            print(f"[{self}] => ERROR: Message not proper format [{frame}]")
             return
         
         match cmd:
@@ -134,35 +352,63 @@ class Client:
             case Client.WS_CMD_START:
                 await self.handle_ws_start(content)
             case Client.WS_CMD_STEP:
-                await self.handle_ws_step(content)
+                await self.handle_ws_step(content, Interface.TRACE_CMD_STEP)
+            case Client.WS_CMD_CONTINUE:
+                await self.handle_ws_step(content, Interface.TRACE_CMD_CONTINUE)
+            case Client.WS_CMD_STEP_OVER:
+                await self.handle_ws_step(content, Interface.TRACE_CMD_STEP_OVER)
+            case Client.WS_CMD_STEP_OUT:
+                await self.handle_ws_step(content, Interface.TRACE_CMD_STEP_OUT)
+            case Client.WS_CMD_BREAKPOINTS:
+                await self.handle_ws_breakpoints(content)
+            case Client.WS_CMD_EXPAND:
+                await self.handle_ws_expand(content)
             case Client.WS_CMD_STOP:
                 await self.handle_ws_stop(content)
+            case Client.WS_CMD_RESUME:
+                # The session to continue had already ended and this is a new one
+                pass
             case _:
                 print(f"[{self}] => ERROR: Invalid message type from websocket [{cmd}]")
 
 
     async def handle_ws_stdin(self, content):
         '''
-        Instruct process to receive STDIN text from the client.  No change
-        to the state.
+        Instruct process to receive a line of STDIN from the client (or the
+        rest of the input when EOF is set).  Change from the INPUT state
+        back to RUNNING as the program has what it was waiting for.
         '''
         try:
-            text = content["TEXT"]
+            text = str(content["TEXT"])
+            eof = bool(content.get("EOF", False))
         except:
             print(f"[{self}] => ERROR: Invalid STDIN CONTENT [{content}]")
             return
         if self.process is None or self.process_task is None:
             print(f"[{self}] => ERROR: Process does not exist to forward STDIN")
             return
-        await self.process.forward(text)
+        if self.recording is not None:
+            self.recording.add_stdin(text)
+        await self.process.forward(text, eof)
+        if self.state == Client.STATE_INPUT:
+            await self.set_state(Client.STATE_RUNNING)
 
     async def handle_ws_start(self, content):
         '''
         Create a new Process object with the code and create a asyncio task to run
-        the process.  Change to RUNNING state.
+        the process.  Change to RUNNING state.  In RECORD mode the process runs
+        without stopping and the recorded trace is sent when it completes.  If
+        the same code has already been recorded then the cached trace is sent
+        instead and no process is started.  In PROFILE mode the process runs
+        without stopping or capturing variables and the hits and time of each
+        line are sent while it runs and when it finishes.
         '''
         try:
             code = content["CODE"]
+            breakpoints = [int(line) for line in content.get("BREAKPOINTS", [])]
+            mode = content.get("MODE", Client.START_MODE_STEP)
+            if mode not in (Client.START_MODE_STEP, Client.START_MODE_RECORD, Client.START_MODE_PROFILE):
+                raise ValueError(mode)
         except:
             print(f"[{self}] => ERROR: Invalid START CONTENT [{content}]")
             return
@@ -171,27 +417,103 @@ class Client:
             print(f"[{self}] => ERROR: Unexpected process exists when attempting to START")
             return
         await self.send_ws_terminal("\n--- PROGRAM STARTED ---\n")
-        self.process = Process(code, self.handle_process_msg)
+        self.begin_span("start")
+        self.stack = []
+        self.frame = None
+        self.line = None
+        self.expand_pending = False
+        if mode == Client.START_MODE_RECORD:
+            key = None
+            if self.cache is not None:
+                key = self.cache.key(code)
+                trace = await self.cache.get(key)
+                if trace is not None:
+                    await self.send_cached_trace(trace)
+                    return
+            self.recording = Recording(key)
+            self.process = Process(code, self.handle_process_msg, self.pool, [], 
+                                   Interface.TRACE_CMD_RECORD, Recording.MAX_STEPS, self.scheduler)
+        elif mode == Client.START_MODE_PROFILE:
+            self.recording = None
+            self.process = Process(code, self.handle_process_msg, self.pool, [],
+                                   Interface.TRACE_CMD_PROFILE, scheduler=self.scheduler)
+        else:
+            self.recording = None
+            self.process = Process(code, self.handle_process_msg, self.pool, breakpoints,
+                                   scheduler=self.scheduler)
         self.process_task = asyncio.create_task(self.process.start())  
         await self.set_state(Client.STATE_RUNNING)      
 
-    async def handle_ws_step(self, content):
+    async def send_cached_trace(self, trace):
         '''
-        Instruct process to step to the next line of code. Change state to 
-        RUNNING state.
+        Send a cached trace as if the program had just been recorded.  The
+        state stays IDLE.
+        '''
+        if len(trace["STDOUT"]) > 0:
+            await self.send_ws_terminal(trace["STDOUT"])
+        await self.send_ws_terminal("\n--- PROGRAM COMPLETED ---\n")
+        # IDLE clears the highlights of the run so it goes before the trace
+        await self.set_state(Client.STATE_IDLE)
+        await self.send_ws(Client.WS_CMD_TRACE, trace)
+        self.end_span()
+
+    async def handle_ws_step(self, content, command):
+        '''
+        Instruct process to step to the next line of code (STEP), run to the next
+        breakpoint (CONTINUE), step over calls (STEP_OVER), or run until the current
+        function returns (STEP_OUT).  Only valid while the process is waiting.
+        Change state to RUNNING state.
         '''
         if self.process is None or self.process_task is None:
-            print("[{self}] => ERROR: Process does not exist to forward STEP")
+            print(f"[{self}] => ERROR: Process does not exist to forward {command}")
+            return
+        if self.state != Client.STATE_WAIT:
+            # The program is not at a line: running, queued or waiting for STDIN
+            print(f"[{self}] => ERROR: Process is not waiting to {command}")
             return
+        self.begin_span(command.lower())
         await self.set_state(Client.STATE_RUNNING)
-        await self.process.proceed()
+        await self.process.proceed(command)
+
+    async def handle_ws_breakpoints(self, content):
+        '''
+        Replace the breakpoints of the running process.  No change to the state.
+        '''
+        try:
+            breakpoints = [int(line) for line in content["LINES"]]
+        except:
+            print(f"[{self}] => ERROR: Invalid BREAKPOINTS CONTENT [{content}]")
+            return
+        if self.process is None or self.process_task is None:
+            # Breakpoints are sent with START when no process is running
+            return
+        await self.process.set_breakpoints(breakpoints)
+
+    async def handle_ws_expand(self, content):
+        '''
+        Request more of a truncated variable from the process.  Only valid
+        while the process is waiting.  No change to the state.
+        '''
+        try:
+            frame = int(content["FRAME"])
+            path = list(content["PATH"])
+            offset = int(content["OFFSET"])
+        except:
+            print(f"[{self}] => ERROR: Invalid EXPAND CONTENT [{content}]")
+            return
+        if self.process is None or self.state != Client.STATE_WAIT:
+            print(f"[{self}] => ERROR: Process is not waiting to EXPAND")
+            return
+        await self.process.expand(frame, path, offset)
         
     async def handle_ws_stop(self, content):
         '''
         Stop process early and reset the client.  Change state to IDLE.
         '''
+        self.recording = None
         await self.reset_client()
         await self.set_state(Client.STATE_IDLE)
+        self.end_span()
         await self.send_ws_terminal("\n--- PROGRAM STOPPED ---\n")
 
 
@@ -216,6 +538,18 @@ class Client:
                 await self.handle_process_stdout(content)
             case Interface.PROC_CMD_COMPLETED:
                 await self.handle_process_completed(content)
+            case Interface.PROC_CMD_EXPAND:
+                await self.handle_process_expand(content)
+            case Interface.PROC_CMD_FINISHED:
+                await self.handle_process_finished(content)
+            case Interface.PROC_CMD_QUEUE:
+                await self.handle_process_queue(content)
+            case Interface.PROC_CMD_INPUT:
+                await self.handle_process_input(content)
+            case Interface.PROC_CMD_PROFILE:
+                await self.handle_process_profile(content)
+            case Interface.PROC_CMD_REFUSED:
+                await self.handle_process_refused(content)
             case _:
                 print(f"[{self}] => ERROR: Invalid message type from process [{cmd}]")
 
@@ -224,16 +558,27 @@ class Client:
         Handle request from process to move to transmit DATA to the Client
         and move to the WAIT state.
         '''
+        self.track_data(content)
         await self.send_ws(Client.WS_CMD_DATA, content)
         await self.set_state(Client.STATE_WAIT)
+        self.end_span()
+        if self.expand_pending and not self.detached:
+            # The browser missed changes while detached so send every variable
+            self.expand_pending = False
+            await self.process.expand(self.frame, [], 0)
 
     async def handle_process_data_no_wait(self, content):
         '''
         Handle request from process to move to transmit DATA to the Client
-        but do not move to the WAIT state.
+        but do not move to the WAIT state.  The process does not wait for a
+        reply so nothing is sent back.  When recording, the DATA is kept for the
+        trace instead.
         '''
+        if self.recording is not None:
+            self.recording.add_step(content)
+            return
+        self.track_data(content)
         await self.send_ws(Client.WS_CMD_DATA, content)
-        await self.process.proceed()
         
     async def handle_process_stdout(self, content):
         '''
@@ -244,17 +589,84 @@ class Client:
         except:
             print(f"[{self}] => ERROR: Invalid STDOUT CONTENT [{content}]")
             return
+        if self.recording is not None:
+            self.recording.add_stdout(text)
         content = {"TEXT" : text}
         await self.send_ws(Client.WS_CMD_STDOUT, content)
   
+    async def handle_process_expand(self, content):
+        '''
+        Handle the reply from the process with more of a truncated variable.
+        '''
+        await self.send_ws(Client.WS_CMD_EXPAND, content)
+
+    async def handle_process_queue(self, content):
+        '''
+        Handle the position of the process while it waits to be admitted.  Move
+        to the QUEUED state while waiting and back to RUNNING once admitted.
+        '''
+        position = content["POSITION"]
+        self.position = position
+        if position == 0:
+            await self.set_state(Client.STATE_RUNNING)
+            return
+        await self.send_ws(Client.WS_CMD_QUEUE, {"POSITION" : position})
+        if self.state != Client.STATE_QUEUED:
+            await self.set_state(Client.STATE_QUEUED)
+
+    async def handle_process_input(self, content):
+        '''
+        Handle the process waiting for STDIN that has not been typed yet.
+        Move to the INPUT state until a line is sent.
+        '''
+        await self.set_state(Client.STATE_INPUT)
+        self.end_span()
+
+    async def handle_process_profile(self, content):
+        '''
+        Handle the hits and time of each line sent while profiling.
+        '''
+        await self.send_ws(Client.WS_CMD_PROFILE, content)
+
+    async def handle_process_finished(self, content):
+        '''
+        Handle the report sent by the process after the program has run.
+        When profiling, the report has the final hits and time of each line.
+        '''
+        if self.recording is not None:
+            self.recording.finish(content)
+        if content.get("profile") is not None:
+            await self.send_ws(Client.WS_CMD_PROFILE, content["profile"])
+
+    async def handle_process_refused(self, content):
+        '''
+        Handle the process not being started.  The reason has already been
+        written to the terminal, so the run just ends without completing.
+        '''
+        self.recording = None
+        await self.reset_client()
+        await self.set_state(Client.STATE_IDLE)
+        self.end_span()
+
     async def handle_process_completed(self, content):
         '''
         Handle request from the process indicating that the process is completed
         '''
-        if self.state == Client.STATE_RUNNING:
+        if self.state in (Client.STATE_RUNNING, Client.STATE_INPUT):
             await self.send_ws_terminal("\n--- PROGRAM COMPLETED ---\n")
+        trace = None
+        if self.recording is not None:
+            # The recording is kept so it can be sent again without running
+            trace = self.recording.to_content()
+            if self.cache is not None and self.recording.key is not None and self.recording.deterministic():
+                await self.cache.put(self.recording.key, trace)
         await self.reset_client()
+        # IDLE clears the highlights of the run so it goes before the trace,
+        # whose replay then shows its first step
         await self.set_state(Client.STATE_IDLE)
+        if trace is not None:
+            await self.send_ws(Client.WS_CMD_TRACE, trace)
+        self.end_span()
         
 
 
@@ -2,4 +2,25 @@ class Interface:
     PROC_CMD_DATA = "PROC_CMD_DATA"
     PROC_CMD_DATA_NO_WAIT = "PROC_CMD_DATA_NO_WAIT"
     PROC_CMD_STDOUT = "PROC_CMD_STDOUT"
-    PROC_CMD_COMPLETED = "PROC_CMD_COMPLETED"
\ No newline at end of file
+    PROC_CMD_COMPLETED = "PROC_CMD_COMPLETED"
+    PROC_CMD_EXPAND = "PROC_CMD_EXPAND"
+    PROC_CMD_FINISHED = "PROC_CMD_FINISHED"
+    PROC_CMD_QUEUE = "PROC_CMD_QUEUE"
+    PROC_CMD_INPUT = "PROC_CMD_INPUT"
+    PROC_CMD_PROFILE = "PROC_CMD_PROFILE"
+    PROC_CMD_REFUSED = "PROC_CMD_REFUSED"
+
+    TRACE_CMD_STEP = "STEP"
+    TRACE_CMD_CONTINUE = "CONTINUE"
+    TRACE_CMD_STEP_OVER = "STEP_OVER"
+    TRACE_CMD_STEP_OUT = "STEP_OUT"
+    TRACE_CMD_RECORD = "RECORD"
+    TRACE_CMD_RUN = "RUN"
+    TRACE_CMD_SUMMARY = "SUMMARY"
+    TRACE_CMD_PROFILE = "PROFILE"
+    TRACE_CMD_BREAKPOINTS = "BREAKPOINTS"
+    TRACE_CMD_EXPAND = "EXPAND"
+    TRACE_CMD_DATA = "DATA"
+    TRACE_CMD_FINISHED = "FINISHED"
+    TRACE_CMD_STDIN = "STDIN"
+    TRACE_CMD_INPUT = "INPUT"
\ No newline at end of file
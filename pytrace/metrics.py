@@ -0,0 +1,223 @@
+import time
+import bisect
+import collections
+
+class Counter:
+    '''
+    A count that only goes up (messages, bytes).
+    '''
+
+    TYPE = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        return [(self.name, self.value)]
+
+class Gauge:
+    '''
+    A value that goes up and down.  If a function is given then it is
+    called for the value each time the metrics are read, which suits
+    values the server already keeps (such as the length of a queue).
+    '''
+
+    TYPE = "gauge"
+
+    def __init__(self, name, help, function=None):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.function = function
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set_function(self, function):
+        self.function = function
+
+    def samples(self):
+        value = self.value
+        if self.function is not None:
+            try:
+                value = self.function()
+            except:
+                value = 0
+        return [(self.name, value)]
+
+class Histogram:
+    '''
+    Counts of observed values (durations, sizes) in fixed buckets, plus
+    their sum and count.  Observing is a bisect and two additions so it
+    can be used on hot paths.
+    '''
+
+    TYPE = "histogram"
+
+    # Seconds, from a fraction of a millisecond to a slow container start
+    TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    # Bytes, from a small message to a large trace
+    SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+    def __init__(self, name, help, buckets=TIME_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        samples = []
+        total = 0
+        for (bound, count) in zip(self.buckets, self.counts):
+            total += count
+            samples.append((f'{self.name}_bucket{{le="{bound}"}}', total))
+        samples.append((f'{self.name}_bucket{{le="+Inf"}}', self.count))
+        samples.append((f"{self.name}_sum", self.sum))
+        samples.append((f"{self.name}_count", self.count))
+        return samples
+
+class Registry:
+    '''
+    The metrics of this server process, read in the Prometheus text format
+    from the /metrics route.
+    '''
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help):
+        return self.add(Counter(name, help))
+
+    def gauge(self, name, help, function=None):
+        return self.add(Gauge(name, help, function))
+
+    def histogram(self, name, help, buckets=Histogram.TIME_BUCKETS):
+        return self.add(Histogram(name, help, buckets))
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        '''
+        Return every metric in the Prometheus text exposition format.
+        '''
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.TYPE}")
+            for (name, value) in metric.samples():
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+class Span:
+    '''
+    One timed operation of a session (for example a STEP until the next
+    DATA).
+    '''
+
+    def __init__(self, session, name):
+        self.session = session
+        self.name = name
+        self.start = time.time()
+        self.started = time.perf_counter()
+        self.duration = None
+
+class Spans:
+    '''
+    Recently finished spans of every session, kept only when enabled
+    (PYTRACE_SPANS=1) and read from the /metrics/spans route.  At most
+    max_spans are kept, oldest dropped first.
+    '''
+
+    def __init__(self, max_spans=10000):
+        self.enabled = False
+        self.spans = collections.deque(maxlen=max_spans)
+
+    def begin(self, session, name):
+        '''
+        Return a new span, or None when spans are not enabled.
+        '''
+        if not self.enabled:
+            return None
+        return Span(session, name)
+
+    def end(self, span):
+        '''
+        Finish a span returned by begin.  None (disabled or already ended)
+        is ignored.
+        '''
+        if span is None or span.duration is not None:
+            return
+        span.duration = time.perf_counter() - span.started
+        self.spans.append(span)
+
+    def to_content(self, session=None):
+        return [{"session" : span.session, "name" : span.name, "start" : span.start,
+                 "duration" : span.duration}
+                for span in self.spans if session is None or span.session == session]
+
+#########################################################################################
+# Metrics of the server                                                                 #
+#########################################################################################
+
+REGISTRY = Registry()
+SPANS = Spans()
+
+WORKER_SPAWN_SECONDS = REGISTRY.histogram(
+    "pytrace_worker_spawn_seconds", "Time to start a worker until its harness connects")
+PROCESS_START_SECONDS = REGISTRY.histogram(
+    "pytrace_process_start_seconds", "Time from a process being admitted until its code is sent to a worker")
+WORKER_ACQUIRE_SECONDS = REGISTRY.histogram(
+    "pytrace_worker_acquire_seconds", "Time a process waits for a warm worker")
+TRACE_MESSAGES = REGISTRY.counter(
+    "pytrace_trace_messages_total", "Messages received from tracer harnesses")
+TRACE_MESSAGE_BYTES = REGISTRY.histogram(
+    "pytrace_trace_message_bytes", "Size of messages received from tracer harnesses", Histogram.SIZE_BUCKETS)
+WS_SEND_SECONDS = REGISTRY.histogram(
+    "pytrace_ws_send_seconds", "Time to encode and send one websocket message")
+WS_SENT_MESSAGES = REGISTRY.counter(
+    "pytrace_ws_sent_messages_total", "Websocket messages sent to browsers")
+WS_QUEUED_MESSAGES = REGISTRY.gauge(
+    "pytrace_ws_queued_messages", "Websocket messages waiting in client outboxes")
+WS_COALESCED_MESSAGES = REGISTRY.counter(
+    "pytrace_ws_coalesced_messages_total", "Websocket messages combined with the one queued before")
+PTY_READ_BYTES = REGISTRY.counter(
+    "pytrace_pty_read_bytes_total", "STDOUT bytes read from program PTYs")
+STDIN_LINES = REGISTRY.counter(
+    "pytrace_stdin_lines_total", "STDIN messages sent to programs")
+INPUT_WAITS = REGISTRY.counter(
+    "pytrace_input_waits_total", "Times a program waited for STDIN to be typed")
+CLIENTS = REGISTRY.gauge(
+    "pytrace_clients", "Connected websocket clients")
+DETACHED_SESSIONS = REGISTRY.gauge(
+    "pytrace_detached_sessions", "Sessions whose program is kept running without a websocket")
+PROCESSES = REGISTRY.gauge(
+    "pytrace_processes", "Processes holding a worker")
+POOL_IDLE = REGISTRY.gauge(
+    "pytrace_pool_idle_workers", "Warm workers waiting for a process")
+POOL_WAITING = REGISTRY.gauge(
+    "pytrace_pool_waiting_processes", "Processes waiting for a warm worker")
+SCHEDULER_RUNNING = REGISTRY.gauge(
+    "pytrace_scheduler_running", "Runs admitted by the scheduler")
+SCHEDULER_QUEUED = REGISTRY.gauge(
+    "pytrace_scheduler_queued", "Runs waiting to be admitted by the scheduler")
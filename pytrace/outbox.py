@@ -0,0 +1,216 @@
+import asyncio
+import collections
+import metrics
+
+class Outbox:
+    '''
+    Messages waiting to be sent to one browser.  Messages are queued without
+    waiting and sent in order by a sender task, so a slow connection never
+    holds up the process (and through it the traced program).  While a
+    message waits it may be combined with the next one:
+
+    - STDOUT text is appended to the STDOUT message before it, up to
+      max_stdout characters.  Text past that is dropped and a marker with
+      the number of characters dropped is added when it is sent
+    - DATA that was sent without waiting is merged into the next DATA of the
+      same frame, as the browser only needs the latest variables and stack
+    - PROFILE replaces the PROFILE before it, as each has every line
+
+    Messages are only ever combined with the last one queued, so the order
+    seen by the browser does not change.  A browser that falls more than
+    max_messages behind is given up on (see Client.handle_outbox_overflow).
+    '''
+
+    MAX_MESSAGES = 1024
+
+    # Most STDOUT characters combined into one message
+    MAX_STDOUT = 256 * 1024
+
+    WS_CMD_STDOUT = "WS_CMD_STDOUT"
+    WS_CMD_DATA = "WS_CMD_DATA"
+    WS_CMD_PROFILE = "WS_CMD_PROFILE"
+
+    def __init__(self, send, overflow, max_messages=MAX_MESSAGES, max_stdout=MAX_STDOUT):
+        self.send = send
+        self.overflow = overflow
+        self.max_messages = max_messages
+        self.max_stdout = max_stdout
+        self.messages = collections.deque()
+        # The last STDOUT queued while more text can still be added to it.
+        # The text is kept in parts and only joined when it is sent.
+        self.stdout = None
+        self.stdout_parts = []
+        self.stdout_size = 0
+        self.stdout_dropped = 0
+        self.ready = asyncio.Event()
+        self.overflowed = False
+        self.task = None
+
+    #########################################################################################
+    # Functions related to queueing messages                                                #
+    #########################################################################################
+
+    def put(self, cmd, content):
+        '''
+        Queue a message to be sent.  Never waits.
+        '''
+        if self.overflowed:
+            return
+        if self.messages:
+            (last_cmd, last_content) = self.messages[-1]
+            if cmd == last_cmd == Outbox.WS_CMD_STDOUT and last_content is self.stdout:
+                self.add_stdout(content["TEXT"])
+                metrics.WS_COALESCED_MESSAGES.inc()
+                return
+            if cmd == last_cmd == Outbox.WS_CMD_DATA and Outbox.supersedes(last_content, content):
+                self.messages[-1] = (cmd, Outbox.merge_data(last_content, content))
+                metrics.WS_COALESCED_MESSAGES.inc()
+                return
+            if cmd == last_cmd == Outbox.WS_CMD_PROFILE:
+                self.messages[-1] = (cmd, content)
+                metrics.WS_COALESCED_MESSAGES.inc()
+                return
+        if len(self.messages) >= self.max_messages:
+            self.overflowed = True
+            self.clear()
+        else:
+            if self.stdout is not None:
+                # The open STDOUT is always the last message queued
+                self.messages[-1] = (Outbox.WS_CMD_STDOUT, self.close_stdout())
+            if cmd == Outbox.WS_CMD_STDOUT:
+                content = self.open_stdout(content["TEXT"])
+            self.messages.append((cmd, content))
+            metrics.WS_QUEUED_MESSAGES.inc()
+        self.ready.set()
+
+    def open_stdout(self, text):
+        '''
+        Start a new STDOUT message that later text may be added to.
+        '''
+        self.stdout = {"TEXT" : ""}
+        self.stdout_parts = []
+        self.stdout_size = 0
+        self.stdout_dropped = 0
+        self.add_stdout(text)
+        return self.stdout
+
+    def add_stdout(self, text):
+        room = self.max_stdout - self.stdout_size
+        if len(text) > room:
+            self.stdout_dropped += len(text) - room
+            text = text[:room]
+        if len(text) > 0:
+            self.stdout_parts.append(text)
+            self.stdout_size += len(text)
+
+    def close_stdout(self):
+        '''
+        Return the content of the open STDOUT message.  Nothing more is added
+        to it.
+        '''
+        text = "".join(self.stdout_parts)
+        if self.stdout_dropped > 0:
+            text += f"\n--- OUTPUT TRUNCATED ({self.stdout_dropped} CHARACTERS) ---\n"
+        self.stdout = None
+        self.stdout_parts = []
+        self.stdout_size = 0
+        self.stdout_dropped = 0
+        return {"TEXT" : text}
+
+    @staticmethod
+    def supersedes(previous, content):
+        '''
+        Return True if DATA content can replace the previous DATA.  Only DATA
+        the process did not stop at, and of the same frame, is replaced.
+        '''
+        try:
+            return not previous["wait"] and previous["frame"] == content["frame"]
+        except:
+            return False
+
+    @staticmethod
+    def merge_data(previous, content):
+        '''
+        Return one DATA content with the changes of both.  Variables are
+        changes since the last DATA of the frame (unless a keyframe) and
+        the stack is the number of functions popped and those pushed.
+        '''
+        merged = dict(content)
+        merged["released"] = previous["released"] + content["released"]
+        if not content["keyframe"]:
+            variables = dict(previous["variables"])
+            variables.update(content["variables"])
+            for name in content["removed"]:
+                variables.pop(name, None)
+            merged["variables"] = variables
+            if previous["keyframe"]:
+                merged["keyframe"] = True
+                merged["removed"] = []
+            else:
+                removed = [name for name in previous["removed"] if name not in content["variables"]]
+                merged["removed"] = removed + [name for name in content["removed"] if name not in removed]
+        first = previous.get("stack")
+        second = content.get("stack")
+        if first is not None and second is not None:
+            pushed = len(first["push"])
+            if second["pop"] <= pushed:
+                merged["stack"] = {"pop" : first["pop"],
+                                   "push" : first["push"][:pushed - second["pop"]] + second["push"]}
+            else:
+                merged["stack"] = {"pop" : first["pop"] + second["pop"] - pushed, "push" : second["push"]}
+        elif first is not None:
+            merged["stack"] = first
+        return merged
+
+    def clear(self):
+        metrics.WS_QUEUED_MESSAGES.dec(len(self.messages))
+        self.messages.clear()
+        self.stdout = None
+        self.stdout_parts = []
+
+    #########################################################################################
+    # Functions related to the sender task                                                  #
+    #########################################################################################
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        '''
+        Send queued messages in order until stopped.  If the browser fell
+        too far behind then the overflow callback is awaited and sending ends.
+        '''
+        while True:
+            if self.overflowed:
+                await self.overflow()
+                return
+            if not self.messages:
+                self.ready.clear()
+                await self.ready.wait()
+                continue
+            (cmd, content) = self.messages.popleft()
+            metrics.WS_QUEUED_MESSAGES.dec()
+            if content is self.stdout:
+                content = self.close_stdout()
+            try:
+                await self.send(cmd, content)
+            except Exception as e:
+                # The websocket is closed and the client will be disconnected
+                print(f"[{self}] => ERROR: Unable to send message [{e}]")
+                self.clear()
+                return
+
+    async def stop(self):
+        '''
+        Stop the sender task.  Messages not yet sent are dropped.
+        '''
+        self.clear()
+        task = self.task
+        self.task = None
+        if task is not None and task is not asyncio.current_task():
+            task.cancel()
+            try:
+                await task
+            except:
+                pass
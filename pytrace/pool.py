@@ -0,0 +1,351 @@
+import pty
+import os
+import sys
+import time
+import uuid
+import asyncio
+import resource
+import collections
+import metrics
+
+# The tracer run by every worker
+HARNESS_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sandbox")
+HARNESS_PATH = os.path.join(HARNESS_DIRECTORY, "harness.py")
+
+class DockerBackend:
+    '''
+    Start workers inside a sandboxed docker container.  The image is built
+    from sandbox/Dockerfile and already contains the compiled harness.
+    '''
+
+    def __init__(self, image="pytrace-sandbox", limits=None):
+        self.image = image
+        self.limits = limits
+
+    def command(self, server_name):
+        '''
+        Return the command and environment used to start a worker that
+        connects back to server_name.  The CPU time and memory limits are
+        given to docker.
+        '''
+        container_server_name = f"/sockets/{os.path.basename(server_name)}"
+        command = [
+            "docker", "run", "-u", f"{os.getuid()}:{os.getgid()}", "--rm", "-it",
+            "-v", f"{os.getcwd()}/sockets:/sockets", "-e", f"SERVER_NAME={container_server_name}"]
+        if self.limits is not None and self.limits.cpu_time is not None:
+            command += ["--ulimit", f"cpu={self.limits.cpu_time}"]
+        if self.limits is not None and self.limits.memory is not None:
+            command += ["--memory", str(self.limits.memory), "--memory-swap", str(self.limits.memory)]
+        command += [self.image, "python", "-u", "-m", "harness"]
+        return command, None
+
+    def preexec(self):
+        '''
+        Return the function run in the child before the worker starts.
+        '''
+        return None
+
+class SubprocessBackend:
+    '''
+    Start workers as plain python subprocesses on the host.  This does not
+    sandbox the code and is intended for testing without a docker daemon.
+    '''
+
+    def __init__(self, limits=None, python=sys.executable):
+        self.limits = limits
+        self.python = python
+
+    def command(self, server_name):
+        '''
+        Return the command and environment used to start a worker that
+        connects back to server_name.  The harness is imported from the
+        sandbox directory so its bytecode is cached after the first run.
+        '''
+        env = dict(os.environ)
+        env["SERVER_NAME"] = os.path.abspath(server_name)
+        env["PYTHONPATH"] = HARNESS_DIRECTORY
+        command = [self.python, "-u", "-m", "harness"]
+        return command, env
+
+    def preexec(self):
+        '''
+        Return the function run in the child before the worker starts.  It
+        sets the CPU time and memory limits as rlimits.
+        '''
+        limits = self.limits
+        if limits is None:
+            return None
+
+        def set_limits():
+            if limits.cpu_time is not None:
+                resource.setrlimit(resource.RLIMIT_CPU, (limits.cpu_time, limits.cpu_time + 1))
+            if limits.memory is not None:
+                resource.setrlimit(resource.RLIMIT_AS, (limits.memory, limits.memory))
+        return set_limits
+
+class Worker:
+
+    # Largest single message accepted from the code process
+    FRAME_LIMIT = 16 * 1024 * 1024
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.pty = None
+        self.server_name = None
+        self.server = None
+        self.process = None
+        self.reader = None
+        self.writer = None
+        self.connected = asyncio.Event()
+
+    #########################################################################################
+    # Functions related to starting the worker                                              #
+    #########################################################################################
+
+    async def spawn(self):
+        '''
+        Start a new worker process.  The worker runs the harness which connects
+        back to the server and then waits for code to run.
+        '''
+        # Create a PTY for both sides for stdout/stdin forwarding
+        # PTY is a pseudo terminal interface
+        self.pty, pty_subprocess = pty.openpty()
+
+        # Create a server for the worker to communicate status of the program
+        self.server_name = f"sockets/pytrace_{str(uuid.uuid4())}.sock"
+        os.makedirs("sockets", exist_ok=True)
+        os.chmod("sockets", 0o777)
+        self.server = await asyncio.start_unix_server(self.handle_server, path=self.server_name,
+                                                      limit=Worker.FRAME_LIMIT)
+        os.chmod(self.server_name, 0o666)
+
+        # Start the process.
+        command, env = self.backend.command(self.server_name)
+        try:
+            self.process = await asyncio.create_subprocess_exec(
+                *command,
+                env = env,
+                stdout = pty_subprocess,
+                stderr = pty_subprocess,
+                stdin = pty_subprocess,
+                preexec_fn = self.backend.preexec(),
+                close_fds = True)
+        finally:
+            # We don't need the process side of the PTY anymore
+            os.close(pty_subprocess)
+
+    async def handle_server(self, reader, writer):
+        '''
+        Save the connection made by the harness.  Only one connection is
+        accepted for each worker.
+        '''
+        if self.writer is not None:
+            print(f"[{self}] => ERROR: Worker is already connected")
+            writer.close()
+            return
+        self.reader = reader
+        self.writer = writer
+        self.connected.set()
+
+    def healthy(self):
+        '''
+        Check if the worker is still running and connected.
+        '''
+        return (self.process is not None and self.process.returncode is None and
+                self.writer is not None and not self.writer.is_closing() and
+                not self.reader.at_eof())
+
+    #########################################################################################
+    # Functions related to stopping (or cleaning up) the worker                             #
+    #########################################################################################
+
+    async def stop(self):
+        '''
+        Shutdown the connection, server, process, and pty if they have not already
+        been closed.
+        '''
+        if self.writer is not None:
+            try:
+                self.writer.close()
+            except:
+                pass
+            finally:
+                self.writer = None
+                self.reader = None
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+        if self.process is not None:
+            try:
+                self.process.kill()
+            except:
+                pass
+            finally:
+                await self.process.wait()
+                self.process = None
+        if self.pty is not None:
+            os.close(self.pty)
+            self.pty = None
+        if self.server_name is not None:
+            # Python 3.13 removes the socket file when the server is closed
+            try:
+                os.remove(self.server_name)
+            except FileNotFoundError:
+                pass
+            self.server_name = None
+
+class Pool:
+
+    def __init__(self, backend, size=4, spawn_timeout=30, health_interval=5):
+        self.backend = backend
+        self.size = size
+        self.spawn_timeout = spawn_timeout
+        self.health_interval = health_interval
+        self.workers = set()
+        self.idle = collections.deque()
+        self.waiters = collections.deque()
+        self.wakeup = asyncio.Event()
+        self.maintain_task = None
+        self.closing = False
+
+    #########################################################################################
+    # Functions related to keeping the pool filled with healthy workers                     #
+    #########################################################################################
+
+    async def start(self):
+        '''
+        Start the task that fills the pool and checks the health of idle workers.
+        '''
+        if self.maintain_task is not None:
+            print(f"[{self}] => ERROR: Pool is already started")
+            return
+        self.maintain_task = asyncio.create_task(self.maintain())
+
+    async def maintain(self):
+        '''
+        Replace workers that have been released or found unhealthy.  Runs when
+        woken by a release or every health_interval seconds, until closed.
+        '''
+        while not self.closing:
+            self.wakeup.clear()
+            await self.check()
+            await self.fill()
+            # asyncio.wait is used as wait_for (before Python 3.12) loses a
+            # cancel that arrives just as the wakeup is set
+            woken = asyncio.ensure_future(self.wakeup.wait())
+            try:
+                await asyncio.wait({woken}, timeout=self.health_interval)
+            finally:
+                woken.cancel()
+
+    async def check(self):
+        '''
+        Remove idle workers that have exited or lost their connection.
+        '''
+        for worker in list(self.idle):
+            if not worker.healthy():
+                print(f"[{self}] => ERROR: Removing unhealthy worker [{worker}]")
+                self.idle.remove(worker)
+                await self.release(worker)
+
+    async def fill(self):
+        '''
+        Start enough workers to bring the pool back to its configured size.
+        '''
+        missing = self.size - len(self.workers)
+        if missing > 0:
+            await asyncio.gather(*[self.spawn() for _ in range(missing)])
+
+    async def spawn(self):
+        '''
+        Start one worker and make it available once the harness has connected.
+        '''
+        worker = Worker(self.backend)
+        self.workers.add(worker)
+        started = time.perf_counter()
+        try:
+            await worker.spawn()
+            await asyncio.wait_for(worker.connected.wait(), self.spawn_timeout)
+        except asyncio.CancelledError:
+            self.workers.discard(worker)
+            await worker.stop()
+            raise
+        except Exception as e:
+            print(f"[{self}] => ERROR: Worker failed to start [{e}]")
+            self.workers.discard(worker)
+            await worker.stop()
+            return
+        metrics.WORKER_SPAWN_SECONDS.observe(time.perf_counter() - started)
+        self.put(worker)
+
+    def put(self, worker):
+        '''
+        Give a ready worker to the longest waiting caller or keep it idle.
+        '''
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(worker)
+                return
+        self.idle.append(worker)
+
+    #########################################################################################
+    # Functions related to handing workers to processes                                     #
+    #########################################################################################
+
+    async def acquire(self, timeout=None):
+        '''
+        Take a healthy idle worker.  If none are idle then wait (in order of
+        arrival) until one is ready.  Returns None if timeout expires first.
+        '''
+        while True:
+            if self.idle:
+                worker = self.idle.popleft()
+            else:
+                waiter = asyncio.get_running_loop().create_future()
+                self.waiters.append(waiter)
+                try:
+                    worker = await asyncio.wait_for(waiter, timeout)
+                except asyncio.TimeoutError:
+                    return None
+                except asyncio.CancelledError:
+                    # Don't lose a worker that was handed over as we were cancelled
+                    if waiter.done() and not waiter.cancelled():
+                        self.put(waiter.result())
+                    raise
+                finally:
+                    if waiter in self.waiters:
+                        self.waiters.remove(waiter)
+            if worker.healthy():
+                return worker
+            await self.release(worker)
+
+    async def release(self, worker):
+        '''
+        Stop a worker after it has run its program.  Workers are never reused, so
+        a replacement is started in the background.
+        '''
+        self.workers.discard(worker)
+        await worker.stop()
+        self.wakeup.set()
+
+    async def close(self):
+        '''
+        Stop the pool and every worker in it.
+        '''
+        self.closing = True
+        if self.maintain_task is not None:
+            self.maintain_task.cancel()
+            try:
+                await self.maintain_task
+            except:
+                pass
+            finally:
+                self.maintain_task = None
+        for waiter in self.waiters:
+            waiter.cancel()
+        self.waiters.clear()
+        self.idle.clear()
+        for worker in list(self.workers):
+            await self.release(worker)
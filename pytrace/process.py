@@ -1,21 +1,51 @@
-import pty
 import os
-import uuid
+import time
 import asyncio
+import codecs
 import json
+import metrics
 from interface import Interface
 
 class Process:
 
-    def __init__(self, code, callback):
+    # Seconds to wait for a worker from the pool before giving up
+    ACQUIRE_TIMEOUT = 60
+
+    # Seconds to wait for the last messages from a process that has exited
+    DRAIN_TIMEOUT = 1
+
+    # STDOUT is forwarded at most every STDOUT_INTERVAL seconds, or sooner
+    # when STDOUT_CHUNK bytes are waiting.  No more than STDOUT_LIMIT bytes
+    # are held; anything more is dropped and marked as truncated.
+    STDOUT_INTERVAL = 0.05
+    STDOUT_CHUNK = 16 * 1024
+    STDOUT_LIMIT = 1024 * 1024
+
+    def __init__(self, code, callback, pool, breakpoints=None, mode=Interface.TRACE_CMD_STEP, limit=0,
+                 scheduler=None, stdin=None):
         self.code = code
         self.callback = callback
-        self.pty = None
-        self.server_name = None
-        self.server = None
-        self.process = None
+        self.pool = pool
+        self.breakpoints = breakpoints or []
+        self.mode = mode
+        self.limit = limit
+        self.scheduler = scheduler
+        self.stdin = stdin
+        self.typed = []
+        self.running = False
+        self.scheduled = False
+        self.queued = False
+        self.started = None
+        # Seconds the program has run, not counting time stopped at a line
+        # or waiting for STDIN (see watch)
+        self.ran = 0
+        self.running_since = None
+        self.resumed = asyncio.Event()
+        self.waiting_input = False
+        self.worker = None
         self.pty = None
         self.server_writer = None
+        self.server_task = None
 
     #########################################################################################
     # Functions related to starting the process that runs the code                          #
@@ -23,58 +53,138 @@ class Process:
 
     async def start(self):
         '''
-        Start a new process running the python code.
+        Take a warm worker from the pool and give it the python code to run.
         '''
-        if self.process is not None:
-            print(f"[{self}] => ERROR: Process already exists when starting process")
-            return
-        if self.server is not None:
-            print(f"[{self}] => ERROR: Server already exists when starting process")
+        if self.worker is not None:
+            print(f"[{self}] => ERROR: Worker already exists when starting process")
             return
-        if self.server_name is not None:
-            print(f"[{self}] => ERROR: Server name already exists when starting process")
-            return
-        if self.pty is not None:
-            print(f"[{self}] => ERROR: PTY already exists when starting process")
+
+        # Wait for a slot to run in.  The client is told its place in the
+        # queue while waiting and position 0 once the process is admitted.
+        if self.scheduler is not None:
+            if not await self.scheduler.acquire(self.handle_queue):
+                await self.send_terminal("\n--- SERVER IS BUSY, TRY AGAIN LATER ---\n")
+                await self.refused()
+                return
+            self.scheduled = True
+            if self.queued:
+                await self.handle_queue(0)
+
+        # Wait for a worker.  If the pool stays empty then give up rather
+        # than queueing forever.
+        acquiring = time.perf_counter()
+        self.started = acquiring
+        worker = await self.pool.acquire(Process.ACQUIRE_TIMEOUT)
+        metrics.WORKER_ACQUIRE_SECONDS.observe(time.perf_counter() - acquiring)
+        if worker is None:
+            await self.send_terminal("\n--- NO WORKER AVAILABLE, TRY AGAIN LATER ---\n")
+            await self.refused()
             return
-        
-        # Wrap code with TRACE_CODE to enable communication back to the client
-        full_code = Process.START_CODE + f"\n        exec(\"\"\"\n{self.code}\n\"\"\",ns, ns)\n" + Process.END_CODE
-        
-        # Create a PTY for both sides for stdout/stdin forwarding
-        # PTY is a pseudo terminal interface
-        self.pty, pty_subprocess = pty.openpty()
-
-        # Create a server for process to communicate status of the program
-        self.server_name = f"sockets/pytrace_{str(uuid.uuid4())}.sock"
-        container_server_name = f"/sockets/{os.path.basename(self.server_name)}" 
-        os.makedirs("sockets", exist_ok=True)
-        os.chmod("sockets", 0o777)       
-        self.server = await asyncio.start_unix_server(self.handle_server, path=self.server_name)
-        os.chmod(self.server_name, 0o666)
-
-        # Start the process.  
-        self.process = await asyncio.create_subprocess_exec(
-            "docker", "run", "-u", f"{os.getuid()}:{os.getgid()}", "--rm", "-it", 
-            "-v", f"{os.getcwd()}/sockets:/sockets", "-e", f"SERVER_NAME={container_server_name}", 
-            "python:3.11-slim", "python", "-u", "-c", full_code,
-            stdout = pty_subprocess,
-            stderr = pty_subprocess,
-            stdin = pty_subprocess,
-            close_fds = True)
-        
-        # We don't need the process side of the PTY anymore
-        os.close(pty_subprocess)
+        self.worker = worker
+        metrics.PROCESSES.inc()
+        self.pty = worker.pty
+        self.server_writer = worker.writer
+        self.server_task = asyncio.create_task(self.handle_server(worker.reader))
+
+        # The run is stopped if it goes past the wall time limit
+        wall_time = None
+        if self.scheduler is not None and self.scheduler.limits is not None:
+            wall_time = self.scheduler.limits.wall_time
+        if wall_time is None:
+            await self.run(worker)
+        else:
+            run = asyncio.create_task(self.run(worker))
+            watch = asyncio.create_task(self.watch(wall_time))
+            try:
+                await asyncio.wait([run, watch], return_when=asyncio.FIRST_COMPLETED)
+            except asyncio.CancelledError:
+                run.cancel()
+                watch.cancel()
+                raise
+            watch.cancel()
+            if run.done():
+                run.result()
+            else:
+                run.cancel()
+                try:
+                    await run
+                except asyncio.CancelledError:
+                    pass
+                await self.send_terminal("\n--- TIME LIMIT EXCEEDED ---\n")
+        await self.completed()
+
+    async def watch(self, wall_time):
+        '''
+        Return once the program has run for wall_time seconds.  The clock is
+        paused while the program is stopped at a line or waiting for STDIN,
+        so stepping slowly never uses up the limit.
+        '''
+        while True:
+            if self.running_since is None:
+                self.resumed.clear()
+                await self.resumed.wait()
+                continue
+            left = wall_time - self.ran - (time.perf_counter() - self.running_since)
+            if left <= 0:
+                return
+            await asyncio.sleep(left)
+
+    def pause(self):
+        if self.running_since is not None:
+            self.ran += time.perf_counter() - self.running_since
+            self.running_since = None
+
+    def resume(self):
+        if self.running_since is None:
+            self.running_since = time.perf_counter()
+            self.resumed.set()
+
+    async def run(self, worker):
+        '''
+        Give the code to the worker and wait for it to finish.
+        '''
+        # The harness in the worker is waiting for the code to run.  STDIN
+        # given up front is read by the program instead of the terminal.
+        await self.send({"CODE" : self.code, "BREAKPOINTS" : self.breakpoints, "MODE" : self.mode,
+                         "LIMIT" : self.limit, "STDIN" : self.stdin})
+        metrics.PROCESS_START_SECONDS.observe(time.perf_counter() - self.started)
+
+        # STDIN typed before the code was sent follows it
+        self.running = True
+        self.resume()
+        typed = self.typed
+        self.typed = []
+        for message in typed:
+            await self.send(message)
 
         # Read STDOUT until the process completes
         await self.handle_process_reader()
 
-        # Verify the process has completely closed
-        # and then cleanup and send message back to Client
-        # that the program is completed
-        await self.process.wait()
-        self.process = None
-        await self.completed()
+        # Verify the process has completely closed and every message it
+        # sent has been read
+        returncode = await worker.process.wait()
+        await asyncio.wait([self.server_task], timeout=Process.DRAIN_TIMEOUT)
+
+        # A process killed by a signal (in docker the exit code is 128 plus
+        # the signal) most likely went past its CPU time or memory limit
+        if returncode < 0 or returncode > 128:
+            await self.send_terminal(f"\n--- PROGRAM TERMINATED (EXIT CODE {returncode}) ---\n")
+
+    async def handle_queue(self, position):
+        '''
+        Tell the client its position while waiting to be admitted.  Position
+        0 means the process has been admitted and is starting.
+        '''
+        self.queued = True
+        message = {"CMD" : Interface.PROC_CMD_QUEUE, "CONTENT" : {"POSITION" : position}}
+        await self.callback(message)
+
+    async def send_terminal(self, text):
+        '''
+        Send text to the client terminal as if written by the process.
+        '''
+        message = {"CMD" : Interface.PROC_CMD_STDOUT, "CONTENT" : {"TEXT" : text}}
+        await self.callback(message)
 
     async def handle_process_reader(self):
         '''
@@ -82,75 +192,114 @@ class Process:
         any text to the Client
         '''
 
-        # Create a queue to manage all the STDOUT received
-        queue = asyncio.Queue()
+        # Output is collected for a short window and then forwarded as
+        # one message.  The amount held is bounded so a runaway program
+        # cannot use up server memory.
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        pending = []
+        pending_size = 0
+        dropped = 0
+        closed = False
+        ready = asyncio.Event()
+        full = asyncio.Event()
         pty_loop = asyncio.get_running_loop()
 
         def on_read():
             '''
-            Read process STDOUT from the PTY and put it in the queue
-            for processing by handle_process_reader
+            Read process STDOUT from the PTY and hold it until it is 
+            forwarded by handle_process_reader
             '''
+            nonlocal pending_size, dropped, closed
             try:
-                data = os.read(self.pty, 1024)
-                queue.put_nowait(data)
+                data = os.read(self.pty, Process.STDOUT_CHUNK)
             except:
+                data = b""
+            if not data:
                 # This will cause the handle_process_reader
                 # to exit and return back to the start function.
-                queue.put_nowait(None)
+                closed = True
+                pty_loop.remove_reader(self.pty)
+                full.set()
+            elif pending_size + len(data) > Process.STDOUT_LIMIT:
+                dropped += len(data)
+            else:
+                metrics.PTY_READ_BYTES.inc(len(data))
+                pending.append(data)
+                pending_size += len(data)
+                if pending_size >= Process.STDOUT_CHUNK:
+                    full.set()
+            ready.set()
 
         # Connect the PTY as a reader on the current execution loop
         pty_loop.add_reader(self.pty, on_read)
-        while True:
-            text = await queue.get()
-            if text is None:
-                # When None, then the STDOUT has been closed
-                break
-            # Forward the STDOUT to the client
-            text = text.decode("utf-8")
-            message = {"CMD" : Interface.PROC_CMD_STDOUT, "CONTENT" : { "TEXT" : text}}
-            await self.callback(message)
-
-        # When STDOUT is closed, remove the PTY as a reader
-        pty_loop.remove_reader(self.pty)
-
-    async def handle_server(self, reader, writer):
+        while not closed:
+            await ready.wait()
+            try:
+                # Wait a little for more output unless there is already plenty
+                await asyncio.wait_for(full.wait(), Process.STDOUT_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            ready.clear()
+            full.clear()
+
+            # Forward the STDOUT to the client.  The incremental decoder keeps
+            # any partial multibyte character for the next read.
+            text = decoder.decode(b"".join(pending), final=closed)
+            pending.clear()
+            pending_size = 0
+            if dropped > 0:
+                text += f"\n--- OUTPUT TRUNCATED ({dropped} BYTES) ---\n"
+                dropped = 0
+            if len(text) > 0:
+                message = {"CMD" : Interface.PROC_CMD_STDOUT, "CONTENT" : { "TEXT" : text}}
+                await self.callback(message)
+
+    async def handle_server(self, reader):
         '''
         Handles all data messages sent to the server from the code process.  These messages
         are forwarded to the client.
         '''
-        if self.server_writer is not None:
-            print(f"[{self}] => ERROR: Server Writer already exists when starting process")
-            return
-        
-        # Save the current writer so it can be used in other functions to forward STDIN
-        self.server_writer = writer
         try:
             while True:
-                # Read messages sent by the client until None is returned by handle_process_reader
-                json_message = await reader.read(4096)
-                if json_message is None:
+                # The code process keeps one connection open for the whole run and
+                # sends one JSON message per line.  The reader buffers partial and
+                # coalesced reads so each readline returns exactly one frame.
+                frame = await reader.readline()
+                if not frame.endswith(b"\n"):
+                    # Connection closed (any partial frame left is discarded)
                     break
 
                 # Convert the data received into a dictionary and send to the client
-                decoded_json_message = json_message.decode("UTF-8").rstrip("\n")
-                content = json.loads(decoded_json_message)
-                if content["wait"]:
-                    message = {"CMD" : Interface.PROC_CMD_DATA, "CONTENT" : content}
-                else:
-                    message = {"CMD" : Interface.PROC_CMD_DATA_NO_WAIT, "CONTENT" : content}
+                metrics.TRACE_MESSAGES.inc()
+                metrics.TRACE_MESSAGE_BYTES.observe(len(frame))
+                frame = json.loads(frame)
+                content = frame["CONTENT"]
+                match frame["CMD"]:
+                    case Interface.TRACE_CMD_DATA:
+                        if content["wait"]:
+                            self.pause()
+                            message = {"CMD" : Interface.PROC_CMD_DATA, "CONTENT" : content}
+                        else:
+                            message = {"CMD" : Interface.PROC_CMD_DATA_NO_WAIT, "CONTENT" : content}
+                    case Interface.TRACE_CMD_EXPAND:
+                        message = {"CMD" : Interface.PROC_CMD_EXPAND, "CONTENT" : content}
+                    case Interface.TRACE_CMD_FINISHED:
+                        message = {"CMD" : Interface.PROC_CMD_FINISHED, "CONTENT" : content}
+                    case Interface.TRACE_CMD_INPUT:
+                        self.pause()
+                        self.waiting_input = True
+                        metrics.INPUT_WAITS.inc()
+                        message = {"CMD" : Interface.PROC_CMD_INPUT, "CONTENT" : content}
+                    case Interface.TRACE_CMD_PROFILE:
+                        message = {"CMD" : Interface.PROC_CMD_PROFILE, "CONTENT" : content}
+                    case _:
+                        print(f"[{self}] => ERROR: Invalid message type from code process [{frame['CMD']}]")
+                        continue
                 await self.callback(message)
+        except ValueError:
+            print(f"[{self}] => ERROR: Invalid or oversized frame received from process")
         except:
             pass
-        finally:
-            try:
-                # Runs when the server is closed
-                writer.close()
-                await writer.wait_closed()
-            except:
-                pass
-            finally:
-                self.server_writer = None
 
     #########################################################################################
     # Functions related to stopping (or cleaning up) the process that runs the code         #
@@ -158,26 +307,30 @@ class Process:
             
     async def stop(self):
         '''
-        Shutdown the server, process, and pty if they have not already be closed.
+        Stop reading from the worker and return it to the pool to be replaced.
+        The slot in the scheduler is given to the next waiting process.
         '''
-        if self.server is not None:
-            self.server.close()
-            await self.server.wait_closed()
-            self.server = None
-        if self.process is not None:
+        if self.server_task is not None:
+            self.server_task.cancel()
             try:
-                self.process.kill()
+                await self.server_task
             except:
                 pass
             finally:
-                await self.process.wait()
-                self.process = None  
+                self.server_task = None
         if self.pty is not None:
-            os.close(self.pty)
+            asyncio.get_running_loop().remove_reader(self.pty)
             self.pty = None
-        if self.server_name is not None:
-            os.remove(self.server_name)
-            self.server_name = None
+        self.server_writer = None
+        self.running = False
+        if self.worker is not None:
+            worker = self.worker
+            self.worker = None
+            metrics.PROCESSES.dec()
+            await self.pool.release(worker)
+        if self.scheduled:
+            self.scheduled = False
+            await self.scheduler.release()
 
     async def completed(self):
         '''
@@ -189,113 +342,70 @@ class Process:
         message = {"CMD" : Interface.PROC_CMD_COMPLETED, "CONTENT" : {}}
         await self.callback(message)
 
+    async def refused(self):
+        '''
+        Perform the stop function and tell the client the program was not
+        started (the server was busy or had no worker).
+        '''
+        await self.stop()
+        message = {"CMD" : Interface.PROC_CMD_REFUSED, "CONTENT" : {}}
+        await self.callback(message)
+
     #########################################################################################
     # Functions related to commands from the client and code process.                       #
     #########################################################################################
 
-    async def proceed(self):
+    async def proceed(self, command=Interface.TRACE_CMD_STEP):
+        '''
+        Direct the code process to run until the next place it should stop
+        for the command (STEP, CONTINUE, STEP_OVER, or STEP_OUT).
+        '''
+        self.resume()
+        await self.send({"CMD" : command})
+
+    async def set_breakpoints(self, lines):
         '''
-        Direct the code process to proceed to the next line of code
+        Replace the breakpoints used by the code process.  This takes effect
+        immediately even while the code is running.
         '''
+        self.breakpoints = lines
         if self.server_writer is None:
-            print(f"[{self}] => ERROR: Server Writer does not exist to proceed")
+            # Not started yet so the breakpoints are sent with the code
             return
-        # The word PROCEED is not checked by the code running in the process
-        self.server_writer.write(b"PROCEED\n")
-        await self.server_writer.drain()
+        await self.send({"CMD" : Interface.TRACE_CMD_BREAKPOINTS, "LINES" : lines})
 
-    async def forward(self, text):
+    async def expand(self, frame, path, offset):
         '''
-        Direct STDIN text to be used by the code process
+        Ask the stopped code process for more of a truncated value.  The path
+        is the variable name followed by the position of each nested item.
+        An empty path asks for every variable of the frame.
+        '''
+        await self.send({"CMD" : Interface.TRACE_CMD_EXPAND, "FRAME" : frame, "PATH" : path, 
+                         "OFFSET" : offset})
+
+    async def send(self, message):
         '''
-        if self.pty is None:
-            print(f"[{self}] => ERROR: PTY does not exist to forward STDIN")
+        Send one framed JSON message to the code process
+        '''
+        if self.server_writer is None:
+            print(f"[{self}] => ERROR: Server Writer does not exist to send [{message}]")
             return
-        os.write(self.pty, text.encode("utf-8"))
+        self.server_writer.write(json.dumps(message).encode("utf-8") + b"\n")
+        await self.server_writer.drain()
 
-    START_CODE = \
-"""import sys
-import socket
-import json
-import os
-import traceback
-
-prev_line = -1
-except_occurred = False
-
-def trace(frame, event, arg):
-    global prev_line
-    global except_occurred
-    if event == "exception":
-        except_occurred = True
-    if (event == "line" or event == "return") and frame.f_code.co_filename == "<string>": 
-        sock_path = os.environ.get("SERVER_NAME")
-        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
-            variables = {}
-            for (name, value) in frame.f_locals.items():
-                try:
-                    json.dumps(value)
-                    variables[name] = value
-                except:
-                    pass
-            stack = []
-            curr = frame
-            while curr is not None and curr.f_code.co_name != "<module>":
-                 stack.append(curr.f_code.co_name)
-                 curr = curr.f_back
-            data = json.dumps({
-                "line": frame.f_lineno - 1, 
-                "file": frame.f_code.co_filename,
-                "variables": variables,
-                "functions": stack,
-                "wait": (prev_line != frame.f_lineno - 1) and not except_occurred
-            })
-            prev_line = frame.f_lineno - 1
-            try:
-                s.connect(sock_path)
-                s.sendall(data.encode("utf-8"))
-                _ = s.recv(4096)
-            except:
-                sys.exit()
-    return trace
-
-def __pytrace():
-    sys.settrace(trace)
-    ns = dict()
-    try:
-"""
-
-    END_CODE = \
-"""
-
-    except SyntaxError as e:
-        print()
-        print("EXCEPTION OCCURRED")
-        print("==================")
-        print(f"{type(e).__name__}: {e.msg}")
-        print(f"Row {e.lineno-1}")
-
-    except Exception as e:
-        tb = traceback.extract_tb(e.__traceback__)
-        stack = []
-        print()
-        print("EXCEPTION OCCURRED")
-        print("==================")
-        print(f"{type(e).__name__}: {str(e)}")
-        for i in range(len(tb)-1, -1, -1):
-            if tb[i].filename == "<string>":
-                if tb[i].name == "<module>":
-                    stack.append((None, tb[i].lineno-1))
-                elif tb[i].name != "__pytrace":
-                    stack.append((tb[i].name, tb[i].lineno-1))
-        space = ""
-        if len(stack) > 0:
-            for (name,line) in reversed(stack):
-                if name is None:
-                    print(f"Row {line}")
-                else:
-                    print(f"{space}\u2514\u2500\u25b6 Inside [{name}] (Row {line})")
-                space += "   "
-
-__pytrace()
-"""
\ No newline at end of file
+    async def forward(self, text, eof=False):
+        '''
+        Direct STDIN text (a whole line) to be read by the code process.
+        EOF ends the input after the text.  Text typed before the code is
+        sent is held until then.
+        '''
+        metrics.STDIN_LINES.inc()
+        message = {"CMD" : Interface.TRACE_CMD_STDIN, "TEXT" : text, "EOF" : eof}
+        if not self.running:
+            self.typed.append(message)
+            return
+        if self.waiting_input:
+            # STDIN typed ahead while stopped at a line does not restart the clock
+            self.waiting_input = False
+            self.resume()
+        await self.send(message)
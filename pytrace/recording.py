@@ -0,0 +1,73 @@
+class Recording:
+    '''
+    The trace of a program that was run unattended.  Each step is a DATA
+    message from the process (variables are already sent as changes per
+    frame) along with how much of STDOUT had been written at that step.
+    The browser steps forward and backward through it without a process.
+    '''
+
+    # Largest number of steps recorded for one run
+    MAX_STEPS = 20000
+
+    def __init__(self, key=None):
+        self.key = key
+        self.steps = []
+        self.stdout = []
+        self.stdin = []
+        self.truncated = False
+        self.finished = False
+        self.imported = []
+
+    def add_step(self, content):
+        '''
+        Add a DATA message from the process.  Fields the replay does not use
+        are removed to keep the recording small.
+        '''
+        if len(self.steps) >= Recording.MAX_STEPS:
+            self.truncated = True
+            return
+        step = dict(content)
+        step.pop("file", None)
+        step.pop("wait", None)
+        for key in ("removed", "released"):
+            if not step.get(key, True):
+                del step[key]
+        self.steps.append(step)
+        if len(self.steps) == Recording.MAX_STEPS:
+            # The process stops sending once the limit is reached
+            self.truncated = True
+
+    def add_stdout(self, text):
+        '''
+        Add STDOUT text from the process.  The offsets in each step count
+        the characters written by the program, so the newlines added by
+        the PTY are removed.
+        '''
+        self.stdout.append(text.replace("\r\n", "\n"))
+
+    def add_stdin(self, text):
+        '''
+        Add STDIN text forwarded to the process.
+        '''
+        self.stdin.append(text)
+
+    def finish(self, content):
+        '''
+        Record the report the process sends after the program has finished.
+        '''
+        self.finished = True
+        self.imported = list(content.get("imported", []))
+
+    def deterministic(self):
+        '''
+        Check if running the program again would give the same trace.  The
+        program must have run to the end without STDIN and without importing
+        modules (such as random or time) that may change what it does.
+        '''
+        return self.finished and not self.truncated and not self.stdin and not self.imported
+
+    def to_content(self):
+        '''
+        Return the recording as the CONTENT of a TRACE message.
+        '''
+        return {"STEPS" : self.steps, "STDOUT" : "".join(self.stdout), "TRUNCATED" : self.truncated}
@@ -0,0 +1,157 @@
+import os
+import sys
+import asyncio
+import hashlib
+import argparse
+import urllib.parse
+
+class Router:
+    '''
+    Front end that spreads connections over several server processes.  A
+    request with a session token (?session=...) always goes to the same
+    server while that server is up, so a browser that reconnects finds its
+    session again.  Requests without one go to the server with the fewest
+    open connections.  Servers may be local processes or other hosts.
+    '''
+
+    # Largest request head read before choosing a server
+    HEAD_LIMIT = 64 * 1024
+
+    # Seconds a server that refused a connection is skipped
+    RETRY_INTERVAL = 5
+
+    def __init__(self, backends):
+        self.backends = backends
+        self.connections = {backend : 0 for backend in backends}
+        self.down = {}
+
+    #########################################################################################
+    # Functions related to choosing a server                                                #
+    #########################################################################################
+
+    def candidates(self, session):
+        '''
+        Return the servers in the order they should be tried.  With a session
+        the order comes from rendezvous hashing, so losing one server only
+        moves the sessions that were on it.
+        '''
+        loop = asyncio.get_running_loop()
+        up = [backend for backend in self.backends if self.down.get(backend, 0) <= loop.time()]
+        down = [backend for backend in self.backends if backend not in up]
+        if session is None:
+            up.sort(key=lambda backend: self.connections[backend])
+        else:
+            def weight(backend):
+                return hashlib.sha256(f"{backend}/{session}".encode("utf-8")).digest()
+            up.sort(key=weight, reverse=True)
+        return up + down
+
+    @staticmethod
+    def session(head):
+        '''
+        Return the session token in the request line of the head or None.
+        '''
+        try:
+            target = head.split(b"\r\n", 1)[0].split(b" ")[1].decode("latin-1")
+            values = urllib.parse.parse_qs(urllib.parse.urlsplit(target).query).get("session")
+        except:
+            return None
+        return values[0] if values else None
+
+    #########################################################################################
+    # Functions related to forwarding connections                                           #
+    #########################################################################################
+
+    async def handle_connection(self, reader, writer):
+        '''
+        Read the request head, connect to a server and then copy bytes both
+        ways until either side closes.  Websocket upgrades are forwarded the
+        same way as plain requests.
+        '''
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            writer.close()
+            return
+
+        session = Router.session(head)
+        for backend in self.candidates(session):
+            host, port = backend.rsplit(":", 1)
+            try:
+                server_reader, server_writer = await asyncio.open_connection(host, int(port))
+            except OSError as e:
+                print(f"[{self}] => ERROR: Server [{backend}] is not reachable [{e}]")
+                self.down[backend] = asyncio.get_running_loop().time() + Router.RETRY_INTERVAL
+                continue
+            self.down.pop(backend, None)
+            break
+        else:
+            writer.write(b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            writer.close()
+            return
+
+        self.connections[backend] += 1
+        try:
+            server_writer.write(head)
+            await asyncio.gather(self.copy(reader, server_writer), self.copy(server_reader, writer))
+        finally:
+            self.connections[backend] -= 1
+            server_writer.close()
+            writer.close()
+
+    async def copy(self, reader, writer):
+        '''
+        Copy bytes from reader to writer until the reader closes.
+        '''
+        try:
+            while True:
+                data = await reader.read(64 * 1024)
+                if not data:
+                    break
+                writer.write(data)
+                await writer.drain()
+        except:
+            pass
+        finally:
+            try:
+                writer.write_eof()
+            except:
+                pass
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle_connection, host, port, limit=Router.HEAD_LIMIT)
+        print(f"[{self}] => Routing {host}:{port} to {', '.join(self.backends)}")
+        async with server:
+            await server.serve_forever()
+
+async def main(args):
+    '''
+    Start the local server processes (if any) and route to them and to any
+    remote servers.  Local servers share state through the sqlite store.
+    '''
+    app = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app")
+    env = dict(os.environ)
+    env.setdefault("PYTRACE_STORE", os.path.abspath(args.store))
+    processes = []
+    backends = list(args.backend)
+    for index in range(args.workers):
+        bind = f"127.0.0.1:{args.worker_port + index}"
+        processes.append(await asyncio.create_subprocess_exec(
+            sys.executable, "-m", "hypercorn", "--bind", bind, app, env=env))
+        backends.append(bind)
+    try:
+        await Router(backends).serve(args.host, args.port)
+    finally:
+        for process in processes:
+            process.terminate()
+            await process.wait()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run pytrace on several server processes")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=2, help="local server processes to start")
+    parser.add_argument("--worker-port", type=int, default=8100, help="port of the first local server")
+    parser.add_argument("--backend", action="append", default=[], help="host:port of a remote server")
+    parser.add_argument("--store", default="pytrace.db", help="sqlite store shared by local servers")
+    asyncio.run(main(parser.parse_args()))
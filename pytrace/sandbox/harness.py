@@ -0,0 +1,767 @@
+# Runs inside each worker (python -m harness).  It connects back to the
+# server named by SERVER_NAME, receives the code to run over that channel
+# and traces it.  The sandbox image ships this module precompiled.
+import sys
+import socket
+import json
+import os
+import traceback
+import threading
+import queue
+import itertools
+import types
+import builtins
+import time
+import io
+import resource
+import operator
+import reprlib
+import array
+import collections
+
+# Name the user code is compiled with so it can be told apart from
+# this harness and the standard library
+FILENAME = "<pytrace>"
+
+prev_line = -1
+except_occurred = False
+channel = None
+commands = queue.SimpleQueue()
+typed = queue.SimpleQueue()
+breakpoints = set()
+mode = "STEP"
+depth = 0
+target_depth = 0
+output = None
+monitoring = hasattr(sys, "monitoring")
+
+# In RECORD mode every line is sent without stopping until record_limit
+# lines have been sent.  After that the program runs without sending.
+record_limit = 0
+recorded = 0
+
+# In RUN mode the program is not traced at all.  In SUMMARY mode only the
+# number of lines run is counted.  Neither sends anything until FINISHED.
+executed = 0
+
+# In PROFILE mode no variables are captured.  Each line has [hits,
+# seconds] in profiled, where the seconds are the time from the line
+# starting until the next line of any frame starts.  The table is sent
+# every PROFILE_INTERVAL seconds while the program runs and in FINISHED.
+PROFILE_INTERVAL = 1
+profiled = {}
+profiled_line = None
+profiled_at = 0
+profile_sent = 0
+clock = time.perf_counter
+
+# Modules whose use means the program may not do the same thing each
+# time it is run.  Imports of these by the program are reported when it
+# finishes so that its trace is not reused for a later run.
+NONDETERMINISTIC = {
+    "random", "secrets", "uuid", "time", "datetime", "os", "socket", "select",
+    "subprocess", "threading", "multiprocessing", "asyncio", "urllib", "http",
+    "tempfile", "shutil", "glob", "pathlib"
+}
+imported = set()
+user_globals = None
+system_import = builtins.__import__
+
+# Variables are sent as changes from the last message sent for the same
+# frame.  A full keyframe is sent the first time a frame is sent and then
+# every KEYFRAME_INTERVAL messages.  Frame ids that have returned are
+# listed in "released" so the browser can forget them.  Each frame of
+# the user code has a state of [frame id, last variables sent, messages
+# since the last keyframe, sent at least once].  The last variables are
+# kept as name: (value, JSON, items).  value is only kept for IMMUTABLE
+# values (otherwise it is UNKEPT) and items only for sequences and small
+# dicts of them (see shallow), so a value that is still the same is not
+# summarized again.
+KEYFRAME_INTERVAL = 100
+IMMUTABLE = {int, float, str, bool, type(None), complex, bytes}
+UNKEPT = object()
+frames = {}
+next_frame_id = 0
+released = []
+
+# The functions being run (outermost first) are kept as they are called
+# and return.  Only the change since the last message is sent: the number
+# of functions to pop followed by the functions to push.  stack_kept is
+# the number of functions at the bottom of the stack unchanged since then.
+stack = []
+stack_sent = 0
+stack_kept = 0
+
+class Output:
+    # Counts the characters written to stdout so each recorded line
+    # knows how much output came before it.
+    def __init__(self, stream):
+        self.stream = stream
+        self.count = 0
+
+    def write(self, text):
+        self.count += len(text)
+        return self.stream.write(text)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+class Input(io.TextIOBase):
+    # STDIN of a program run from the browser.  The browser sends whole
+    # lines over the channel.  When the program needs input that has not
+    # been typed yet the server is told so (INPUT) before waiting for it.
+    # Lines are echoed as they are read, as a terminal would.
+    def __init__(self):
+        self.text = ""
+        self.eof = False
+
+    def readable(self):
+        return True
+
+    def fill(self):
+        # Wait for more text.  Returns False at the end of the input.
+        if self.eof:
+            return False
+        try:
+            command = typed.get_nowait()
+        except queue.Empty:
+            sys.stdout.flush()
+            send("INPUT", {})
+            command = typed.get()
+        if command is None:
+            sys.exit()
+        text = command["TEXT"]
+        self.eof = command.get("EOF", False)
+        if text:
+            sys.stdout.write(text)
+            sys.stdout.flush()
+        self.text += text
+        return bool(text) or not self.eof
+
+    def readline(self, size=-1):
+        while "\n" not in self.text and (size < 0 or len(self.text) < size) and self.fill():
+            pass
+        end = self.text.find("\n") + 1 or len(self.text)
+        if size >= 0:
+            end = min(end, size)
+        (line, self.text) = (self.text[:end], self.text[end:])
+        return line
+
+    def read(self, size=-1):
+        while (size < 0 or len(self.text) < size) and self.fill():
+            pass
+        end = len(self.text) if size < 0 else size
+        (text, self.text) = (self.text[:end], self.text[end:])
+        return text
+
+def record_import(name, globals=None, locals=None, fromlist=(), level=0):
+    if globals is user_globals and level == 0:
+        module = name.partition(".")[0]
+        if module in NONDETERMINISTIC:
+            imported.add(module)
+    return system_import(name, globals, locals, fromlist, level)
+
+def connect():
+    global channel
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(os.environ.get("SERVER_NAME"))
+    channel = sock.makefile("rwb")
+
+def listen():
+    # Runs in its own (untraced) thread so breakpoints can be changed
+    # while the program is running.  STDIN is queued for the program to
+    # read and other commands are queued until the program stops to wait
+    # for them.
+    global breakpoints
+    global breakpoints_changed
+    while True:
+        line = channel.readline()
+        if not line:
+            commands.put(None)
+            typed.put(None)
+            return
+        command = json.loads(line)
+        if command["CMD"] == "BREAKPOINTS":
+            breakpoints = set(command["LINES"])
+            if monitoring:
+                # Lines disabled by the program must run again to reach the
+                # new breakpoints.  The program thread restarts them again
+                # itself (see monitor_line).
+                breakpoints_changed += 1
+                sys.monitoring.restart_events()
+        elif command["CMD"] == "STDIN":
+            typed.put(command)
+        else:
+            commands.put(command)
+
+# Values are encoded once, with one encoder made up front.  Messages the
+# server does not wait for are left in the channel buffer and go out with
+# the next message that is flushed (a stop, INPUT, EXPAND or FINISHED),
+# so most lines cost no system call.
+encode = json.JSONEncoder(separators=(",", ":"), check_circular=False).encode
+encode_string = json.encoder.encode_basestring_ascii
+
+def dump(value):
+    # Return the JSON of a summarized value.  Scalars are written directly
+    # as setting up the encoder costs more than encoding them.
+    kind = type(value)
+    if kind is int:
+        return int.__repr__(value)
+    if kind is str:
+        return encode_string(value)
+    if kind is float:
+        return float.__repr__(value)
+    if value is None:
+        return "null"
+    if kind is bool:
+        return "true" if value else "false"
+    return encode(value)
+
+def send(cmd, content, flush=True):
+    write(f'{{"CMD":"{cmd}","CONTENT":{encode(content)}}}\n', flush)
+
+def write(text, flush=True):
+    try:
+        channel.write(text.encode("utf-8"))
+        if flush:
+            channel.flush()
+    except:
+        sys.exit()
+
+def wait():
+    global mode
+    global target_depth
+    while True:
+        command = commands.get()
+        if command is None:
+            sys.exit()
+        if command["CMD"] == "EXPAND":
+            send("EXPAND", expand(command["FRAME"], command["PATH"], command["OFFSET"]))
+            continue
+        mode = command["CMD"]
+        target_depth = depth
+        if monitoring:
+            enable_lines()
+        return
+
+# Values are summarized so the cost of each message is bounded no matter
+# how large the data is.  Containers are cut off after MAX_ITEMS items
+# (and MAX_DEPTH levels) and strings after MAX_STRING characters.  The
+# browser can ask for more of a truncated value with EXPAND.  deque and
+# array are summarized like lists.  Anything else is shown by its repr,
+# made by SUMMARY_REPR so that large standard values are not repr'd in
+# full (only the __repr__ of the program's own classes can not be cut
+# short).
+MAX_DEPTH = 3
+MAX_ITEMS = 50
+MAX_STRING = 200
+HIDDEN = (types.ModuleType, types.FunctionType, types.BuiltinFunctionType, type)
+CONTAINERS = (list, tuple, set, frozenset, dict)
+SEQUENCES = (collections.deque, array.array)
+
+class SummaryRepr(reprlib.Repr):
+    def repr_bytes(self, value, level):
+        if len(value) <= self.maxstring:
+            return builtins.repr(value)
+        return builtins.repr(value[:self.maxstring]) + "..."
+
+    repr_bytearray = repr_bytes
+
+SUMMARY_REPR = SummaryRepr()
+SUMMARY_REPR.maxlevel = MAX_DEPTH
+for limit in ("maxtuple", "maxlist", "maxarray", "maxdict", "maxset", "maxfrozenset", "maxdeque"):
+    setattr(SUMMARY_REPR, limit, MAX_ITEMS)
+SUMMARY_REPR.maxstring = SUMMARY_REPR.maxlong = SUMMARY_REPR.maxother = MAX_STRING
+
+def summarize_items(items, depth):
+    # The items of a container.  Most are short strings and small ints so
+    # those are kept as they are without a call to summarize.
+    result = []
+    for value in items:
+        kind = type(value)
+        if kind is int and -2**53 < value < 2**53 or kind is str and len(value) <= MAX_STRING:
+            result.append(value)
+        else:
+            result.append(summarize(value, depth))
+    return result
+
+def summarize(value, depth=0, offset=0):
+    kind = type(value)
+    if kind is int:
+        if -2**53 < value < 2**53:
+            return value
+    elif kind is str:
+        if offset == 0 and len(value) <= MAX_STRING:
+            return value
+    elif kind is float:
+        if value - value == 0:
+            return value
+    elif value is None or kind is bool:
+        return value
+    if isinstance(value, str):
+        if offset == 0 and len(value) <= MAX_STRING:
+            return str(value)
+        return {"type": "str", "text": value[offset:offset + MAX_STRING], "length": len(value)}
+    if isinstance(value, CONTAINERS):
+        if kind not in CONTAINERS:
+            for kind in CONTAINERS:
+                if isinstance(value, kind):
+                    break
+        node = {"type": kind.__name__, "items": [], "length": len(value)}
+        if type(value) is not kind:
+            node["class"] = type(value).__name__
+        if depth < MAX_DEPTH:
+            if kind is dict:
+                keys = summarize_items(itertools.islice(value, offset, offset + MAX_ITEMS), depth + 1)
+                values = summarize_items(itertools.islice(value.values(), offset, offset + MAX_ITEMS), depth + 1)
+                node["items"] = list(map(list, zip(keys, values)))
+            else:
+                node["items"] = summarize_items(itertools.islice(value, offset, offset + MAX_ITEMS), depth + 1)
+        return node
+    if isinstance(value, SEQUENCES):
+        node = {"type": "list", "class": type(value).__name__, "items": [], "length": len(value)}
+        if depth < MAX_DEPTH:
+            node["items"] = summarize_items(itertools.islice(value, offset, offset + MAX_ITEMS), depth + 1)
+        return node
+    try:
+        text = SUMMARY_REPR.repr(value)
+    except:
+        text = f"<{type(value).__name__} object>"
+    return {"type": "repr", "class": type(value).__name__, "text": text[:MAX_STRING], "length": len(text)}
+
+def visible(frame):
+    for (name, value) in frame.f_locals.items():
+        if name.startswith(("__", ".")) or isinstance(value, HIDDEN):
+            continue
+        yield (name, value)
+
+def expand(frame_id, path, offset):
+    # An empty path asks for every variable of the frame.  Any frame that
+    # has not returned can be expanded.
+    content = {"frame": frame_id, "path": path, "offset": offset, "value": None}
+    frame = None
+    for (candidate, state) in frames.items():
+        if state[0] == frame_id:
+            frame = candidate
+            break
+    if frame is None:
+        return content
+    try:
+        if not path:
+            content["value"] = {name: summarize(value) for (name, value) in visible(frame)}
+            return content
+        value = frame.f_locals[path[0]]
+        for index in path[1:]:
+            if isinstance(value, dict):
+                value = next(itertools.islice(value.values(), index, None))
+            else:
+                value = next(itertools.islice(value, index, None))
+        content["value"] = summarize(value, 0, offset)
+    except:
+        pass
+    return content
+
+def capture(frame):
+    # Return the start of the JSON of a DATA message for the frame: the
+    # variables changed since the last message of the frame (or all of
+    # them for a keyframe), those removed and the frames released
+    global released
+    state = frames.get(frame)
+    if state is None:
+        state = enter(frame)
+    (frame_id, previous, count, sent) = state
+    state[3] = True
+    keyframe = count >= KEYFRAME_INTERVAL
+    variables = []
+    kept = 0
+    added = 0
+    local = frame.f_locals
+    # The last variables sent are updated in place so nothing is done for
+    # a variable that has not changed (most of them on most lines)
+    for (name, value) in local.items():
+        last = previous.get(name)
+        if last is None:
+            if name.startswith(("__", ".")) or isinstance(value, HIDDEN):
+                continue
+            added += 1
+        else:
+            if last[0] is value or (last[2] is not None and unchanged(value, last[2])):
+                kept += 1
+                if keyframe:
+                    variables.append(f"{encode_string(name)}:{last[1]}")
+                continue
+            if isinstance(value, HIDDEN):
+                # A variable that now holds a function or module is removed
+                continue
+            kept += 1
+        kind = type(value)
+        encoded = dump(summarize(value))
+        previous[name] = (value if kind in IMMUTABLE else UNKEPT, encoded, shallow(value, kind))
+        if keyframe or last is None or last[1] != encoded:
+            variables.append(f"{encode_string(name)}:{encoded}")
+    removed = "[]"
+    if kept + added != len(previous):
+        names = [name for name in previous if name not in local or isinstance(local[name], HIDDEN)]
+        for name in names:
+            del previous[name]
+        if not keyframe:
+            removed = f'[{",".join([encode_string(name) for name in names])}]'
+    state[2] = 0 if keyframe else count + 1
+    text = (f'{{"frame":{frame_id},"keyframe":{"true" if keyframe else "false"},'
+            f'"variables":{{{",".join(variables)}}},"removed":{removed},"released":')
+    if released:
+        text += f'[{",".join(map(str, released))}]'
+        released = []
+    else:
+        text += "[]"
+    return text
+
+def shallow(value, kind):
+    # Return the length and summarized items of a small dict, or a list,
+    # tuple, deque or array of any length, of IMMUTABLE values (or None) so
+    # that a later capture can tell the value is unchanged by comparing the
+    # identity of its items instead of summarizing it.  Only the first
+    # MAX_ITEMS items are summarized so only those are compared.
+    if kind is dict:
+        if len(value) <= MAX_ITEMS:
+            keys = tuple(value)
+            values = tuple(value.values())
+            if all(map(IMMUTABLE.__contains__, map(type, keys))) and \
+                    all(map(IMMUTABLE.__contains__, map(type, values))):
+                return (kind, len(value), keys, values)
+    elif kind is list or kind is tuple or kind is collections.deque:
+        items = tuple(itertools.islice(value, MAX_ITEMS))
+        if all(map(IMMUTABLE.__contains__, map(type, items))):
+            return (kind, len(value), items, None)
+    elif kind is array.array:
+        # Items of an array are new objects each time so its bytes are kept
+        return (kind, len(value), value[:MAX_ITEMS].tobytes(), value.typecode)
+    return None
+
+def unchanged(value, items):
+    (kind, length, keys, values) = items
+    if type(value) is not kind or len(value) != length:
+        return False
+    if kind is array.array:
+        return value.typecode == values and value[:MAX_ITEMS].tobytes() == keys
+    # map stops at the end of keys (the first MAX_ITEMS items)
+    return all(map(operator.is_, value, keys)) and \
+        (values is None or all(map(operator.is_, value.values(), values)))
+
+def enter(frame):
+    global next_frame_id
+    next_frame_id += 1
+    state = [next_frame_id, {}, KEYFRAME_INTERVAL, False]
+    frames[frame] = state
+    if frame.f_code.co_name != "<module>":
+        stack.append((frame.f_code.co_name, next_frame_id, frame))
+    return state
+
+def leave(frame):
+    global stack_kept
+    if stack and stack[-1][2] is frame:
+        stack.pop()
+        stack_kept = min(stack_kept, len(stack))
+    state = frames.pop(frame, None)
+    if state is not None and state[3]:
+        released.append(state[0])
+
+def stack_changes():
+    # Return the JSON of the stack changes since the last message or None
+    global stack_sent
+    global stack_kept
+    if stack_kept == stack_sent == len(stack):
+        return None
+    push = ",".join([f"[{encode_string(name)},{frame_id}]" for (name, frame_id, frame) in stack[stack_kept:]])
+    changes = f'{{"pop":{stack_sent - stack_kept},"push":[{push}]}}'
+    stack_sent = len(stack)
+    stack_kept = len(stack)
+    return changes
+
+def should_stop(event, line):
+    if except_occurred:
+        return False
+    if mode == "STEP":
+        return line != prev_line
+    if event != "line":
+        return False
+    if line in breakpoints:
+        return True
+    if mode == "STEP_OVER":
+        return depth <= target_depth
+    if mode == "STEP_OUT":
+        return depth < target_depth
+    return False
+
+def handle(frame, event):
+    # Handle a call, line or return event of a frame of the user code
+    global prev_line
+    global depth
+    global mode
+    global breakpoints
+    global recorded
+    global executed
+    if mode == "PROFILE":
+        profile(frame, event)
+        return
+    if mode == "SUMMARY":
+        if event == "line":
+            executed += 1
+        return
+    if event == "call":
+        depth += 1
+        enter(frame)
+        return
+    line = frame.f_lineno
+    stop = should_stop(event, line)
+    # In STEP and RECORD mode every line is sent (without waiting unless
+    # stopped).  In the other modes nothing is sent until the program stops.
+    if stop or mode == "STEP" or mode == "RECORD":
+        text = capture(frame)
+        changes = stack_changes()
+        if changes is not None:
+            text += f',"stack":{changes}'
+        text += f',"line":{line},"file":"{FILENAME}","wait":{"true" if stop else "false"}'
+        flush = stop
+        if mode == "RECORD":
+            text += f',"stdout":{output.count}'
+            recorded += 1
+            if recorded >= record_limit:
+                # Nothing may be sent after the last line recorded
+                mode = "CONTINUE"
+                breakpoints = set()
+                flush = True
+        write(f'{{"CMD":"DATA","CONTENT":{text}}}}}\n', flush)
+        if stop:
+            wait()
+    prev_line = line
+    if event == "return":
+        depth -= 1
+        leave(frame)
+
+def profile(frame, event):
+    global profiled_line
+    global profiled_at
+    global profile_sent
+    now = clock()
+    if profiled_line is not None:
+        profiled[profiled_line][1] += now - profiled_at
+    if event == "line":
+        line = frame.f_lineno
+        entry = profiled.get(line)
+        if entry is None:
+            profiled[line] = [1, 0.0]
+        else:
+            entry[0] += 1
+        profiled_line = line
+    elif event == "return":
+        # The time until the next line is the rest of the line that called
+        caller = frame.f_back
+        if caller is not None and caller.f_code.co_filename == FILENAME:
+            profiled_line = caller.f_lineno
+        else:
+            profiled_line = None
+    profiled_at = now
+    if now - profile_sent >= PROFILE_INTERVAL:
+        profile_sent = now
+        send("PROFILE", profile_content())
+
+def profile_content():
+    # The line running now is counted up to now
+    global profiled_at
+    now = clock()
+    if profiled_line is not None:
+        profiled[profiled_line][1] += now - profiled_at
+    profiled_at = now
+    return {"lines": [[line, hits, seconds] for (line, (hits, seconds)) in sorted(profiled.items())]}
+
+# Python 3.11 and older use sys.settrace.  Frames of other code (the
+# standard library and this harness) are not traced locally, but the
+# trace function is still called when each of them starts.
+def trace(frame, event, arg):
+    global except_occurred
+    if frame.f_code.co_filename != FILENAME:
+        return None
+    if event == "exception":
+        except_occurred = True
+    elif event == "call" or event == "line" or event == "return":
+        handle(frame, event)
+    return trace
+
+# Python 3.12 and newer use sys.monitoring.  Events are only turned on
+# for the code objects of the user code so other code runs at full speed.
+# In CONTINUE mode a line that is not a breakpoint is disabled after it
+# runs once; lines are enabled again whenever the mode or breakpoints
+# change.
+TOOL = 2
+lines_disabled = False
+
+# Counts the changes of breakpoints made by the listen thread.  A line the
+# program disables just as the breakpoints change may miss the restart of
+# the listen thread, so the program thread restarts the events again at
+# its next line once it sees the count change.  lines_disabled is only
+# used by the program thread.
+breakpoints_changed = 0
+breakpoints_seen = 0
+
+def user_code(code):
+    yield code
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            yield from user_code(const)
+
+def monitor_start(code, offset):
+    handle(sys._getframe(1), "call")
+
+def monitor_line(code, line):
+    global lines_disabled
+    global breakpoints_seen
+    if breakpoints_seen != breakpoints_changed:
+        breakpoints_seen = breakpoints_changed
+        sys.monitoring.restart_events()
+    handle(sys._getframe(1), "line")
+    if mode == "CONTINUE" and line not in breakpoints:
+        lines_disabled = True
+        return sys.monitoring.DISABLE
+
+def monitor_return(code, offset, value):
+    handle(sys._getframe(1), "return")
+
+def monitor_raise(code, offset, exception):
+    global except_occurred
+    if code.co_filename == FILENAME:
+        except_occurred = True
+
+def monitor_unwind(code, offset, exception):
+    if code.co_filename == FILENAME:
+        handle(sys._getframe(1), "return")
+
+def start_monitoring(code):
+    events = sys.monitoring.events
+    sys.monitoring.use_tool_id(TOOL, "pytrace")
+    sys.monitoring.register_callback(TOOL, events.PY_START, monitor_start)
+    sys.monitoring.register_callback(TOOL, events.PY_RESUME, monitor_start)
+    sys.monitoring.register_callback(TOOL, events.LINE, monitor_line)
+    sys.monitoring.register_callback(TOOL, events.PY_RETURN, monitor_return)
+    sys.monitoring.register_callback(TOOL, events.PY_YIELD, monitor_return)
+    sys.monitoring.register_callback(TOOL, events.RAISE, monitor_raise)
+    sys.monitoring.register_callback(TOOL, events.PY_UNWIND, monitor_unwind)
+    # RAISE and PY_UNWIND can not be turned on for single code objects
+    sys.monitoring.set_events(TOOL, events.RAISE | events.PY_UNWIND)
+    local = events.PY_START | events.PY_RESUME | events.LINE | events.PY_RETURN | events.PY_YIELD
+    for user in user_code(code):
+        sys.monitoring.set_local_events(TOOL, user, local)
+
+def stop_monitoring(code):
+    sys.monitoring.set_events(TOOL, 0)
+    for user in user_code(code):
+        sys.monitoring.set_local_events(TOOL, user, 0)
+    sys.monitoring.free_tool_id(TOOL)
+
+def enable_lines():
+    global lines_disabled
+    if lines_disabled:
+        lines_disabled = False
+        sys.monitoring.restart_events()
+
+def __pytrace():
+    global mode
+    global output
+    global record_limit
+    global user_globals
+    global profile_sent
+    connect()
+    start = channel.readline()
+    if not start:
+        return
+    start = json.loads(start)
+    code = start["CODE"]
+    mode = start["MODE"]
+    if start.get("STDIN") is not None:
+        # STDIN given up front (for batch runs) is read instead of the browser
+        sys.stdin = io.StringIO(start["STDIN"])
+    else:
+        sys.stdin = Input()
+    if mode == "RECORD":
+        record_limit = start["LIMIT"]
+        output = Output(sys.stdout)
+        sys.stdout = output
+    elif mode == "STEP":
+        breakpoints.update(start["BREAKPOINTS"])
+        if breakpoints:
+            # Run to the first breakpoint instead of stopping on the first line
+            mode = "CONTINUE"
+    threading.Thread(target=listen, daemon=True).start()
+    ns = dict()
+    user_globals = ns
+    builtins.__import__ = record_import
+    report = None
+    traced = mode != "RUN"
+    started = time.perf_counter()
+    profile_sent = started
+    try:
+        code = compile(code, FILENAME, "exec")
+        if traced:
+            if monitoring:
+                start_monitoring(code)
+            else:
+                sys.settrace(trace)
+        exec(code, ns, ns)
+
+    except SyntaxError as e:
+        report = [
+            "EXCEPTION OCCURRED",
+            "==================",
+            f"{type(e).__name__}: {e.msg}",
+            f"Row {e.lineno}"
+        ]
+
+    except Exception as e:
+        tb = traceback.extract_tb(e.__traceback__)
+        stack = []
+        report = [
+            "EXCEPTION OCCURRED",
+            "==================",
+            f"{type(e).__name__}: {str(e)}"
+        ]
+        for i in range(len(tb)-1, -1, -1):
+            if tb[i].filename == FILENAME:
+                if tb[i].name == "<module>":
+                    stack.append((None, tb[i].lineno))
+                else:
+                    stack.append((tb[i].name, tb[i].lineno))
+        space = ""
+        if len(stack) > 0:
+            for (name,line) in reversed(stack):
+                if name is None:
+                    report.append(f"Row {line}")
+                else:
+                    report.append(f"{space}\u2514\u2500\u25b6 Inside [{name}] (Row {line})")
+                space += "   "
+
+    finally:
+        wall_time = time.perf_counter() - started
+        if not traced:
+            pass
+        elif monitoring:
+            if isinstance(code, types.CodeType):
+                stop_monitoring(code)
+        else:
+            sys.settrace(None)
+        builtins.__import__ = system_import
+        if report is not None:
+            print()
+            print("\n".join(report))
+        sys.stdout.flush()
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        send("FINISHED", {
+            "imported": sorted(imported),
+            "exception": "\n".join(report) if report is not None else None,
+            "usage": {"cpu_time": usage.ru_utime + usage.ru_stime, "wall_time": wall_time,
+                      "max_rss": usage.ru_maxrss * 1024},
+            "lines": executed if mode == "SUMMARY" else None,
+            "profile": profile_content() if mode == "PROFILE" else None
+        })
+
+if __name__ == "__main__":
+    __pytrace()
@@ -0,0 +1,194 @@
+import uuid
+import asyncio
+import collections
+
+class Limits:
+    '''
+    Resources each run may use.  CPU time (seconds) and memory (bytes) are
+    enforced by the worker backend.  Wall time (seconds) is enforced by the
+    Process and does not include time spent stopped at a line or waiting for
+    STDIN to be typed.  A limit of None is not enforced.
+    '''
+
+    def __init__(self, cpu_time=10, wall_time=600, memory=256 * 1024 * 1024):
+        self.cpu_time = cpu_time
+        self.wall_time = wall_time
+        self.memory = memory
+
+class Ticket:
+    '''
+    A place in the admission queue.
+    '''
+
+    def __init__(self):
+        self.admitted = False
+        self.position = None
+        self.changed = asyncio.Event()
+
+class Scheduler:
+    '''
+    Limits how many processes run at once across the server.  Starts beyond
+    the limit wait in a first come first served queue and are told their
+    position as it changes.  Starts beyond max_queued are refused.  The
+    limits apply to every run.
+    '''
+
+    def __init__(self, max_running=8, max_queued=100, limits=None):
+        self.max_running = max_running
+        self.max_queued = max_queued
+        self.limits = limits
+        self.running = 0
+        self.waiters = collections.deque()
+
+    async def acquire(self, notify=None):
+        '''
+        Wait for a slot to run a process.  While waiting, notify is awaited
+        with the (1-based) position in the queue each time it changes.
+        Returns False if the queue is full.
+        '''
+        if self.running < self.max_running and not self.waiters:
+            self.running += 1
+            return True
+        if len(self.waiters) >= self.max_queued:
+            return False
+
+        ticket = Ticket()
+        self.waiters.append(ticket)
+        try:
+            while not ticket.admitted:
+                ticket.changed.clear()
+                if notify is not None:
+                    await notify(self.waiters.index(ticket) + 1)
+                if not ticket.admitted:
+                    await ticket.changed.wait()
+        except asyncio.CancelledError:
+            if ticket.admitted:
+                # Don't lose a slot that was handed over as we were cancelled
+                await self.release()
+            else:
+                self.waiters.remove(ticket)
+                self.moved()
+            raise
+        return True
+
+    async def release(self):
+        '''
+        Give the slot of a finished process to the longest waiting start.
+        '''
+        if self.waiters:
+            ticket = self.waiters.popleft()
+            ticket.admitted = True
+            ticket.changed.set()
+            self.moved()
+        else:
+            self.running -= 1
+
+    def moved(self):
+        '''
+        Wake every waiting start so it can report its new position.
+        '''
+        for ticket in self.waiters:
+            ticket.changed.set()
+
+    def depth(self):
+        '''
+        Return the number of (running, queued) processes.
+        '''
+        return (self.running, len(self.waiters))
+
+class SharedScheduler:
+    '''
+    Scheduler whose queue is kept in a store shared by several server
+    processes, so the limit applies to all of them together.  One task per
+    server process renews the leases of its tickets and polls for its
+    positions.  Tickets of a server process that stops renewing them are
+    dropped once their lease expires.  The store may block (for example
+    while another process holds the database lock) so it is only used from
+    a thread and never from the event loop itself.
+    '''
+
+    def __init__(self, store, max_running=8, max_queued=100, limits=None, poll_interval=0.2, lease=10):
+        self.store = store
+        self.max_running = max_running
+        self.max_queued = max_queued
+        self.limits = limits
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.waiting = {}
+        self.running = []
+        self.poll_task = None
+
+    async def acquire(self, notify=None):
+        '''
+        Wait for a slot to run a process.  While waiting, notify is awaited
+        with the (1-based) position in the queue each time it changes.
+        Returns False if the queue is full or the ticket was dropped.
+        '''
+        name = str(uuid.uuid4())
+        if not await asyncio.to_thread(self.store.enqueue, name, self.max_queued, self.lease):
+            return False
+        ticket = Ticket()
+        self.waiting[name] = ticket
+        await self.poll()
+        if self.poll_task is None:
+            self.poll_task = asyncio.create_task(self.handle_poll())
+        try:
+            while True:
+                if ticket.admitted:
+                    self.running.append(name)
+                    return True
+                if ticket.position is None:
+                    return False
+                ticket.changed.clear()
+                if notify is not None:
+                    await notify(ticket.position)
+                if not ticket.admitted:
+                    await ticket.changed.wait()
+        except asyncio.CancelledError:
+            await asyncio.to_thread(self.store.leave, name)
+            raise
+        finally:
+            self.waiting.pop(name, None)
+
+    async def release(self):
+        '''
+        Give up the slot of a finished process.  Slots are interchangeable so
+        any admitted ticket of this server process is removed.
+        '''
+        if self.running:
+            await asyncio.to_thread(self.store.leave, self.running.pop())
+
+    def depth(self):
+        '''
+        Return the number of (running, queued) processes of this server
+        process.
+        '''
+        return (len(self.running), len(self.waiting))
+
+    async def poll(self):
+        '''
+        Renew the leases of this server process and update the position of
+        every waiting ticket.
+        '''
+        positions = await asyncio.to_thread(self.store.update, list(self.waiting) + self.running,
+                                            self.max_running, self.lease)
+        for (name, ticket) in self.waiting.items():
+            position = positions.get(name)
+            if position != ticket.position:
+                ticket.position = position
+                ticket.admitted = position == 0
+                ticket.changed.set()
+
+    async def handle_poll(self):
+        '''
+        Poll the store until this server process has no tickets left.
+        '''
+        try:
+            while self.waiting or self.running:
+                await asyncio.sleep(self.poll_interval)
+                try:
+                    await self.poll()
+                except Exception as e:
+                    print(f"[{self}] => ERROR: Unable to update the admission queue [{e}]")
+        finally:
+            self.poll_task = None
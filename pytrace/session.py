@@ -0,0 +1,69 @@
+import asyncio
+
+class Sessions:
+    '''
+    Clients by session token (?session=... chosen by the browser).  When the
+    websocket of a client with a running program closes, the client is
+    detached instead of disconnected and its program keeps running for
+    grace_period seconds.  A browser that reconnects with the same token in
+    that time, and sends the secret the session was given (see
+    Client.resume), is attached to the same client and continues where it
+    was.
+    '''
+
+    def __init__(self, grace_period=60):
+        self.grace_period = grace_period
+        self.clients = {}
+        self.timers = {}
+
+    def get(self, token):
+        '''
+        Return the client of a session or None.
+        '''
+        if token is None:
+            return None
+        return self.clients.get(token)
+
+    def add(self, client):
+        if client.session is not None:
+            self.clients[client.session] = client
+
+    def remove(self, client):
+        '''
+        Forget a client (only if it is still the client of its session).
+        '''
+        if self.clients.get(client.session) is client:
+            del self.clients[client.session]
+        self.cancel(client)
+
+    def detached(self, client):
+        '''
+        Start the grace period of a detached client.
+        '''
+        self.cancel(client)
+        self.timers[client.session] = asyncio.create_task(self.expire(client))
+
+    def attached(self, client):
+        self.cancel(client)
+
+    def cancel(self, client):
+        timer = self.timers.pop(client.session, None)
+        if timer is not None and timer is not asyncio.current_task():
+            timer.cancel()
+
+    async def expire(self, client):
+        '''
+        Disconnect a client that was not attached again in time.  This stops
+        its program.
+        '''
+        await asyncio.sleep(self.grace_period)
+        self.timers.pop(client.session, None)
+        self.remove(client)
+        print(f"[{self}] => Session of [{client}] expired")
+        await client.disconnect()
+
+    def count(self):
+        '''
+        Return the number of detached clients.
+        '''
+        return len(self.timers)
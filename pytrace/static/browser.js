@@ -1,9 +1,13 @@
+import { decodeFrame, wireQuery } from "./wire.js";
+
 
 
 const STATE_DEAD = -1
 const STATE_IDLE = 0
 const STATE_RUNNING = 1
 const STATE_WAIT = 2
+const STATE_QUEUED = 3
+const STATE_INPUT = 4
 
 const WS_CMD_STDIN = "WS_CMD_STDIN"
 const WS_CMD_STDOUT = "WS_CMD_STDOUT"
@@ -13,15 +17,44 @@ const WS_CMD_STEP = "WS_CMD_STEP"
 const WS_CMD_STOP = "WS_CMD_STOP"
 const WS_CMD_STATE = "WS_CMD_STATE"
 const WS_CMD_DATA = "WS_CMD_DATA"
+const WS_CMD_CONTINUE = "WS_CMD_CONTINUE"
+const WS_CMD_STEP_OVER = "WS_CMD_STEP_OVER"
+const WS_CMD_STEP_OUT = "WS_CMD_STEP_OUT"
+const WS_CMD_BREAKPOINTS = "WS_CMD_BREAKPOINTS"
+const WS_CMD_EXPAND = "WS_CMD_EXPAND"
+const WS_CMD_TRACE = "WS_CMD_TRACE"
+const WS_CMD_QUEUE = "WS_CMD_QUEUE"
+const WS_CMD_RESYNC = "WS_CMD_RESYNC"
+const WS_CMD_PROFILE = "WS_CMD_PROFILE"
+const WS_CMD_SESSION = "WS_CMD_SESSION"
+const WS_CMD_RESUME = "WS_CMD_RESUME"
+
+// Close codes of the server: the session was continued in another window,
+// or the server would not continue the session without its secret
+const CLOSE_MOVED = 4001
+const CLOSE_REFUSED = 4403
 
 const DATA_VARIABLES = 0
 const DATA_FUNCTIONS = 1
 
+// Only the newest TERMINAL_LINES lines of output are kept.  Containers
+// show RENDER_ITEMS items at a time.  The values of the first EAGER_CARDS
+// variables are drawn at once; the others when scrolled into view.
+const TERMINAL_LINES = 5000
+const RENDER_ITEMS = 100
+const EAGER_CARDS = 30
+
 const codeArea = document.getElementById("codeArea")
 const terminalArea = document.getElementById("terminalArea");
+const terminalBorder = document.getElementById("terminalBorder");
 const dataArea = document.getElementById("dataArea");
 const startBtn = document.getElementById("startBtn");
+const recordBtn = document.getElementById("recordBtn");
+const profileBtn = document.getElementById("profileBtn");
 const stepBtn = document.getElementById("stepBtn");
+const overBtn = document.getElementById("overBtn");
+const outBtn = document.getElementById("outBtn");
+const continueBtn = document.getElementById("continueBtn");
 const stopBtn = document.getElementById("stopBtn");
 const openBtn = document.getElementById("openBtn");
 const saveBtn = document.getElementById("saveBtn");
@@ -30,10 +63,17 @@ const settingsBtn = document.getElementById("settingsBtn");
 const variableBtn = document.getElementById("variableBtn");
 const functionBtn = document.getElementById("functionBtn");
 const clearDataBtn = document.getElementById("clearDataBtn");
+const replayArea = document.getElementById("replayArea");
+const replaySlider = document.getElementById("replaySlider");
+const backBtn = document.getElementById("backBtn");
+const forwardBtn = document.getElementById("forwardBtn");
+const queueStatus = document.getElementById("queueStatus");
 
 let state = STATE_DEAD;
 startBtn.disabled = false;
-stepBtn.disabled = true;
+recordBtn.disabled = false;
+profileBtn.disabled = false;
+setStepButtons(true);
 stopBtn.disabled = true;
 openBtn.disabled = false;
 saveBtn.disabled = false;
@@ -44,9 +84,62 @@ functionBtn.disabled = false;
 clearDataBtn.disabled = false;
 
 let variables = {};
+let frames = new Map();
+let currFrame = -1;
+let viewFrame = -1;
+let stack = [];
 let currLine = -1;
 let visitedLines = new Set();
+let replay = null;
 let ws = null;
+let session = claimSession();
+
+// Messages only change the data and ask for a render.  Rendering is done
+// at most once per animation frame with the latest data, so a program
+// running quickly does not draw states that would never be seen.
+const pending = {
+    animation: 0,
+    variables: null,
+    highlight: true,
+    stack: null,
+    line: -1,
+    lines: new Set(),
+};
+
+// Cards are kept by variable name (and function by frame id) so a render
+// only changes the cards whose values changed.  Values of cards out of
+// view are not drawn until they are scrolled into view.
+let variableCards = new Map();
+let functionCards = new Map();
+let itemLimits = new Map();
+const noVariables = document.createElement("div");
+noVariables.className = "var-val";
+noVariables.textContent = "No Variables Exist";
+const noFunctions = document.createElement("div");
+noFunctions.className = "var-val";
+noFunctions.textContent = "No Functions Called";
+const cardObserver = new IntersectionObserver((entries) => {
+    for (const entry of entries) {
+        const card = entry.target.card;
+        card.visible = entry.isIntersecting;
+        if (card.visible && card.stale) {
+            renderCardValue(card);
+        }
+    }
+}, {root: dataArea, rootMargin: "200px"});
+
+// Output is kept in a ring of lines (the last line may be incomplete) and
+// the terminal is redrawn once per animation frame.  The line being typed
+// is kept in input and only sent when it is complete.
+const terminal = {
+    lines: new Array(TERMINAL_LINES),
+    start: 0,
+    count: 0,
+    dropped: 0,
+    text: "",
+    input: "",
+    changed: false,
+};
 
 const cm = CodeMirror.fromTextArea(codeArea, {
     mode: "python",
@@ -60,6 +153,7 @@ const cm = CodeMirror.fromTextArea(codeArea, {
     spellcheck: false,
     autocorrect: false,
     readOnly: false,
+    gutters: ["CodeMirror-linenumbers", "breakpoints", "profile"],
     extraKeys: {
         Tab: (cm) => cm.execCommand("indentMore"),
         "Shift-Tab": (cm) => cm.execCommand("indentLess"),
@@ -69,6 +163,7 @@ cm.getWrapperElement().style.fontSize = "14px";
 cm.setSize('100%', '100%');   // ensures .CodeMirror gets inline size
 
 cm.refresh(); 
+cm.on("gutterClick", (cm, line) => toggleBreakpoint(line));
 
 let dataAreaVariables = document.createElement("div");
 let dataAreaFunctions = document.createElement("div");
@@ -79,91 +174,367 @@ clear_data()
 setupListeners();
 connect();
 
-function renderDataVariables(data) {
+function applyDataVariables(content) {
+    // Variables arrive as changes to the last message for the same
+    // frame (or as a full keyframe).  Returns the complete variables.
+    for (const id of content.released) {
+        frames.delete(id);
+    }
+    let data = frames.get(content.frame);
+    if (content.keyframe || data === undefined) {
+        data = {};
+        frames.set(content.frame, data);
+    }
+    for (const name of content.removed) {
+        delete data[name];
+    }
+    Object.assign(data, content.variables);
+    currFrame = content.frame;
+    viewFrame = content.frame;
+    return data;
+}
+
+function applyStack(stack, changes) {
+    // The functions being run (outermost first) arrive as the number of
+    // functions to pop and the functions to push since the last message.
+    // Returns the new stack, which is only copied if it changed.
+    if (changes === undefined) {
+        return stack;
+    }
+    return stack.slice(0, stack.length - changes.pop).concat(changes.push);
+}
+
+function applyExpand(content) {
+    // Add the extra items (or characters) received for a truncated value
+    // and redraw if the value is still displayed.
+    if (content.value === null) {
+        return;
+    }
+    if (content.path.length == 0) {
+        // Every variable of a frame that was selected in the functions
+        frames.set(content.frame, content.value);
+        if (content.frame === viewFrame) {
+            scheduleVariables(content.value, false);
+        }
+        return;
+    }
+    const data = frames.get(content.frame);
+    if (data === undefined) {
+        return;
+    }
+    let node = data[content.path[0]];
+    for (const index of content.path.slice(1)) {
+        node = (node.type === "dict") ? node.items[index][1] : node.items[index];
+    }
+    if (node.type === "str" && content.offset === node.text.length) {
+        node.text += content.value.text;
+    } else if (node.items !== undefined && content.offset === node.items.length) {
+        node.items.push(...content.value.items);
+    }
+    if (content.frame === viewFrame) {
+        scheduleVariables(data, false);
+    }
+}
+
+function pyStr(text) {
+    return "'" + text.replaceAll("\\", "\\\\").replaceAll("'", "\\'").replaceAll("\n", "\\n") + "'";
+}
+
+function renderValue(parent, node, path) {
+    // Values are plain JSON for small numbers and strings.  Everything else
+    // is a summary from the tracer that may be truncated, in which case a
+    // link is added to request more of it.
+    const text = (value) => parent.appendChild(document.createTextNode(value));
+    if (node === null) {
+        text("None");
+    } else if (typeof node === "boolean") {
+        text(node ? "True" : "False");
+    } else if (typeof node === "number") {
+        text(String(node));
+    } else if (typeof node === "string") {
+        text(pyStr(node));
+    } else if (node.type === "repr") {
+        text(node.text + (node.text.length < node.length ? "\u2026" : ""));
+    } else if (node.type === "str") {
+        text(pyStr(node.text).slice(0, -1));
+        renderMore(parent, path, node.text.length, node.length);
+        text("'");
+    } else {
+        const brackets = {"list": "[]", "tuple": "()", "set": "{}", "frozenset": "{}", "dict": "{}"}[node.type];
+        if (node.class !== undefined || node.type === "frozenset") {
+            text((node.class || node.type) + "(");
+        }
+        text(brackets[0]);
+        // Large containers are drawn RENDER_ITEMS items at a time
+        const limitKey = (path === null) ? null : viewFrame + ":" + path.join("/");
+        const shown = Math.min(node.items.length, itemLimits.get(limitKey) || RENDER_ITEMS);
+        for (let index = 0; index < shown; index++) {
+            const item = node.items[index];
+            if (index > 0) {
+                text(", ");
+            }
+            if (node.type === "dict") {
+                renderValue(parent, item[0], null);
+                text(": ");
+                renderValue(parent, item[1], path.concat([index]));
+            } else {
+                renderValue(parent, item, path.concat([index]));
+            }
+        }
+        if (shown < node.items.length && limitKey !== null) {
+            text(", ");
+            renderShowMore(parent, limitKey, shown, node.length);
+        } else if (node.items.length < node.length) {
+            text(node.items.length > 0 ? ", " : "");
+            renderMore(parent, path, node.items.length, node.length);
+        }
+        if (node.type === "tuple" && node.length === 1) {
+            text(",");
+        }
+        text(brackets[1]);
+        if (node.class !== undefined || node.type === "frozenset") {
+            text(")");
+        }
+    }
+}
+
+function renderMore(parent, path, offset, length) {
+    const more = document.createElement("span");
+    more.className = "var-more";
+    more.textContent = `\u2026 ${length - offset} more`;
+    if (path !== null) {
+        const frame = viewFrame;
+        more.addEventListener("click", () => {
+            if (state === STATE_WAIT) {
+                ws_send(WS_CMD_EXPAND, {"FRAME" : frame, "PATH" : path, "OFFSET" : offset});
+            }
+        });
+    }
+    parent.appendChild(more);
+}
+
+function renderShowMore(parent, limitKey, shown, length) {
+    // Show more of the items already received without asking the server
+    const more = document.createElement("span");
+    more.className = "var-more";
+    more.textContent = `\u2026 ${length - shown} more`;
+    more.addEventListener("click", () => {
+        itemLimits.set(limitKey, shown + RENDER_ITEMS);
+        const card = more.closest(".var-card").card;
+        renderCardValue(card);
+    });
+    parent.appendChild(more);
+}
+
+function scheduleRender() {
+    if (pending.animation === 0) {
+        pending.animation = requestAnimationFrame(renderPending);
+    }
+}
+
+function scheduleVariables(data, highlightChanges = true) {
+    // Variables shown without highlighting stay that way until drawn
+    pending.highlight = (pending.variables === null) ? highlightChanges : pending.highlight && highlightChanges;
+    pending.variables = data;
+    scheduleRender();
+}
+
+function renderPending() {
+    pending.animation = 0;
+    if (pending.variables !== null) {
+        renderDataVariables(pending.variables, pending.highlight);
+        pending.variables = null;
+    }
+    if (pending.stack !== null) {
+        renderDataFunctions(pending.stack);
+        pending.stack = null;
+    }
+    if (pending.line !== -1) {
+        const line = pending.line;
+        const lines = pending.lines;
+        pending.line = -1;
+        pending.lines = new Set();
+        cm.operation(() => {
+            renderCodeHighlights(line);
+            // Lines run since the last frame are visited too
+            for (const other of lines) {
+                if (!visitedLines.has(other - 1)) {
+                    cm.addLineClass(other - 1, "background", "code-visited");
+                    visitedLines.add(other - 1);
+                }
+            }
+        });
+    }
+    renderTerminal();
+}
+
+function createVariableCard(name) {
+    const element = document.createElement("div");
+    element.className = "var-card";
+    element.setAttribute("role", "listitem");
+
+    const key = document.createElement("div");
+    key.className = "var-key";
+    key.textContent = name;
+
+    const val = document.createElement("div");
+    val.className = "var-val";
+
+    element.appendChild(key);
+    element.appendChild(val);
+    const card = {name: name, element: element, val: val, value: null, encoded: null,
+                  visible: variableCards.size < EAGER_CARDS, stale: false};
+    element.card = card;
+    cardObserver.observe(element);
+    return card;
+}
+
+function renderCardValue(card) {
+    card.val.replaceChildren();
+    renderValue(card.val, card.value, [card.name]);
+    card.stale = false;
+}
+
+function renderDataVariables(data, highlightChanges = true) {
     const entries = Object.entries(data);
 
     entries.sort(([a], [b]) => a.localeCompare(b));
 
-    dataAreaVariables.replaceChildren();
-
     if (entries.length == 0) {
-        const message = document.createElement("div");
-        message.className = "var-val";
-        message.textContent = String("No Variables Exist");
-        dataAreaVariables.appendChild(message);
+        for (const card of variableCards.values()) {
+            cardObserver.unobserve(card.element);
+        }
+        variableCards = new Map();
+        dataAreaVariables.replaceChildren(noVariables);
         return;
     }
+    if (noVariables.parentNode !== null) {
+        noVariables.remove();
+    }
 
-    for (const [name, value] of entries) {
-        
+    // Remove the cards of variables that no longer exist
+    for (const [name, card] of variableCards) {
+        if (!(name in data)) {
+            cardObserver.unobserve(card.element);
+            card.element.remove();
+            variableCards.delete(name);
+        }
+    }
+
+    for (const [index, [name, value]] of entries.entries()) {
+
+        const encoded = JSON.stringify(value);
         let highlight = false;
-        if (name in variables) {
-            if (variables[name] !== String(value)) {
+        if (!highlightChanges) {
+            // Showing a different frame so there is nothing to compare with
+        } else if (name in variables) {
+            if (variables[name] !== encoded) {
                 highlight = true;
             }
         } else {
             highlight = true;
         }
 
-        const card = document.createElement("div");
-        if (highlight) {
-            card.className = "var-card var-changed"
-        } else {
-            card.className = "var-card"
+        let card = variableCards.get(name);
+        if (card === undefined) {
+            card = createVariableCard(name);
+            variableCards.set(name, card);
+        }
+        card.element.classList.toggle("var-changed", highlight);
+        if (card.encoded !== encoded || card.value !== value) {
+            card.value = value;
+            card.encoded = encoded;
+            card.stale = true;
+        }
+        if (card.stale && card.visible) {
+            renderCardValue(card);
         }
-        card.setAttribute("role", "listitem");
-
-        const key = document.createElement("div");
-        key.className = "var-key";
-        key.textContent = name;
-
-        const val = document.createElement("div");
-        val.className = "var-val";
-        val.textContent = String(value);
 
-        card.appendChild(key);
-        card.appendChild(val);
-        dataAreaVariables.appendChild(card);
-        variables[name] = String(value);
+        // Cards are only moved when they are out of order
+        const current = dataAreaVariables.children[index];
+        if (current !== card.element) {
+            dataAreaVariables.insertBefore(card.element, current || null);
+        }
+        variables[name] = encoded;
     }
 }
 
 function renderDataFunctions(data) {
-    dataAreaFunctions.replaceChildren()
-
     if (data.length == 0) {
-        const message = document.createElement("div");
-        message.className = "var-val";
-        message.textContent = String("No Functions Called");
-        dataAreaFunctions.appendChild(message);
+        functionCards = new Map();
+        dataAreaFunctions.replaceChildren(noFunctions);
         return;
     }
+    if (noFunctions.parentNode !== null) {
+        noFunctions.remove();
+    }
 
-    for (const [index, name] of data.entries()) {
-        const card = document.createElement("div");
-        if (index == 0) {
-            card.className = "var-card var-changed"
-        } else {
-            card.className = "var-card"
+    const frameIds = new Set(data.map(([name, frame]) => frame));
+    for (const [frame, card] of functionCards) {
+        if (!frameIds.has(frame)) {
+            card.remove();
+            functionCards.delete(frame);
         }
-        card.setAttribute("role", "listitem");
-        
-        const key = document.createElement("div");
-        key.className = "var-key";
-        key.textContent = name;
-        card.appendChild(key);
-        dataAreaFunctions.appendChild(card);
+    }
+
+    // The innermost function is shown first.  Selecting a function shows
+    // its variables.
+    for (let index = 0; index < data.length; index++) {
+        const [name, frame] = data[data.length - 1 - index];
+        let card = functionCards.get(frame);
+        if (card === undefined) {
+            card = document.createElement("div");
+            card.className = "var-card";
+            card.setAttribute("role", "listitem");
+            card.addEventListener("click", () => selectFrame(frame));
+
+            const key = document.createElement("div");
+            key.className = "var-key";
+            key.textContent = name;
+            card.appendChild(key);
+            functionCards.set(frame, card);
+        }
+        card.classList.toggle("var-changed", index == 0);
+        const current = dataAreaFunctions.children[index];
+        if (current !== card) {
+            dataAreaFunctions.insertBefore(card, current || null);
+        }
+    }
+}
+
+function selectFrame(frame) {
+    // Show the last variables received for the frame and, if the program
+    // is stopped, ask for its current variables.
+    viewFrame = frame;
+    if (replay !== null) {
+        // The variables of the frame at the last step it ran
+        let index = replay.index;
+        while (index >= 0 && replay.steps[index].frame !== frame) {
+            index--;
+        }
+        renderDataVariables(index >= 0 ? replayVariables(index) : {}, false);
+        displayData(DATA_VARIABLES);
+        return;
+    }
+    renderDataVariables(frames.get(frame) || {}, false);
+    displayData(DATA_VARIABLES);
+    if (state === STATE_WAIT) {
+        ws_send(WS_CMD_EXPAND, {"FRAME" : frame, "PATH" : [], "OFFSET" : 0});
     }
 }
 
 function displayData(newDataState) {
     if (newDataState == DATA_VARIABLES) {
-        dataArea.replaceChildren(dataAreaVariables);
+        if (dataArea.firstChild !== dataAreaVariables) {
+            dataArea.replaceChildren(dataAreaVariables);
+        }
         variableBtn.style.backgroundColor = "cyan";
         functionBtn.style.backgroundColor = "";
         dataState = DATA_VARIABLES;
     } else if (newDataState == DATA_FUNCTIONS) {
-        dataArea.replaceChildren(dataAreaFunctions);
+        if (dataArea.firstChild !== dataAreaFunctions) {
+            dataArea.replaceChildren(dataAreaFunctions);
+        }
         variableBtn.style.backgroundColor = "";
         functionBtn.style.backgroundColor = "cyan";
         dataState = DATA_FUNCTIONS;
@@ -197,45 +568,86 @@ function clearCodeHighlights() {
     visitedLines = new Set();
 }
 
+function newSession() {
+    const bytes = crypto.getRandomValues(new Uint8Array(16));
+    return {token: Array.from(bytes, (b) => b.toString(16).padStart(2, "0")).join(""), secret: null};
+}
+
+function claimSession() {
+    // The token keeps this tab on the same server when several are running
+    // behind the router and lets a reload continue a running program.  It
+    // is taken out of sessionStorage while this page has it, so a tab
+    // duplicated from this one (which copies sessionStorage) starts its own
+    // session, and put back when the page is left.
+    const saved = {token: sessionStorage.getItem("pytraceSession"),
+                   secret: sessionStorage.getItem("pytraceSecret")};
+    sessionStorage.removeItem("pytraceSession");
+    sessionStorage.removeItem("pytraceSecret");
+    window.addEventListener("pagehide", () => {
+        sessionStorage.setItem("pytraceSession", session.token);
+        if (session.secret !== null) {
+            sessionStorage.setItem("pytraceSecret", session.secret);
+        }
+    });
+    window.addEventListener("pageshow", (event) => {
+        if (event.persisted) {
+            sessionStorage.removeItem("pytraceSession");
+            sessionStorage.removeItem("pytraceSecret");
+        }
+    });
+    return (saved.token === null) ? newSession() : saved;
+}
+
 function connect() {
-    ws = new WebSocket(`ws://${location.host}/ws`);
+    ws = new WebSocket(`ws://${location.host}/ws?session=${session.token}&${wireQuery()}`);
+    ws.binaryType = "arraybuffer";
+    // Frames are decoded in order even though inflating is asynchronous
+    let decoded = Promise.resolve();
     ws.onopen = () => {
-        terminalArea.value += "\n--- CONNECTED TO SERVER ---\n";
-        requestAnimationFrame(() => moveCaretToEnd(terminalArea));
+        // A session is only continued after its secret is sent
+        if (session.secret !== null) {
+            ws_send(WS_CMD_RESUME, {"SECRET" : session.secret});
+        }
+        writeTerminal("\n--- CONNECTED TO SERVER ---\n");
         state = STATE_IDLE;
         startBtn.disabled = false;
-        stepBtn.disabled = true;
+        recordBtn.disabled = false;
+        profileBtn.disabled = false;
+        setStepButtons(true);
         stopBtn.disabled = true;
     }
-    ws.onclose = () => {
-        if (state != STATE_DEAD) {
-            terminalArea.value += "\n--- SERVER IS DOWN ---\n"
-            requestAnimationFrame(() => moveCaretToEnd(terminalArea));
+    ws.onclose = (event) => {
+        if (event.code === CLOSE_MOVED) {
+            writeTerminal("\n--- SESSION CONTINUED IN ANOTHER WINDOW ---\n");
+        } else if (state != STATE_DEAD) {
+            writeTerminal("\n--- SERVER IS DOWN ---\n");
         }
         state = STATE_DEAD
         startBtn.disabled = true;
-        stepBtn.disabled = true;
+        recordBtn.disabled = true;
+        profileBtn.disabled = true;
+        setStepButtons(true);
         stopBtn.disabled = true;
+        if (event.code === CLOSE_MOVED) {
+            // Reconnecting would take the session back from the other window
+            return;
+        }
+        if (event.code === CLOSE_REFUSED) {
+            session = newSession();
+        }
         setTimeout(connect, 3000);
     }
     ws.onerror = () => {
         ws.close();
     }
     ws.onmessage = (event) => {
-        handle_ws(event);
+        decoded = decoded.then(() => decodeFrame(event.data)).then(handle_ws).catch((error) => {
+            console.log("ERROR: Unable to handle message => ", error);
+        });
     }
 }
 
-function handle_ws(event) {
-    let data;
-
-    try {
-        data = JSON.parse(event.data);
-    } catch (_) {
-        console.log("ERROR: Expected JSON => ", event.data);
-        return;
-    }
-
+function handle_ws(data) {
     if (!("CMD" in data)) {
         console.log("ERROR: Missing CMD parameter => ", data);
         return;
@@ -249,25 +661,56 @@ function handle_ws(event) {
     // console.log(">CMD: ",data.CMD," CONTENT: ",data.CONTENT);
     switch (data.CMD) {
         case WS_CMD_STDOUT:
-            terminalArea.value += data.CONTENT.TEXT;
-            requestAnimationFrame(() => moveCaretToEnd(terminalArea));
+            writeTerminal(data.CONTENT.TEXT);
             break;
 
         case WS_CMD_STATE:
             if (data.CONTENT.STATE === STATE_IDLE) {
                 startBtn.disabled = false;
-                stepBtn.disabled = true;
+                recordBtn.disabled = false;
+                profileBtn.disabled = false;
+                setStepButtons(true);
                 stopBtn.disabled = true;
                 openBtn.disabled = false;
                 saveBtn.disabled = false;
                 startBtn.style.backgroundColor = "green";
                 stepBtn.style.backgroundColor = "";
                 stopBtn.style.backgroundColor = "";
+                pending.line = -1;
+                pending.lines = new Set();
+                setInput("");
                 clearCodeHighlights()
                 cm.setOption("readOnly", false);
             } else if (data.CONTENT.STATE === STATE_RUNNING) {
                 startBtn.disabled = true;
-                stepBtn.disabled = true;
+                recordBtn.disabled = true;
+                profileBtn.disabled = true;
+                setStepButtons(true);
+                stopBtn.disabled = false;
+                openBtn.disabled = true;
+                saveBtn.disabled = true;
+                stopBtn.style.backgroundColor = "red";
+                stepBtn.style.backgroundColor = "";
+                startBtn.style.backgroundColor = "";
+                cm.setOption("readOnly", "nocursor");
+            } else if (data.CONTENT.STATE === STATE_INPUT) {
+                startBtn.disabled = true;
+                recordBtn.disabled = true;
+                profileBtn.disabled = true;
+                setStepButtons(true);
+                stopBtn.disabled = false;
+                openBtn.disabled = true;
+                saveBtn.disabled = true;
+                stopBtn.style.backgroundColor = "red";
+                stepBtn.style.backgroundColor = "";
+                startBtn.style.backgroundColor = "";
+                cm.setOption("readOnly", "nocursor");
+                terminalArea.focus();
+            } else if (data.CONTENT.STATE === STATE_QUEUED) {
+                startBtn.disabled = true;
+                recordBtn.disabled = true;
+                profileBtn.disabled = true;
+                setStepButtons(true);
                 stopBtn.disabled = false;
                 openBtn.disabled = true;
                 saveBtn.disabled = true;
@@ -277,7 +720,9 @@ function handle_ws(event) {
                 cm.setOption("readOnly", "nocursor");
             } else if (data.CONTENT.STATE === STATE_WAIT) {
                 startBtn.disabled = true;
-                stepBtn.disabled = false;
+                recordBtn.disabled = true;
+                profileBtn.disabled = true;
+                setStepButtons(false);
                 stopBtn.disabled = false;
                 openBtn.disabled = true;
                 saveBtn.disabled = true;
@@ -290,13 +735,42 @@ function handle_ws(event) {
                 return;
             }
             state = data.CONTENT.STATE;
+            queueStatus.classList.toggle("queue-active", state === STATE_QUEUED);
+            terminalBorder.classList.toggle("terminal-input", state === STATE_INPUT);
+            break;
+
+        case WS_CMD_QUEUE:
+            queueStatus.textContent = `Waiting to start (position ${data.CONTENT.POSITION})`;
             break;
 
         case WS_CMD_DATA:
-            renderDataVariables(data.CONTENT.variables);
-            renderDataFunctions(data.CONTENT.functions);
-            displayData(dataState);
-            renderCodeHighlights(data.CONTENT.line);
+            scheduleVariables(applyDataVariables(data.CONTENT));
+            stack = applyStack(stack, data.CONTENT.stack);
+            pending.stack = stack;
+            if (pending.line !== -1) {
+                pending.lines.add(pending.line);
+            }
+            pending.line = data.CONTENT.line;
+            break;
+
+        case WS_CMD_EXPAND:
+            applyExpand(data.CONTENT);
+            break;
+
+        case WS_CMD_TRACE:
+            startReplay(data.CONTENT);
+            break;
+
+        case WS_CMD_RESYNC:
+            applyResync(data.CONTENT);
+            break;
+
+        case WS_CMD_SESSION:
+            session.secret = data.CONTENT.SECRET;
+            break;
+
+        case WS_CMD_PROFILE:
+            showProfile(data.CONTENT);
             break;
 
         default:
@@ -304,6 +778,135 @@ function handle_ws(event) {
     }
 }
 
+function writeTerminal(text) {
+    terminal.text += text;
+    scheduleRender();
+}
+
+function clearTerminal() {
+    terminal.start = 0;
+    terminal.count = 0;
+    terminal.dropped = 0;
+    terminal.text = "";
+    terminal.changed = true;
+    scheduleRender();
+}
+
+function setInput(text) {
+    terminal.input = text;
+    terminal.changed = true;
+    scheduleRender();
+}
+
+function typeInput(text) {
+    // Send every complete line at once and keep the rest being typed.
+    // Lines are echoed by the program as it reads them.
+    const parts = (terminal.input + text).split("\n");
+    const rest = parts.pop();
+    if (parts.length > 0) {
+        ws_send(WS_CMD_STDIN, {"TEXT" : parts.join("\n") + "\n"});
+    }
+    setInput(rest);
+}
+
+function endInput() {
+    // Send what is typed without a new line and end the input (Ctrl-D)
+    ws_send(WS_CMD_STDIN, {"TEXT" : terminal.input, "EOF" : true});
+    setInput("");
+}
+
+function renderTerminal() {
+    // Add the text received since the last frame to the ring of lines,
+    // dropping the oldest lines once it is full, and redraw once.
+    if (terminal.text.length == 0 && !terminal.changed) {
+        return;
+    }
+    terminal.changed = false;
+    const parts = terminal.text.split("\n");
+    terminal.text = "";
+    if (terminal.count > 0) {
+        const last = (terminal.start + terminal.count - 1) % TERMINAL_LINES;
+        terminal.lines[last] += parts.shift();
+    }
+    for (const part of parts) {
+        if (terminal.count == TERMINAL_LINES) {
+            terminal.lines[terminal.start] = part;
+            terminal.start = (terminal.start + 1) % TERMINAL_LINES;
+            terminal.dropped += 1;
+        } else {
+            terminal.lines[(terminal.start + terminal.count) % TERMINAL_LINES] = part;
+            terminal.count += 1;
+        }
+    }
+    const end = terminal.start + terminal.count;
+    const lines = (end <= TERMINAL_LINES) ? terminal.lines.slice(terminal.start, end) :
+        terminal.lines.slice(terminal.start).concat(terminal.lines.slice(0, end - TERMINAL_LINES));
+    const header = (terminal.dropped > 0) ? `--- ${terminal.dropped} EARLIER LINES NOT SHOWN ---\n` : "";
+    terminalArea.value = header + lines.join("\n") + terminal.input;
+    moveCaretToEnd(terminalArea);
+}
+
+function applyResync(content) {
+    // The server kept the run going while disconnected.  Show where it is
+    // now and the output missed.  If the program is stopped the server
+    // sends the variables again, otherwise they come with the next stop.
+    handle_ws({"CMD" : WS_CMD_STATE, "CONTENT" : {"STATE" : content.STATE}});
+    if (content.POSITION !== undefined) {
+        handle_ws({"CMD" : WS_CMD_QUEUE, "CONTENT" : {"POSITION" : content.POSITION}});
+    }
+    writeTerminal(content.STDOUT);
+    if (content.STATE === STATE_IDLE) {
+        return;
+    }
+    stack = content.STACK;
+    pending.stack = stack;
+    if (content.FRAME !== null) {
+        currFrame = content.FRAME;
+        viewFrame = content.FRAME;
+    }
+    if (content.LINE !== null) {
+        pending.line = content.LINE;
+    }
+    scheduleRender();
+}
+
+function showProfile(content) {
+    // Each line run has [line, hits, seconds].  The hits are shown in the
+    // profile gutter, shaded by the share of the slowest line's time.
+    let slowest = 0;
+    let total = 0;
+    for (const [, , seconds] of content.lines) {
+        slowest = Math.max(slowest, seconds);
+        total += seconds;
+    }
+    cm.operation(() => {
+        cm.clearGutter("profile");
+        for (const [line, hits, seconds] of content.lines) {
+            if (line < 1 || line > cm.lineCount()) {
+                continue;
+            }
+            const marker = document.createElement("div");
+            marker.className = "profile-marker";
+            marker.textContent = formatHits(hits);
+            const heat = (slowest > 0) ? seconds / slowest : 0;
+            marker.style.backgroundColor = `rgba(208, 0, 0, ${(0.05 + 0.6 * heat).toFixed(2)})`;
+            const share = (total > 0) ? (100 * seconds / total).toFixed(1) : "0.0";
+            marker.title = `${hits} hits, ${(seconds * 1000).toFixed(2)} ms (${share}% of the time)`;
+            cm.setGutterMarker(line - 1, "profile", marker);
+        }
+    });
+}
+
+function formatHits(hits) {
+    if (hits >= 1e6) {
+        return (hits / 1e6).toFixed(1) + "M";
+    }
+    if (hits >= 1e4) {
+        return Math.round(hits / 1e3) + "k";
+    }
+    return String(hits);
+}
+
 function moveCaretToEnd(el) {
     el.focus();
     const len = el.value.length;
@@ -315,7 +918,10 @@ function setupListeners() {
     terminalArea.addEventListener("keydown", (event) => {
         if (event.key === "Enter") {
             event.preventDefault();
-            ws_send(WS_CMD_STDIN, {"TEXT" : "\n"});
+            typeInput("\n");
+        } else if (event.key === "d" && event.ctrlKey) {
+            event.preventDefault();
+            endInput();
         }
     });
 
@@ -323,27 +929,193 @@ function setupListeners() {
         event.preventDefault();
         if (event.inputType === "insertText" || event.inputType === "insertFromPaste") {
             if (event.data != null) {
-                ws_send(WS_CMD_STDIN, {"TEXT" : event.data});
+                typeInput(event.data);
             }
         } else if (event.inputType === "insertLineBreak") {
-            ws_send(WS_CMD_STDIN, {"TEXT" : "\n"});
+            typeInput("\n");
+        } else if (event.inputType === "deleteContentBackward") {
+            setInput(terminal.input.slice(0, -1));
         }
     });
 
+    terminalArea.addEventListener("paste", (event) => {
+        // Pasted text is not in event.data of beforeinput for a textarea
+        event.preventDefault();
+        typeInput(event.clipboardData.getData("text").replace(/\r\n?/g, "\n"));
+    });
+
     stopBtn.addEventListener("click", () => ws_send(WS_CMD_STOP, {}));
-    startBtn.addEventListener("click", () => { clear_data(); ws_send(WS_CMD_START, {"CODE" : cm.getValue()}) });
+    startBtn.addEventListener("click", () => { 
+        clear_data(); 
+        ws_send(WS_CMD_START, {"CODE" : cm.getValue(), "BREAKPOINTS" : getBreakpoints()}) 
+    });
+    recordBtn.addEventListener("click", () => { 
+        clear_data(); 
+        ws_send(WS_CMD_START, {"CODE" : cm.getValue(), "MODE" : "RECORD"}) 
+    });
+    profileBtn.addEventListener("click", () => {
+        clear_data();
+        ws_send(WS_CMD_START, {"CODE" : cm.getValue(), "MODE" : "PROFILE"})
+    });
+    backBtn.addEventListener("click", () => showReplayStep(replay.index - 1));
+    forwardBtn.addEventListener("click", () => showReplayStep(replay.index + 1));
+    replaySlider.addEventListener("input", () => showReplayStep(Number(replaySlider.value)));
     stepBtn.addEventListener("click", () => ws_send(WS_CMD_STEP, {}));
-    clearTerminalBtn.addEventListener("click", () => terminalArea.value = "");
+    overBtn.addEventListener("click", () => ws_send(WS_CMD_STEP_OVER, {}));
+    outBtn.addEventListener("click", () => ws_send(WS_CMD_STEP_OUT, {}));
+    continueBtn.addEventListener("click", () => ws_send(WS_CMD_CONTINUE, {}));
+    clearTerminalBtn.addEventListener("click", () => clearTerminal());
     clearDataBtn.addEventListener("click", () => clear_data());
     variableBtn.addEventListener("click", () => displayData(DATA_VARIABLES));
     functionBtn.addEventListener("click", () => displayData(DATA_FUNCTIONS));
 }
 
+function setStepButtons(disabled) {
+    stepBtn.disabled = disabled;
+    overBtn.disabled = disabled;
+    outBtn.disabled = disabled;
+    continueBtn.disabled = disabled;
+}
+
+function toggleBreakpoint(line) {
+    const info = cm.lineInfo(line);
+    if (info.gutterMarkers && info.gutterMarkers.breakpoints) {
+        cm.setGutterMarker(line, "breakpoints", null);
+    } else {
+        const marker = document.createElement("div");
+        marker.className = "breakpoint";
+        marker.textContent = "\u25cf";
+        cm.setGutterMarker(line, "breakpoints", marker);
+    }
+    if (state === STATE_RUNNING || state === STATE_WAIT || state === STATE_QUEUED || state === STATE_INPUT) {
+        ws_send(WS_CMD_BREAKPOINTS, {"LINES" : getBreakpoints()});
+    }
+}
+
+function getBreakpoints() {
+    // Markers move with their lines as the code is edited so the
+    // line numbers are collected when they are needed (1-based).
+    const lines = [];
+    let line = 0;
+    cm.eachLine((handle) => {
+        line += 1;
+        if (handle.gutterMarkers && handle.gutterMarkers.breakpoints) {
+            lines.push(line);
+        }
+    });
+    return lines;
+}
+
+function startReplay(content) {
+    // Index the recorded steps once so that any step can be shown directly.
+    // prev links each step to the previous step of the same frame so the
+    // variables can be rebuilt from the nearest keyframe.
+    // The stack of every step is rebuilt from the changes (steps that do
+    // not change it share the same array).
+    const prev = [];
+    const lastStep = new Map();
+    const firstVisit = new Map();
+    const stacks = [];
+    let replayStack = [];
+    for (const [index, step] of content.STEPS.entries()) {
+        replayStack = applyStack(replayStack, step.stack);
+        stacks.push(replayStack);
+        prev.push(lastStep.has(step.frame) ? lastStep.get(step.frame) : -1);
+        lastStep.set(step.frame, index);
+        if (!firstVisit.has(step.line)) {
+            firstVisit.set(step.line, index);
+        }
+    }
+    if (content.STEPS.length == 0) {
+        return;
+    }
+    replay = {
+        steps: content.STEPS, 
+        stdout: content.STDOUT, 
+        truncated: content.TRUNCATED, 
+        prev: prev, 
+        stacks: stacks, 
+        firstVisit: firstVisit, 
+        index: 0
+    };
+    replaySlider.max = String(replay.steps.length - 1);
+    replayArea.classList.add("replay-active");
+    showReplayStep(0);
+}
+
+function stopReplay() {
+    replay = null;
+    replayArea.classList.remove("replay-active");
+}
+
+function replayVariables(index) {
+    const chain = [];
+    for (let i = index; i != -1; i = replay.prev[i]) {
+        chain.push(replay.steps[i]);
+        if (replay.steps[i].keyframe) {
+            break;
+        }
+    }
+    const data = {};
+    for (const step of chain.reverse()) {
+        for (const name of step.removed || []) {
+            delete data[name];
+        }
+        Object.assign(data, step.variables);
+    }
+    return data;
+}
+
+function showReplayStep(index) {
+    if (replay === null || index < 0 || index >= replay.steps.length) {
+        return;
+    }
+    replay.index = index;
+    replaySlider.value = String(index);
+    const step = replay.steps[index];
+
+    currFrame = step.frame;
+    viewFrame = step.frame;
+    renderDataVariables(replayVariables(index));
+    renderDataFunctions(replay.stacks[index]);
+    displayData(dataState);
+
+    clearCodeHighlights();
+    for (const [line, first] of replay.firstVisit) {
+        if (first < index) {
+            cm.addLineClass(line - 1, "background", "code-visited");
+            visitedLines.add(line - 1);
+        }
+    }
+    renderCodeHighlights(step.line);
+
+    clearTerminal();
+    if (index == replay.steps.length - 1) {
+        writeTerminal(replay.stdout);
+        if (replay.truncated) {
+            writeTerminal("\n--- TRACE TRUNCATED ---\n");
+        }
+    } else {
+        writeTerminal(replay.stdout.slice(0, step.stdout));
+    }
+}
+
 function clear_data() {
+    stopReplay();
     variables = {};
+    itemLimits = new Map();
+    pending.variables = null;
+    pending.stack = null;
+    pending.line = -1;
+    pending.lines = new Set();
+    frames = new Map();
+    currFrame = -1;
+    viewFrame = -1;
+    stack = [];
     renderDataVariables([]);
     renderDataFunctions([]); 
     displayData(dataState);
+    cm.clearGutter("profile");
 }
 
 function ws_send(command, content) {
@@ -0,0 +1,119 @@
+// Decoding of the binary websocket wire (see wire.py).  A binary frame is
+// one flags byte followed by the MessagePack array [opcode, content].  The
+// payload is deflated when the compressed flag is set.
+
+// Opcodes are the position in this list (shared with wire.py)
+const OPCODES = [
+    "WS_CMD_STDIN", "WS_CMD_STDOUT", "WS_CMD_START", "WS_CMD_WAIT", "WS_CMD_STEP", "WS_CMD_STOP",
+    "WS_CMD_STATE", "WS_CMD_DATA", "WS_CMD_CONTINUE", "WS_CMD_STEP_OVER", "WS_CMD_STEP_OUT",
+    "WS_CMD_BREAKPOINTS", "WS_CMD_EXPAND", "WS_CMD_TRACE", "WS_CMD_QUEUE",
+    "WS_CMD_RESYNC", "WS_CMD_PROFILE", "WS_CMD_SESSION", "WS_CMD_RESUME"
+];
+
+const FLAG_COMPRESSED = 0x01;
+
+const textDecoder = new TextDecoder();
+
+// Query arguments that ask the server for the binary wire.  Compression is
+// only asked for when the browser can inflate.
+export function wireQuery() {
+    if (typeof DecompressionStream === "undefined") {
+        return "wire=binary";
+    }
+    return "wire=binary&compress=1";
+}
+
+// Return the {CMD, CONTENT} message of a websocket frame.  Text frames
+// are JSON.  Returns a promise as inflating is asynchronous.
+export async function decodeFrame(data) {
+    if (typeof data === "string") {
+        return JSON.parse(data);
+    }
+    let bytes = new Uint8Array(data);
+    const flags = bytes[0];
+    bytes = bytes.subarray(1);
+    if (flags & FLAG_COMPRESSED) {
+        const stream = new Blob([bytes]).stream().pipeThrough(new DecompressionStream("deflate"));
+        bytes = new Uint8Array(await new Response(stream).arrayBuffer());
+    }
+    const [opcode, content] = unpack(bytes);
+    return {"CMD" : OPCODES[opcode], "CONTENT" : content};
+}
+
+// Decode one MessagePack value.  Only the types sent by msgpack.packb for
+// JSON-like data are handled (no extension types).
+function unpack(bytes) {
+    const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+    let pos = 0;
+
+    function str(length) {
+        const text = textDecoder.decode(bytes.subarray(pos, pos + length));
+        pos += length;
+        return text;
+    }
+
+    function array(length) {
+        const items = new Array(length);
+        for (let i = 0; i < length; i++) {
+            items[i] = value();
+        }
+        return items;
+    }
+
+    function map(length) {
+        const object = {};
+        for (let i = 0; i < length; i++) {
+            const key = value();
+            object[key] = value();
+        }
+        return object;
+    }
+
+    function value() {
+        const type = bytes[pos++];
+        let result;
+        if (type <= 0x7f) {
+            return type;
+        } else if (type >= 0xe0) {
+            return type - 0x100;
+        } else if ((type & 0xe0) == 0xa0) {
+            return str(type & 0x1f);
+        } else if ((type & 0xf0) == 0x90) {
+            return array(type & 0x0f);
+        } else if ((type & 0xf0) == 0x80) {
+            return map(type & 0x0f);
+        }
+        switch (type) {
+            case 0xc0: return null;
+            case 0xc2: return false;
+            case 0xc3: return true;
+            case 0xca: result = view.getFloat32(pos); pos += 4; return result;
+            case 0xcb: result = view.getFloat64(pos); pos += 8; return result;
+            case 0xcc: result = view.getUint8(pos); pos += 1; return result;
+            case 0xcd: result = view.getUint16(pos); pos += 2; return result;
+            case 0xce: result = view.getUint32(pos); pos += 4; return result;
+            case 0xcf: result = Number(view.getBigUint64(pos)); pos += 8; return result;
+            case 0xd0: result = view.getInt8(pos); pos += 1; return result;
+            case 0xd1: result = view.getInt16(pos); pos += 2; return result;
+            case 0xd2: result = view.getInt32(pos); pos += 4; return result;
+            case 0xd3: result = Number(view.getBigInt64(pos)); pos += 8; return result;
+            case 0xd9: result = view.getUint8(pos); pos += 1; return str(result);
+            case 0xda: result = view.getUint16(pos); pos += 2; return str(result);
+            case 0xdb: result = view.getUint32(pos); pos += 4; return str(result);
+            case 0xdc: result = view.getUint16(pos); pos += 2; return array(result);
+            case 0xdd: result = view.getUint32(pos); pos += 4; return array(result);
+            case 0xde: result = view.getUint16(pos); pos += 2; return map(result);
+            case 0xdf: result = view.getUint32(pos); pos += 4; return map(result);
+            case 0xc4: result = view.getUint8(pos); pos += 1; break;
+            case 0xc5: result = view.getUint16(pos); pos += 2; break;
+            case 0xc6: result = view.getUint32(pos); pos += 4; break;
+            default: throw new Error(`Unsupported MessagePack type ${type}`);
+        }
+        // Binary data is returned as bytes
+        const data = bytes.slice(pos, pos + result);
+        pos += result;
+        return data;
+    }
+
+    return value();
+}
@@ -0,0 +1,159 @@
+import abc
+import time
+import sqlite3
+import threading
+
+class Store(abc.ABC):
+    '''
+    State shared by every server process: the admission queue of the
+    scheduler and the trace cache.  A store used by processes on several
+    hosts must implement these methods on a shared service.
+    '''
+
+    @abc.abstractmethod
+    def enqueue(self, ticket, max_queued, lease):
+        '''
+        Add ticket to the end of the admission queue.  Returns False if
+        max_queued tickets are already waiting.
+        '''
+
+    @abc.abstractmethod
+    def update(self, tickets, max_running, lease):
+        '''
+        Renew the lease of the tickets owned by the caller, drop tickets whose
+        lease has expired and admit waiting tickets in order while fewer than
+        max_running are admitted.  Returns the position of each owned ticket
+        (0 once admitted).  A ticket that has been dropped is not returned.
+        '''
+
+    @abc.abstractmethod
+    def leave(self, ticket):
+        '''
+        Remove ticket whether waiting or admitted.
+        '''
+
+    @abc.abstractmethod
+    def get_trace(self, key):
+        '''
+        Return the encoded trace stored for key or None.
+        '''
+
+    @abc.abstractmethod
+    def put_trace(self, key, entry, max_entries, max_bytes):
+        '''
+        Store the encoded trace for key and evict the least recently used
+        traces beyond max_entries or max_bytes.
+        '''
+
+    def close(self):
+        pass
+
+class SqliteStore(Store):
+    '''
+    Store kept in a sqlite database.  This shares state between server
+    processes on the same host and is the local stand-in for a networked
+    store.
+    '''
+
+    # Seconds to wait for another process holding the database lock
+    BUSY_TIMEOUT = 5
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=SqliteStore.BUSY_TIMEOUT, isolation_level=None,
+                                  check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS tickets (
+                               seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                               ticket TEXT UNIQUE NOT NULL,
+                               admitted INTEGER NOT NULL DEFAULT 0,
+                               expires REAL NOT NULL)""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS traces (
+                               key TEXT PRIMARY KEY,
+                               entry TEXT NOT NULL,
+                               size INTEGER NOT NULL,
+                               used REAL NOT NULL)""")
+
+    def transaction(self, function, *args):
+        '''
+        Run function with the database inside one write transaction.
+        '''
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                result = function(*args)
+            except:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+            return result
+
+    #########################################################################################
+    # Functions related to the admission queue                                              #
+    #########################################################################################
+
+    def enqueue(self, ticket, max_queued, lease):
+        def enqueue():
+            (waiting,) = self.db.execute("SELECT COUNT(*) FROM tickets WHERE admitted = 0").fetchone()
+            if waiting >= max_queued:
+                return False
+            self.db.execute("INSERT INTO tickets (ticket, expires) VALUES (?, ?)",
+                            (ticket, time.time() + lease))
+            return True
+        return self.transaction(enqueue)
+
+    def update(self, tickets, max_running, lease):
+        def update():
+            now = time.time()
+            self.db.executemany("UPDATE tickets SET expires = ? WHERE ticket = ?",
+                                [(now + lease, ticket) for ticket in tickets])
+            self.db.execute("DELETE FROM tickets WHERE expires < ?", (now,))
+            (running,) = self.db.execute("SELECT COUNT(*) FROM tickets WHERE admitted = 1").fetchone()
+            if running < max_running:
+                self.db.execute("""UPDATE tickets SET admitted = 1 WHERE seq IN (
+                                       SELECT seq FROM tickets WHERE admitted = 0 ORDER BY seq LIMIT ?)""",
+                                (max_running - running,))
+            waiting = self.db.execute("SELECT ticket FROM tickets WHERE admitted = 0 ORDER BY seq")
+            positions = {ticket : position for (position, (ticket,)) in enumerate(waiting, 1)}
+            owned = set(tickets)
+            admitted = self.db.execute("SELECT ticket FROM tickets WHERE admitted = 1")
+            positions.update({ticket : 0 for (ticket,) in admitted})
+            return {ticket : position for (ticket, position) in positions.items() if ticket in owned}
+        return self.transaction(update)
+
+    def leave(self, ticket):
+        def leave():
+            self.db.execute("DELETE FROM tickets WHERE ticket = ?", (ticket,))
+        self.transaction(leave)
+
+    #########################################################################################
+    # Functions related to the trace cache                                                  #
+    #########################################################################################
+
+    def get_trace(self, key):
+        def get_trace():
+            row = self.db.execute("SELECT entry FROM traces WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.db.execute("UPDATE traces SET used = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+        return self.transaction(get_trace)
+
+    def put_trace(self, key, entry, max_entries, max_bytes):
+        def put_trace():
+            self.db.execute("INSERT OR REPLACE INTO traces (key, entry, size, used) VALUES (?, ?, ?, ?)",
+                            (key, entry, len(entry), time.time()))
+            (count, size) = self.db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM traces").fetchone()
+            rows = self.db.execute("SELECT key, size FROM traces ORDER BY used").fetchall()
+            for (old_key, old_size) in rows:
+                if count <= max_entries and size <= max_bytes:
+                    break
+                self.db.execute("DELETE FROM traces WHERE key = ?", (old_key,))
+                count -= 1
+                size -= old_size
+        self.transaction(put_trace)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,84 @@
+import json
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+class Wire:
+    '''
+    Encoding of websocket messages sent to the browser.  The default is JSON
+    text.  A browser that asks for the binary wire (?wire=binary) is sent
+    MessagePack frames instead, with the command as an integer opcode, if
+    msgpack is installed.  Messages from the browser may use either.
+    '''
+
+    WIRE_JSON = "json"
+    WIRE_BINARY = "binary"
+
+    # Opcodes are the position in this list.  The list is shared with
+    # static/wire.js and commands may only be added to the end.
+    OPCODES = [
+        "WS_CMD_STDIN", "WS_CMD_STDOUT", "WS_CMD_START", "WS_CMD_WAIT", "WS_CMD_STEP", "WS_CMD_STOP",
+        "WS_CMD_STATE", "WS_CMD_DATA", "WS_CMD_CONTINUE", "WS_CMD_STEP_OVER", "WS_CMD_STEP_OUT",
+        "WS_CMD_BREAKPOINTS", "WS_CMD_EXPAND", "WS_CMD_TRACE", "WS_CMD_QUEUE",
+        "WS_CMD_RESYNC", "WS_CMD_PROFILE", "WS_CMD_SESSION", "WS_CMD_RESUME"
+    ]
+    OPCODE = {cmd : opcode for (opcode, cmd) in enumerate(OPCODES)}
+
+    # A binary frame is one flags byte followed by the MessagePack array
+    # [opcode, content].  Payloads of at least COMPRESS_SIZE bytes are
+    # deflated when the browser supports it.
+    FLAG_COMPRESSED = 0x01
+    COMPRESS_SIZE = 1024
+    COMPRESS_LEVEL = 1
+
+    # Largest payload a compressed frame from the browser may inflate to
+    MAX_FRAME = 1 << 20
+
+    def __init__(self, mode=WIRE_JSON, compress=False):
+        self.mode = mode
+        self.compress = compress
+
+    @staticmethod
+    def negotiate(args):
+        '''
+        Choose the wire for a websocket from its query arguments.  The binary
+        wire is only used when msgpack is installed.
+        '''
+        if args.get("wire") == Wire.WIRE_BINARY and msgpack is not None:
+            return Wire(Wire.WIRE_BINARY, args.get("compress") == "1")
+        return Wire()
+
+    def encode(self, cmd, content):
+        '''
+        Return the frame for a message (str for JSON, bytes for binary).
+        '''
+        if self.mode == Wire.WIRE_JSON or cmd not in Wire.OPCODE:
+            return json.dumps({"CMD" : cmd, "CONTENT" : content})
+        payload = msgpack.packb([Wire.OPCODE[cmd], content], use_bin_type=True)
+        if self.compress and len(payload) >= Wire.COMPRESS_SIZE:
+            return bytes([Wire.FLAG_COMPRESSED]) + zlib.compress(payload, Wire.COMPRESS_LEVEL)
+        return b"\x00" + payload
+
+    def decode(self, frame):
+        '''
+        Return the message in a frame from the browser as a dictionary.
+        Raises ValueError for a binary frame that inflates to more than
+        MAX_FRAME bytes or has an unknown opcode.
+        '''
+        if isinstance(frame, str):
+            return json.loads(frame)
+        if msgpack is None:
+            raise ValueError("Binary frame received without msgpack installed")
+        payload = frame[1:]
+        if frame[0] & Wire.FLAG_COMPRESSED:
+            inflate = zlib.decompressobj()
+            payload = inflate.decompress(payload, Wire.MAX_FRAME)
+            if inflate.unconsumed_tail:
+                raise ValueError(f"Binary frame inflates to more than {Wire.MAX_FRAME} bytes")
+        (opcode, content) = msgpack.unpackb(payload, raw=False)
+        if type(opcode) is not int or not 0 <= opcode < len(Wire.OPCODES):
+            raise ValueError(f"Binary frame has unknown opcode {opcode!r}")
+        return {"CMD" : Wire.OPCODES[opcode], "CONTENT" : content}
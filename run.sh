@@ -1,6 +1,10 @@
 #!/usr/bin/env bash
 source venv311/bin/activate
 # quart -A pytrace/app run
+# Build the image the workers run in (again after the harness changes)
+# docker build -t pytrace-sandbox pytrace/sandbox
+# Several server processes behind one port sharing a sqlite store
+# python pytrace/router.py --workers 4
 python -m hypercorn pytrace/app
 
 
@@ -0,0 +1,38 @@
+import os
+import sys
+import asyncio
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pytrace"))
+
+from pool import Pool, SubprocessBackend
+from batch import Batch, Job, load_jobs
+
+def run(coroutine, timeout=30):
+    return asyncio.run(asyncio.wait_for(coroutine, timeout))
+
+def run_batch(jobs):
+    async def main():
+        pool = Pool(SubprocessBackend(None, sys.executable), 1)
+        await pool.start()
+        try:
+            return [result async for result in Batch(pool, None, 1).run(jobs)]
+        finally:
+            await pool.close()
+    return run(main())
+
+def test_job_with_stdin_fixture(tmp_path):
+    program = tmp_path / "greet.py"
+    program.write_text('name = input("Name? ")\nprint("Hello", name)\nprint(1 / int(input()))\n')
+    (tmp_path / "greet.stdin").write_text("Ada\n0\n")
+    [result] = run_batch(load_jobs([str(program)], ""))
+    exception = "EXCEPTION OCCURRED\n==================\nZeroDivisionError: division by zero\nRow 3"
+    assert result["ID"] == str(program)
+    assert result["STATUS"] == Job.STATUS_EXCEPTION
+    assert result["EXCEPTION"] == exception
+    assert result["STDOUT"] == "Name? Hello Ada\n\n" + exception + "\n"
+    assert not result["TRUNCATED"]
+
+def test_stdout_without_pty_newlines():
+    job = Job("0", "")
+    job.add_stdout("one\r\ntwo\r\n")
+    assert "".join(job.stdout) == "one\ntwo\n"
@@ -0,0 +1,74 @@
+import os
+import sys
+import copy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pytrace"))
+
+from outbox import Outbox
+
+def apply(state, content):
+    # The same as applyDataVariables and applyStack in static/browser.js
+    (frames, stack) = state
+    for frame in content["released"]:
+        frames.pop(frame, None)
+    if content["keyframe"] or content["frame"] not in frames:
+        frames[content["frame"]] = {}
+    data = frames[content["frame"]]
+    for name in content["removed"]:
+        data.pop(name, None)
+    data.update(content["variables"])
+    changes = content.get("stack")
+    if changes is not None:
+        stack = stack[:len(stack) - changes["pop"]] + changes["push"]
+    return (frames, stack)
+
+def data(variables, removed=(), keyframe=False, stack=None, released=(), frame=1, wait=False):
+    content = {"frame" : frame, "keyframe" : keyframe, "variables" : variables,
+               "removed" : list(removed), "released" : list(released), "line" : 1, "wait" : wait}
+    if stack is not None:
+        content["stack"] = stack
+    return content
+
+def check_merge(previous, content):
+    state = ({1 : {"a" : 1, "b" : 2}, 2 : {"c" : 3}}, [["<module>", 1], ["f", 2]])
+    assert Outbox.supersedes(previous, content)
+    merged = Outbox.merge_data(previous, content)
+    expected = apply(apply(copy.deepcopy(state), previous), content)
+    assert apply(copy.deepcopy(state), merged) == expected
+    return merged
+
+def test_keyframe_after_diff():
+    merged = check_merge(data({"a" : 5}, removed=["b"]), data({"x" : 1}, keyframe=True))
+    assert merged["keyframe"]
+
+def test_diff_after_keyframe():
+    merged = check_merge(data({"x" : 1, "y" : 2}, keyframe=True), data({"y" : 3}, removed=["x"]))
+    assert merged["keyframe"]
+    assert merged["variables"] == {"y" : 3}
+
+def test_name_removed_then_added():
+    merged = check_merge(data({}, removed=["a"]), data({"a" : 7}))
+    assert merged["removed"] == []
+
+def test_name_added_then_removed():
+    check_merge(data({"z" : 1}), data({}, removed=["z", "b"]))
+
+def test_pop_more_than_pushed():
+    merged = check_merge(data({}, stack={"pop" : 0, "push" : [["g", 3]]}),
+                         data({}, stack={"pop" : 2, "push" : [["h", 4]]}))
+    assert merged["stack"] == {"pop" : 1, "push" : [["h", 4]]}
+
+def test_pop_less_than_pushed():
+    check_merge(data({}, stack={"pop" : 1, "push" : [["g", 3], ["h", 4]]}),
+                data({}, stack={"pop" : 1, "push" : [["k", 5]]}))
+
+def test_stack_only_in_first():
+    check_merge(data({}, stack={"pop" : 1, "push" : []}), data({"a" : 2}))
+
+def test_released_frames():
+    check_merge(data({}, released=[2]), data({"b" : 4}, released=[3]))
+
+def test_supersedes():
+    assert not Outbox.supersedes(data({}, wait=True), data({}))
+    assert not Outbox.supersedes(data({}), data({}, frame=2))
+    assert not Outbox.supersedes({}, data({}))
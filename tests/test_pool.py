@@ -0,0 +1,41 @@
+import os
+import sys
+import asyncio
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pytrace"))
+
+from pool import Pool, SubprocessBackend
+
+def run(coroutine, timeout=30):
+    return asyncio.run(asyncio.wait_for(coroutine, timeout))
+
+def test_close_after_release():
+    async def main():
+        pool = Pool(SubprocessBackend(None, sys.executable), 1)
+        await pool.start()
+        worker = await pool.acquire(10)
+        assert worker is not None
+        await pool.release(worker)
+        await pool.close()
+        assert pool.maintain_task is None
+        assert not pool.workers
+    run(main())
+
+def test_close_just_after_wakeup():
+    # The cancel of close arrives while the maintain task is being woken
+    async def main():
+        pool = Pool(SubprocessBackend(None, sys.executable), 1)
+        await pool.start()
+        worker = await pool.acquire(10)
+        await pool.release(worker)
+        while not pool.idle:
+            await asyncio.sleep(0.05)
+        await asyncio.sleep(0.05)
+        task = pool.maintain_task
+        pool.wakeup.set()
+        task.cancel()
+        await asyncio.sleep(0.1)
+        assert task.done()
+        await pool.close()
+        assert not pool.workers
+    run(main())
@@ -0,0 +1,60 @@
+import os
+import sys
+import json
+import asyncio
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pytrace"))
+
+from interface import Interface
+from pool import Worker
+from process import Process
+
+def run(coroutine, timeout=30):
+    return asyncio.run(asyncio.wait_for(coroutine, timeout))
+
+def frame(cmd, content):
+    return json.dumps({"CMD" : cmd, "CONTENT" : content}).encode() + b"\n"
+
+def read_frames(writes):
+    '''
+    Return the messages Process.handle_server passes on for the writes of
+    the code process, giving the reader a turn after each write.
+    '''
+    async def main():
+        messages = []
+        async def callback(message):
+            messages.append(message)
+        process = Process("", callback, None)
+        reader = asyncio.StreamReader(limit=Worker.FRAME_LIMIT)
+        task = asyncio.create_task(process.handle_server(reader))
+        for data in writes:
+            reader.feed_data(data)
+            await asyncio.sleep(0)
+        reader.feed_eof()
+        await task
+        return messages
+    return run(main())
+
+def test_frame_split_across_writes():
+    data = frame(Interface.TRACE_CMD_PROFILE, {"lines" : {"1" : [1, 0.5]}})
+    messages = read_frames([data[:5], data[5:20], data[20:]])
+    assert messages == [{"CMD" : Interface.PROC_CMD_PROFILE, "CONTENT" : {"lines" : {"1" : [1, 0.5]}}}]
+
+def test_two_frames_in_one_write():
+    first = {"frame" : 1, "keyframe" : True, "variables" : {"a" : 1}, "wait" : False}
+    second = {"frame" : 1, "keyframe" : False, "variables" : {"a" : 2}, "wait" : False}
+    messages = read_frames([frame(Interface.TRACE_CMD_DATA, first) + frame(Interface.TRACE_CMD_DATA, second)])
+    assert messages == [{"CMD" : Interface.PROC_CMD_DATA_NO_WAIT, "CONTENT" : first},
+                        {"CMD" : Interface.PROC_CMD_DATA_NO_WAIT, "CONTENT" : second}]
+
+def test_frame_larger_than_64k():
+    content = {"frame" : 1, "path" : [], "value" : "x" * (200 * 1024)}
+    data = frame(Interface.TRACE_CMD_EXPAND, content)
+    writes = [data[offset:offset + 64 * 1024] for offset in range(0, len(data), 64 * 1024)]
+    messages = read_frames(writes)
+    assert messages == [{"CMD" : Interface.PROC_CMD_EXPAND, "CONTENT" : content}]
+
+def test_partial_frame_at_close_dropped():
+    data = frame(Interface.TRACE_CMD_PROFILE, {})
+    messages = read_frames([data + data[:-1]])
+    assert messages == [{"CMD" : Interface.PROC_CMD_PROFILE, "CONTENT" : {}}]